@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Boot markers -------------------------------------------------------------------------------------
+
+# Console messages marking the start of each boot phase, in boot order.
+boot_markers = [
+    ("bios",        r"BIOS built on"),
+    ("bios_boot",   r"Boot sequence"),
+    ("liftoff",     r"Liftoff!"),
+    ("emulator",    r"VexRiscv Machine Mode software built"),
+    ("linux",       r"Linux version"),
+    ("initramfs",   r"Unpacking initramfs"),
+    ("free_init",   r"Freeing unused kernel memory"),
+    ("init",        r"Run /(s?bin/)?init as init process"),
+    ("userspace",   r"Starting syslogd|Welcome to Buildroot"),
+    ("login",       r"login:"),
+]
+
+# Boot Profiler ------------------------------------------------------------------------------------
+
+class BootProfiler:
+    """Timestamps boot markers on a console stream and reports the per-phase boot time."""
+    def __init__(self, markers=boot_markers, echo=True):
+        self.markers    = [(name, re.compile(pattern)) for name, pattern in markers]
+        self.echo       = echo
+        self.timestamps = {}
+
+    def feed(self, line):
+        if self.echo:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        for name, pattern in self.markers:
+            if name not in self.timestamps and pattern.search(line):
+                self.timestamps[name] = time.time()
+
+    def done(self):
+        return self.markers[-1][0] in self.timestamps
+
+    def run(self, stream, timeout):
+        deadline = time.time() + timeout
+        for line in stream:
+            if isinstance(line, bytes):
+                line = line.decode(errors="replace")
+            self.feed(line)
+            if self.done() or time.time() > deadline:
+                break
+
+    def phases(self):
+        """Returns [(phase, duration)], a phase lasting from its marker to the next seen marker."""
+        seen = [(name, self.timestamps[name]) for name, _ in self.markers if name in self.timestamps]
+        return [(name, next_t - t) for (name, t), (_, next_t) in zip(seen, seen[1:])]
+
+    def report(self, reference=None, threshold=0.1):
+        """Print the phases breakdown, compared to a reference run ({phase: duration}) if given."""
+        phases = self.phases()
+        total  = sum(duration for _, duration in phases)
+        print("")
+        print("{:<12} {:>10} {:>7} {:>10} {:>8}".format("Phase", "Time (s)", "%", "Ref (s)", "Delta"))
+        print("-"*51)
+        for name, duration in phases + [("total", total)]:
+            line = "{:<12} {:>10.3f} {:>6.1f}%".format(name, duration, 100*duration/max(total, 1e-9))
+            if reference is not None and name in reference:
+                ref   = reference[name]
+                delta = (duration - ref)/max(ref, 1e-9)
+                line += " {:>10.3f} {:>+7.1f}%".format(ref, 100*delta)
+                if delta > threshold:
+                    line += " REGRESSION"
+            print(line)
+        missing = [name for name, _ in self.markers if name not in self.timestamps]
+        if missing:
+            print("Markers not seen: {}".format(", ".join(missing)))
+
+    def results(self):
+        r = dict(self.phases())
+        r["total"] = sum(r.values())
+        return r
+
+def open_stream(source, baudrate):
+    if source == "-":
+        return sys.stdin.buffer
+    if source.startswith("cmd:"):
+        # Ex: cmd:./sim.py to profile the simulation (serial2console) boot.
+        p = subprocess.Popen(source[4:], shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return p.stdout
+    import serial
+    return serial.serial_for_url(source, baudrate)
+
+def main():
+    parser = argparse.ArgumentParser(description="Linux on LiteX-VexRiscv boot profiler")
+    parser.add_argument("source", help="serial port, - (stdin) or cmd:<command> (ex: cmd:./sim.py)")
+    parser.add_argument("--speed", type=float, default=1e6, help="serial baudrate")
+    parser.add_argument("--timeout", type=float, default=3600, help="profiling timeout (s)")
+    parser.add_argument("--save", help="save phases durations to JSON file")
+    parser.add_argument("--compare", help="compare to phases durations JSON file of a previous run")
+    parser.add_argument("--threshold", type=float, default=10, help="regression threshold (%%)")
+    parser.add_argument("--quiet", action="store_true", help="do not echo the console")
+    args = parser.parse_args()
+
+    profiler = BootProfiler(echo=not args.quiet)
+    try:
+        profiler.run(open_stream(args.source, int(args.speed)), args.timeout)
+    except KeyboardInterrupt:
+        pass
+
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+    profiler.report(reference, args.threshold/100)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(profiler.results(), f, indent=4)
+
+if __name__ == "__main__":
+    main()
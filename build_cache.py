@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+import subprocess
+import multiprocessing
+
+# Build Cache --------------------------------------------------------------------------------------
+
+# Toolchain version commands, their output is part of the cache key.
+toolchain_version_cmds = {
+    "vivado":  [["vivado", "-version"]],
+    "ise":     [["xst", "-help"]],
+    "trellis": [["yosys", "-V"], ["nextpnr-ecp5", "--version"]],
+    "quartus": [["quartus_sh", "--version"]],
+}
+
+# Gateware inputs: generated Verilog and constraint files.
+gateware_inputs = ["*.v", "*.xdc", "*.ucf", "*.lpf", "*.pcf", "*.qsf", "*.sdc"]
+
+# BIOS binary (initial ROM contents), from the software build.
+bios_binary = os.path.join("software", "bios", "bios.bin")
+
+# Gateware outputs restored on cache hits.
+gateware_outputs = ["top.bit", "top.bin", "top.svf", "top.sof", "top.rbf"]
+
+# Generation timestamps (and the __DATE__ __TIME__ build date of the BIOS) would make every key unique.
+_timestamp_re = re.compile(rb"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}|[A-Z][a-z]{2} [ \d]\d \d{4} \d{2}:\d{2}:\d{2}")
+
+def _hash_file(h, filename):
+    h.update(os.path.basename(filename).encode())
+    with open(filename, "rb") as f:
+        for line in f:
+            h.update(_timestamp_re.sub(b"", line))
+
+def toolchain_version(toolchain):
+    version = ""
+    for cmd in toolchain_version_cmds.get(toolchain, []):
+        try:
+            version += subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                timeout=60).stdout.decode(errors="replace")
+        except (OSError, subprocess.SubprocessError):
+            version += "unknown"
+    return version
+
+
+class BuildCache:
+    """Content-hashed cache of the gateware outputs.
+
+    The key covers the generated Verilog and constraint files, the CPU/platform Verilog sources,
+    the generated software headers, the BIOS binary initializing the ROM (its build date excluded),
+    the toolchain version and the SoC configuration.
+    """
+    def __init__(self, cache_dir="build/cache"):
+        self.cache_dir = cache_dir
+        self.hits      = multiprocessing.Value("i", 0)
+        self.misses    = multiprocessing.Value("i", 0)
+
+    def key(self, soc, build_dir, toolchain, config):
+        h = hashlib.sha256()
+        h.update(json.dumps(config, sort_keys=True, default=str).encode())
+        h.update(toolchain_version(toolchain).encode())
+        gateware_dir = os.path.join(build_dir, "gateware")
+        for pattern in gateware_inputs:
+            for filename in sorted(glob.glob(os.path.join(gateware_dir, pattern))):
+                _hash_file(h, filename)
+        for source in sorted(getattr(soc.platform, "sources", [])):
+            _hash_file(h, source[0])
+        generated_dir = os.path.join(build_dir, "software", "include", "generated")
+        for filename in sorted(glob.glob(os.path.join(generated_dir, "*"))):
+            _hash_file(h, filename)
+        _hash_file(h, os.path.join(build_dir, bios_binary))
+        return h.hexdigest()
+
+    def restore(self, key, build_dir):
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            with self.misses.get_lock():
+                self.misses.value += 1
+            return False
+        gateware_dir = os.path.join(build_dir, "gateware")
+        for filename in os.listdir(entry):
+            shutil.copy2(os.path.join(entry, filename), os.path.join(gateware_dir, filename))
+        with self.hits.get_lock():
+            self.hits.value += 1
+        return True
+
+    def store(self, key, build_dir):
+        entry = os.path.join(self.cache_dir, key)
+        tmp   = entry + ".tmp{}".format(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for filename in gateware_outputs:
+            filename = os.path.join(build_dir, "gateware", filename)
+            if os.path.exists(filename):
+                shutil.copy2(filename, tmp)
+        try:
+            os.rename(tmp, entry)
+        except OSError: # Stored concurrently by another build.
+            shutil.rmtree(tmp)
+
+    def summary(self):
+        print("Build cache: {} hit(s), {} miss(es)".format(self.hits.value, self.misses.value))
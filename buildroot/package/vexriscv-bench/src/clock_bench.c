@@ -0,0 +1,43 @@
+/* clock_gettime() throughput benchmark */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+static double elapsed(struct timespec *start, struct timespec *end)
+{
+	return (end->tv_sec - start->tv_sec) + (end->tv_nsec - start->tv_nsec)*1e-9;
+}
+
+static void print_clocksource(void)
+{
+	char name[64] = "unknown";
+	FILE *f = fopen("/sys/devices/system/clocksource/clocksource0/current_clocksource", "r");
+	if (f) {
+		if (fgets(name, sizeof(name), f))
+			name[strcspn(name, "\n")] = 0;
+		fclose(f);
+	}
+	printf("Clocksource: %s\n", name);
+}
+
+int main(int argc, char **argv)
+{
+	double duration = argc > 1 ? atof(argv[1]) : 1.0;
+	struct timespec start, now;
+	unsigned long calls = 0;
+	double t;
+
+	print_clocksource();
+	clock_gettime(CLOCK_MONOTONIC, &start);
+	do {
+		clock_gettime(CLOCK_MONOTONIC, &now);
+		calls++;
+		t = elapsed(&start, &now);
+	} while (t < duration);
+
+	printf("clock_gettime(CLOCK_MONOTONIC): %lu calls in %.3fs, %.0f calls/s, %.2f us/call\n",
+		calls, t, calls/t, 1e6*t/calls);
+	return 0;
+}
@@ -0,0 +1,118 @@
+/* Network benchmark server (client: eth_bench.py on the host)
+ *
+ * UDP port 5001: echo (latency).
+ * TCP port 5001: 9 bytes request: mode ('r': receive, 't': transmit) and length (64-bit big
+ * endian). The server receives length bytes and replies a byte ('r') or sends length bytes ('t').
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <unistd.h>
+#include <poll.h>
+#include <netinet/in.h>
+#include <sys/socket.h>
+
+#define PORT 5001
+
+static char buffer[16384];
+
+static int bind_socket(int type, int port)
+{
+	struct sockaddr_in addr;
+	int one = 1;
+	int s = socket(AF_INET, type, 0);
+	if (s < 0) {
+		perror("socket");
+		exit(1);
+	}
+	setsockopt(s, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+	memset(&addr, 0, sizeof(addr));
+	addr.sin_family = AF_INET;
+	addr.sin_addr.s_addr = htonl(INADDR_ANY);
+	addr.sin_port = htons(port);
+	if (bind(s, (struct sockaddr *)&addr, sizeof(addr)) < 0) {
+		perror("bind");
+		exit(1);
+	}
+	return s;
+}
+
+static int read_full(int s, void *data, size_t len)
+{
+	size_t done = 0;
+	while (done < len) {
+		ssize_t n = read(s, (char *)data + done, len - done);
+		if (n <= 0)
+			return -1;
+		done += n;
+	}
+	return 0;
+}
+
+static void tcp_serve(int s)
+{
+	unsigned char request[9];
+	uint64_t length = 0;
+	int i;
+
+	if (read_full(s, request, sizeof(request)) < 0)
+		return;
+	for (i = 1; i < 9; i++)
+		length = (length << 8) | request[i];
+
+	if (request[0] == 'r') {
+		while (length > 0) {
+			ssize_t n = read(s, buffer, length < sizeof(buffer) ? length : sizeof(buffer));
+			if (n <= 0)
+				return;
+			length -= n;
+		}
+		write(s, "r", 1);
+	} else if (request[0] == 't') {
+		while (length > 0) {
+			ssize_t n = write(s, buffer, length < sizeof(buffer) ? length : sizeof(buffer));
+			if (n <= 0)
+				return;
+			length -= n;
+		}
+	}
+}
+
+int main(void)
+{
+	struct pollfd fds[2];
+	int udp = bind_socket(SOCK_DGRAM, PORT);
+	int tcp = bind_socket(SOCK_STREAM, PORT);
+
+	if (listen(tcp, 1) < 0) {
+		perror("listen");
+		return 1;
+	}
+	printf("net_bench: listening on TCP/UDP port %d\n", PORT);
+
+	fds[0].fd = udp;
+	fds[0].events = POLLIN;
+	fds[1].fd = tcp;
+	fds[1].events = POLLIN;
+	while (1) {
+		if (poll(fds, 2, -1) < 0)
+			continue;
+		if (fds[0].revents & POLLIN) {
+			struct sockaddr_in addr;
+			socklen_t addrlen = sizeof(addr);
+			ssize_t n = recvfrom(udp, buffer, sizeof(buffer), 0, (struct sockaddr *)&addr, &addrlen);
+			if (n > 0)
+				sendto(udp, buffer, n, 0, (struct sockaddr *)&addr, addrlen);
+		}
+		if (fds[1].revents & POLLIN) {
+			int s = accept(tcp, NULL, NULL);
+			if (s >= 0) {
+				tcp_serve(s);
+				close(s);
+			}
+		}
+	}
+	return 0;
+}
@@ -0,0 +1,23 @@
+################################################################################
+#
+# vexriscv-bench
+#
+################################################################################
+
+VEXRISCV_BENCH_VERSION = 1.0
+VEXRISCV_BENCH_SITE = $(BR2_EXTERNAL_LITEX_VEXRISCV_PATH)/package/vexriscv-bench/src
+VEXRISCV_BENCH_SITE_METHOD = local
+
+VEXRISCV_BENCH_PROGRAMS = clock_bench net_bench
+
+define VEXRISCV_BENCH_BUILD_CMDS
+	$(foreach p,$(VEXRISCV_BENCH_PROGRAMS),\
+		$(TARGET_CC) $(TARGET_CFLAGS) $(TARGET_LDFLAGS) -o $(@D)/$(p) $(@D)/$(p).c$(sep))
+endef
+
+define VEXRISCV_BENCH_INSTALL_TARGET_CMDS
+	$(foreach p,$(VEXRISCV_BENCH_PROGRAMS),\
+		$(INSTALL) -D -m 0755 $(@D)/$(p) $(TARGET_DIR)/usr/bin/$(p)$(sep))
+endef
+
+$(eval $(generic-package))
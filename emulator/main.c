@@ -30,20 +30,18 @@
     _a < _b ? _a : _b; })
 
 extern const uint32_t _sp;
+extern uint32_t _trap_stats[];
+extern uint32_t _sim_snapshot[];
+
+#ifdef CSR_SUPERVISOR_SNAPSHOT_ADDR
+#define SIM_SNAPSHOT
+#endif
 
 void vexriscv_machine_mode_trap(void);
+static void console_tx_flush(void);
 
 /* LiteX peripherals access functions */
 
-static void litex_putchar(char c){
-    uint32_t full;
-    full = 1;
-    while ((full & 0x1) != 0)
-        full = uart_txfull_read();
-    if (c != '\r')
-        uart_rxtx_write(c);
-}
-
 static int32_t litex_getchar(void){
     int32_t c;
     uint32_t empty;
@@ -61,9 +59,9 @@ static uint32_t litex_read_cpu_timer_lsb(void){
     return ((cpu_timer_time_read() >> 0) & 0xffffffff);
 }
 
-static uint32_t litex_read_cpu_timer_msb(void){
+static uint64_t litex_read_cpu_timer(void){
     cpu_timer_latch_write(1);
-    return ((cpu_timer_time_read() >> 32) & 0xffffffff);
+    return cpu_timer_time_read();
 }
 
 static void litex_write_cpu_timer_cmp(uint32_t low, uint32_t high){
@@ -72,6 +70,7 @@ static void litex_write_cpu_timer_cmp(uint32_t low, uint32_t high){
 }
 
 static void litex_stop(void){
+	console_tx_flush();
 #ifdef CSR_SUPERVISOR_FINISH_ADDR
     supervisor_finish_write(1);
 #endif
@@ -120,6 +119,9 @@ static int32_t vexriscv_read_word(uint32_t address, int32_t *data){
 	return fail;
 }
 
+#ifdef UNALIGNED_BENCH
+/* Legacy byte-wise unaligned accesses, kept for comparison (see unaligned_bench) */
+
 static int32_t vexriscv_read_word_unaligned(uint32_t address, int32_t *data){
 	int32_t result, tmp;
 	int32_t fail;
@@ -164,6 +166,8 @@ static int32_t vexriscv_read_half_unaligned(uint32_t address, int32_t *data){
 	return fail;
 }
 
+#endif
+
 static int32_t vexriscv_write_word(uint32_t address, int32_t data){
 	int32_t tmp;
 	int32_t fail;
@@ -180,6 +184,7 @@ static int32_t vexriscv_write_word(uint32_t address, int32_t data){
 }
 
 
+#ifdef UNALIGNED_BENCH
 static int32_t vexriscv_write_word_unaligned(uint32_t address, int32_t data){
 	int32_t tmp;
 	int32_t fail;
@@ -201,8 +206,6 @@ static int32_t vexriscv_write_word_unaligned(uint32_t address, int32_t data){
 	return fail;
 }
 
-
-
 static int32_t vexriscv_write_short_unaligned(uint32_t address, int32_t data){
 	int32_t tmp;
 	int32_t fail;
@@ -219,6 +222,116 @@ static int32_t vexriscv_write_short_unaligned(uint32_t address, int32_t data){
 
 	return fail;
 }
+#endif
+
+/* Fast unaligned accesses: loads are done with the aligned word(s) covering the access and
+   merged, stores with the largest naturally aligned accesses (no read-modify-write that could
+   race with DMA). All the accesses are done in a single trap barrier. */
+
+static int32_t vexriscv_read_unaligned(uint32_t address, uint32_t size, int32_t *data){
+	uint32_t base  = address & ~3;
+	uint32_t shift = (address & 3)*8;
+	uint32_t lo, hi, tmp;
+	int32_t fail;
+	if((address & 3) + size <= 4) {
+		__asm__ __volatile__ (
+			vexriscv_trap_barrier_start
+			"	lw       %[lo], 0(%[base])\n"
+			vexriscv_trap_barrier_end
+			: [lo]"=&r" (lo), [fail]"=&r" (fail), [tmp]"=&r" (tmp)
+			: [base]"r" (base)
+			: "memory"
+		);
+		*data = lo >> shift;
+	} else {
+		__asm__ __volatile__ (
+			vexriscv_trap_barrier_start
+			"	lw       %[lo], 0(%[base])\n"
+			"	lw       %[hi], 4(%[base])\n"
+			vexriscv_trap_barrier_end
+			: [lo]"=&r" (lo), [hi]"=&r" (hi), [fail]"=&r" (fail), [tmp]"=&r" (tmp)
+			: [base]"r" (base)
+			: "memory"
+		);
+		*data = (lo >> shift) | (hi << (32 - shift));
+	}
+	return fail;
+}
+
+static int32_t vexriscv_write_unaligned(uint32_t address, uint32_t size, int32_t data){
+	int32_t tmp;
+	int32_t fail;
+	if(size == 2) {
+		/* SH at odd address */
+		__asm__ __volatile__ (
+			vexriscv_trap_barrier_start
+			"	sb       %[data], 0(%[address])\n"
+			"	srli     %[tmp],  %[data], 8\n"
+			"	sb       %[tmp],  1(%[address])\n"
+			vexriscv_trap_barrier_end
+			: [fail]"=&r" (fail), [tmp]"=&r" (tmp)
+			: [address]"r" (address), [data]"r" (data)
+			: "memory"
+		);
+	} else if(address & 1) {
+		/* SW at odd address: byte, aligned half, byte */
+		__asm__ __volatile__ (
+			vexriscv_trap_barrier_start
+			"	sb       %[data], 0(%[address])\n"
+			"	srli     %[tmp],  %[data], 8\n"
+			"	sh       %[tmp],  1(%[address])\n"
+			"	srli     %[tmp],  %[data], 24\n"
+			"	sb       %[tmp],  3(%[address])\n"
+			vexriscv_trap_barrier_end
+			: [fail]"=&r" (fail), [tmp]"=&r" (tmp)
+			: [address]"r" (address), [data]"r" (data)
+			: "memory"
+		);
+	} else {
+		/* SW at half aligned address */
+		__asm__ __volatile__ (
+			vexriscv_trap_barrier_start
+			"	sh       %[data], 0(%[address])\n"
+			"	srli     %[tmp],  %[data], 16\n"
+			"	sh       %[tmp],  2(%[address])\n"
+			vexriscv_trap_barrier_end
+			: [fail]"=&r" (fail), [tmp]"=&r" (tmp)
+			: [address]"r" (address), [data]"r" (data)
+			: "memory"
+		);
+	}
+	return fail;
+}
+
+/* AMOs: load, operation and store done in a single trap barrier */
+
+#define VEXRISCV_AMO(name, op) \
+static int32_t vexriscv_amo_##name(uint32_t address, int32_t src, int32_t *data){ \
+	int32_t result, value, tmp; \
+	int32_t fail; \
+	__asm__ __volatile__ ( \
+		vexriscv_trap_barrier_start \
+		"	lw       %[result], 0(%[address])\n" \
+		op \
+		"	sw       %[value],  0(%[address])\n" \
+		vexriscv_trap_barrier_end \
+		: [result]"=&r" (result), [value]"=&r" (value), [fail]"=&r" (fail), [tmp]"=&r" (tmp) \
+		: [address]"r" (address), [src]"r" (src) \
+		: "memory" \
+	); \
+	*data = result; \
+	return fail; \
+}
+
+VEXRISCV_AMO(add,  "	add      %[value], %[result], %[src]\n")
+VEXRISCV_AMO(swap, "	mv       %[value], %[src]\n")
+VEXRISCV_AMO(xor,  "	xor      %[value], %[result], %[src]\n")
+VEXRISCV_AMO(and,  "	and      %[value], %[result], %[src]\n")
+VEXRISCV_AMO(or,   "	or       %[value], %[result], %[src]\n")
+VEXRISCV_AMO(min,  "	mv       %[value], %[result]\n	blt      %[result], %[src], 2f\n	mv       %[value], %[src]\n2:\n")
+VEXRISCV_AMO(max,  "	mv       %[value], %[result]\n	bge      %[result], %[src], 2f\n	mv       %[value], %[src]\n2:\n")
+VEXRISCV_AMO(minu, "	mv       %[value], %[result]\n	bltu     %[result], %[src], 2f\n	mv       %[value], %[src]\n2:\n")
+VEXRISCV_AMO(maxu, "	mv       %[value], %[result]\n	bgeu     %[result], %[src], 2f\n	mv       %[value], %[src]\n2:\n")
 
 /* VexRiscv Machine Mode Emulator */
 
@@ -256,6 +369,7 @@ static void vexriscv_machine_mode_trap_entry(void) {
 	"sw x30,   30*4(sp)\n"
 	"sw x31,   31*4(sp)\n"
 	"call vexriscv_machine_mode_trap\n"
+	"vexriscv_machine_mode_trap_exit:\n"
 	"lw x1,   1*4(sp)\n"
 	"lw x3,   3*4(sp)\n"
 	"lw x4,   4*4(sp)\n"
@@ -334,6 +448,18 @@ static void vexriscv_machine_mode_trap_to_supervisor_trap(uint32_t sepc, uint32_
 	);
 }
 
+/* Word of a supervisor buffer passed to an SBI call. A faulting access traps back here: the trap
+   state of the SBI call is then restored. */
+static int32_t vexriscv_read_sbi_word(uint32_t address, int32_t *data, uint32_t mepc, uint32_t mstatus){
+	if(vexriscv_read_word(address, data)) {
+		csr_write(mtvec,   vexriscv_machine_mode_trap_entry);
+		csr_write(mepc,    mepc);
+		csr_write(mstatus, mstatus);
+		return 1;
+	}
+	return 0;
+}
+
 
 static uint32_t vexriscv_read_instruction(uint32_t pc){
 	uint32_t i;
@@ -352,68 +478,575 @@ static uint32_t vexriscv_read_instruction(uint32_t pc){
 }
 
 
-void vexriscv_machine_mode_trap(void) {
+/* Unaligned accesses emulation */
+
+static void vexriscv_emulate_unaligned(uint32_t cause){
+	uint32_t mepc = csr_read(mepc);
+	uint32_t mstatus = csr_read(mstatus);
+	uint32_t address = csr_read(mbadaddr);
+	uint32_t instruction = vexriscv_read_instruction(mepc);
+	uint32_t func3 = (instruction >> 12) & 0x7;
+	uint32_t reg = (cause == CAUSE_UNALIGNED_LOAD) ? (instruction >> 7) & 0x1f : (instruction >> 20) & 0x1f; /* rd/rs2 */
+	int32_t value;
+	int32_t fail;
+
+	if(cause == CAUSE_UNALIGNED_LOAD) {
+		switch(func3){
+			case 1: /* LH */
+				fail = vexriscv_read_unaligned(address, 2, &value);
+				value = (int32_t)(value << 16) >> 16;
+				break;
+			case 5: /* LHU */
+				fail = vexriscv_read_unaligned(address, 2, &value);
+				value &= 0xffff;
+				break;
+			case 2: /* LW */
+				fail = vexriscv_read_unaligned(address, 4, &value);
+				break;
+			default: fail = 1; break;
+		}
+	} else {
+		value = vexriscv_read_register(reg);
+		switch(func3){
+			case 1: fail = vexriscv_write_unaligned(address, 2, value); break; /* SH */
+			case 2: fail = vexriscv_write_unaligned(address, 4, value); break; /* SW */
+			default: fail = 1; break;
+		}
+	}
+
+	if(fail){
+		vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
+		return;
+	}
+
+	if(cause == CAUSE_UNALIGNED_LOAD)
+		vexriscv_write_register(reg, value);
+	csr_write(mepc, mepc + 4);
+	csr_write(mtvec, vexriscv_machine_mode_trap_entry); /* Restore MTVEC */
+}
+
+#ifdef UNALIGNED_BENCH
+static volatile int unaligned_legacy; /* Use legacy emulation (see unaligned_bench) */
+
+static void vexriscv_emulate_unaligned_legacy(uint32_t cause){
+	switch(cause){
+	    case CAUSE_UNALIGNED_LOAD:{
+		    uint32_t mepc = csr_read(mepc);
+		    uint32_t mstatus = csr_read(mstatus);
+		    uint32_t instruction = vexriscv_read_instruction(mepc);
+		    uint32_t address = csr_read(mbadaddr);
+		    uint32_t func3 =(instruction >> 12) & 0x7;
+		    uint32_t rd = (instruction >> 7) & 0x1F;
+		    int32_t readValue;
+		    int32_t fail = 1;
+
+		    switch(func3){
+		    case 1: fail = vexriscv_read_half_unaligned(address, &readValue); break;  //LH
+		    case 2: fail = vexriscv_read_word_unaligned(address, &readValue); break; //LW
+		    case 5: fail = vexriscv_read_half_unaligned(address, &readValue) & 0xFFFF; break; //LHU
+		    }
+
+		    if(fail){
+			    vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
+			    return;
+		    }
+
+		    vexriscv_write_register(rd, readValue);
+		    csr_write(mepc, mepc + 4);
+		    csr_write(mtvec, vexriscv_machine_mode_trap_entry); //Restore mtvec
+	    }break;
+	    case CAUSE_UNALIGNED_STORE:{
+		    uint32_t mepc = csr_read(mepc);
+		    uint32_t mstatus = csr_read(mstatus);
+		    uint32_t instruction = vexriscv_read_instruction(mepc);
+		    uint32_t address = csr_read(mbadaddr);
+		    uint32_t func3 =(instruction >> 12) & 0x7;
+		    int32_t writeValue = vexriscv_read_register((instruction >> 20) & 0x1F);
+		    int32_t fail = 1;
+
+		    switch(func3){
+		    case 1: fail = vexriscv_write_short_unaligned(address, writeValue); break; //SH
+		    case 2: fail = vexriscv_write_word_unaligned(address, writeValue); break; //SW
+		    }
+
+		    if(fail){
+			    vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
+			    return;
+		    }
+
+		    csr_write(mepc, mepc + 4);
+		    csr_write(mtvec, vexriscv_machine_mode_trap_entry); //Restore mtvec
+	    }break;
+	}
+}
+#endif
+
+/* Atomics emulation */
+
+/* LR/SC are done in hardware on the Linux VexRiscv variants and only emulated otherwise. Single
+   hart: the emulated reservation is cleared by SC, by emulated AMOs on the reserved word and by
+   machine timer interrupts (possible context switch). */
+static uint32_t lr_reservation_valid = 0;
+static uint32_t lr_reservation_address;
+
+static void vexriscv_emulate_atomic(uint32_t instr, uint32_t mepc, uint32_t mstatus){
+	uint32_t sel = instr >> 27;
+	uint32_t address = vexriscv_read_register((instr >> 15) & 0x1f);
+	int32_t src = vexriscv_read_register((instr >> 20) & 0x1f);
+	int32_t result;
+	int32_t fail;
+
+	switch(sel){
+		case 0x0:  fail = vexriscv_amo_add(address, src, &result); break;
+		case 0x1:  fail = vexriscv_amo_swap(address, src, &result); break;
+		case 0x2: /* LR */
+			fail = vexriscv_read_word(address, &result);
+			lr_reservation_valid   = !fail;
+			lr_reservation_address = address;
+			break;
+		case 0x3: /* SC */
+			if(lr_reservation_valid && lr_reservation_address == address) {
+				fail = vexriscv_write_word(address, src);
+				result = 0;
+			} else {
+				fail = 0;
+				result = 1;
+			}
+			lr_reservation_valid = 0;
+			break;
+		case 0x4:  fail = vexriscv_amo_xor(address, src, &result); break;
+		case 0xC:  fail = vexriscv_amo_and(address, src, &result); break;
+		case 0x8:  fail = vexriscv_amo_or(address, src, &result); break;
+		case 0x10: fail = vexriscv_amo_min(address, src, &result); break;
+		case 0x14: fail = vexriscv_amo_max(address, src, &result); break;
+		case 0x18: fail = vexriscv_amo_minu(address, src, &result); break;
+		case 0x1C: fail = vexriscv_amo_maxu(address, src, &result); break;
+		default: litex_stop(); return;
+	}
+	if(sel != 0x2 && address == lr_reservation_address)
+		lr_reservation_valid = 0;
+
+	if(fail){
+		vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
+		return;
+	}
+
+	vexriscv_write_register((instr >> 7) & 0x1f, result);
+	csr_write(mepc, mepc + 4);
+	csr_write(mtvec, vexriscv_machine_mode_trap_entry); /* Restore MTVEC */
+}
+
+#ifdef ATOMIC_BENCH
+static volatile int atomic_legacy; /* Use legacy emulation (see atomic_bench) */
+
+static void vexriscv_emulate_atomic_legacy(uint32_t instr, uint32_t mepc, uint32_t mstatus){
+	uint32_t sel = instr >> 27;
+	uint32_t addr = vexriscv_read_register((instr >> 15) & 0x1f);
+	int32_t src = vexriscv_read_register((instr >> 20) & 0x1f);
+	uint32_t rd = (instr >> 7) & 0x1f;
+	int32_t read_value;
+	int32_t write_value = 0
+	;
+	if(vexriscv_read_word(addr, &read_value)) {
+		vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
+		return;
+	}
+
+	switch(sel){
+		case 0x0:  write_value = src + read_value; break;
+		case 0x1:  write_value = src; break;
+		case 0x2:  break; /*  LR, SC done in hardware (cheap) and require */
+		case 0x3:  break; /*  to keep track of context switches */
+		case 0x4:  write_value = src ^ read_value; break;
+		case 0xC:  write_value = src & read_value; break;
+		case 0x8:  write_value = src | read_value; break;
+		case 0x10: write_value = min(src, read_value); break;
+		case 0x14: write_value = max(src, read_value); break;
+		case 0x18: write_value = min((unsigned int)src, (unsigned int)read_value); break;
+		case 0x1C: write_value = max((unsigned int)src, (unsigned int)read_value); break;
+		default: litex_stop(); return; break;
+	}
+	if(vexriscv_write_word(addr, write_value)){
+		vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
+		return;
+	}
+	vexriscv_write_register(rd, read_value);
+	csr_write(mepc, mepc + 4);
+	csr_write(mtvec, vexriscv_machine_mode_trap_entry); /* Restore MTVEC */
+}
+#endif
+
+/* Time base */
+
+/* Linux reads the 64-bit time with rdtimeh/rdtime/rdtimeh (retried until both rdtimeh match), each
+   read trapping here. The 64-bit time is latched on a read and the read of the other half that
+   follows it (next instructions, within TIME_SNAPSHOT_WINDOW bytes) returns the other half of this
+   coherent snapshot, saving a timer latch and CSR read. The snapshot is served once: any other
+   read (same half, as in a polling loop, or the final rdtimeh of the sequence) latches the time
+   again. Only done for supervisor mode reads: the kernel is not preemptible, so the instructions
+   following the read always run in the same context (an interrupt handler reading the time
+   replaces the snapshot and the sequence is then retried). */
+#define TIME_SNAPSHOT_WINDOW 8
+
+static uint32_t time_snapshot_pc = 0; /* pc of the read that latched the snapshot, 0 when served */
+static uint32_t time_snapshot_half;   /* half returned by that read (1: msb) */
+static uint32_t time_snapshot_lsb;
+static uint32_t time_snapshot_msb;
+
+#ifdef SIM_SNAPSHOT
+/* Time of Linux minus CPU timer, non-zero after a simulation snapshot restore: the CPU timer restarts
+   from 0 with the simulation and is not writable. */
+static uint64_t time_offset = 0;
+static uint64_t time_cmp    = 0;
+#endif
+
+static uint32_t vexriscv_read_time(uint32_t pc, uint32_t mstatus, int msb){
+	if((pc - time_snapshot_pc - 1) < TIME_SNAPSHOT_WINDOW && msb != time_snapshot_half &&
+	   (mstatus & MSTATUS_MPP) != 0) {
+		time_snapshot_pc = 0;
+	} else {
+		uint64_t time = litex_read_cpu_timer();
+#ifdef SIM_SNAPSHOT
+		time += time_offset;
+#endif
+		time_snapshot_lsb  = time;
+		time_snapshot_msb  = time >> 32;
+		time_snapshot_half = msb;
+		time_snapshot_pc   = ((mstatus & MSTATUS_MPP) == 0) ? 0 : pc;
+	}
+	return msb ? time_snapshot_msb : time_snapshot_lsb;
+}
+
+/* Console */
+
+/* SBI console output is queued in a TX ring instead of waiting for the UART on each character. The
+   ring is drained without waiting (while the UART TX FIFO has room) when characters are queued, at
+   the end of each trap and from the machine timer interrupt, armed CONSOLE_DRAIN_PERIOD ahead while
+   characters are pending. The CPU only waits for the UART when the ring is full. SBI_CONSOLE_WRITE
+   queues a whole buffer in a single trap (instead of one SBI_CONSOLE_PUTCHAR trap per character). */
+#define CONSOLE_TX_RING_SIZE 512 /* Power of 2 */
+
+#ifdef CONFIG_CLOCK_FREQUENCY
+#define CONSOLE_DRAIN_PERIOD max(CONFIG_CLOCK_FREQUENCY/10000, 1000) /* 100us: 10 characters at 1Mbauds */
+#else
+#define CONSOLE_DRAIN_PERIOD 10000
+#endif
+
+static char console_tx_ring[CONSOLE_TX_RING_SIZE];
+static uint32_t console_tx_head = 0;
+static uint32_t console_tx_tail = 0;
+
+static void console_tx_drain(void){
+	while(console_tx_tail != console_tx_head && (uart_txfull_read() & 0x1) == 0) {
+		uart_rxtx_write(console_tx_ring[console_tx_tail]);
+		console_tx_tail = (console_tx_tail + 1) & (CONSOLE_TX_RING_SIZE - 1);
+	}
+}
+
+static void console_tx_flush(void){
+	while(console_tx_tail != console_tx_head)
+		console_tx_drain();
+}
+
+static void console_tx_queue(char c){
+	uint32_t head = (console_tx_head + 1) & (CONSOLE_TX_RING_SIZE - 1);
+	if (c == '\r')
+		return;
+	while(head == console_tx_tail)
+		console_tx_drain();
+	console_tx_ring[console_tx_head] = c;
+	console_tx_head = head;
+}
+
+/* Queue length characters of a supervisor buffer (read with the supervisor translation), stopping
+   on a faulting access. Returns the number of characters queued. */
+static uint32_t console_tx_queue_buffer(uint32_t address, uint32_t length, uint32_t mepc, uint32_t mstatus){
+	uint32_t i;
+	int32_t word = 0;
+	for(i=0; i<length; i++) {
+		if(i == 0 || ((address + i) & 0x3) == 0)
+			if(vexriscv_read_sbi_word((address + i) & ~0x3, &word, mepc, mstatus))
+				break;
+		console_tx_queue(word >> (((address + i) & 0x3)*8));
+	}
+	return i;
+}
+
+/* Machine timer */
+
+/* The CPU timer compare is shared by the Linux timer (SBI_SET_TIMER, forwarded to Linux as a
+   supervisor timer interrupt) and the console drain: it is set to the earliest of both. */
+static uint64_t linux_timer_cmp;              /* Linux timer compare, CPU timer time */
+static uint32_t linux_timer_pending = 0;      /* Linux timer set, supervisor interrupt not raised */
+static uint32_t console_timer_pending = 0;    /* CPU timer compare set for the console drain */
+
+static void machine_timer_update(void){
+	uint64_t cmp = linux_timer_pending ? linux_timer_cmp : ~0ULL;
+	console_timer_pending = 0;
+	if(console_tx_tail != console_tx_head) {
+		uint64_t drain = litex_read_cpu_timer() + CONSOLE_DRAIN_PERIOD;
+		if(drain < cmp) {
+			cmp = drain;
+			console_timer_pending = 1;
+		}
+	}
+	if(cmp == ~0ULL) {
+		csr_clear(mie, MIE_MTIE);
+		return;
+	}
+	litex_write_cpu_timer_cmp(cmp, cmp >> 32);
+	csr_set(mie, MIE_MTIE);
+}
+
+static void machine_timer_interrupt(void){
+	console_tx_drain();
+	if(linux_timer_pending && (!console_timer_pending || litex_read_cpu_timer() >= linux_timer_cmp)) {
+		linux_timer_pending = 0;
+		csr_set(sip, MIP_STIP);
+	}
+	machine_timer_update();
+}
+
+/* IPIs and remote fences */
+
+/* SBI calls of an SMP kernel (CONFIG_SMP), even on a single hart (flush_tlb_all, flush_icache_all).
+   a0 points to the mask of the target harts (all harts when NULL). The SoC has a single hart (hart
+   0): IPIs to it raise its supervisor software interrupt, fences are done locally. */
+static uint32_t vexriscv_sbi_hart_selected(uint32_t hart_mask, uint32_t mepc, uint32_t mstatus){
+	int32_t mask;
+	if(hart_mask == 0)
+		return 1;
+	if(vexriscv_read_sbi_word(hart_mask, &mask, mepc, mstatus))
+		return 0;
+	return mask & 0x1;
+}
+
+/* Trap statistics */
+
+#ifdef TRAP_STATS
+/* Per-cause trap counters and handler cycles, at a fixed address (last 256 bytes of emulator_ram,
+   see linker.ld) to be read from Linux (/dev/mem, see emulator_stats in rootfs overlay). */
+enum {
+	TRAP_STATS_TIMER_INTERRUPT,
+	TRAP_STATS_UNALIGNED_LOAD,
+	TRAP_STATS_UNALIGNED_STORE,
+	TRAP_STATS_ATOMIC,
+	TRAP_STATS_CSR_TIME,
+	TRAP_STATS_SBI_SET_TIMER,
+	TRAP_STATS_SBI_CONSOLE_PUTCHAR,
+	TRAP_STATS_SBI_CONSOLE_GETCHAR,
+	TRAP_STATS_SBI_CONSOLE_WRITE,
+	TRAP_STATS_OTHER,
+	TRAP_STATS_N
+};
+
+#define TRAP_STATS_MAGIC   0x53505254 /* "TRPS" */
+#define TRAP_STATS_VERSION 2
+
+struct trap_stats_entry {
+	uint32_t count;
+	uint32_t cycles_lsb;
+	uint32_t cycles_msb;
+	uint32_t max_cycles;
+};
+
+struct trap_stats_table {
+	uint32_t magic;
+	uint32_t version;
+	uint32_t clock_frequency;
+	uint32_t n;
+	struct trap_stats_entry entries[TRAP_STATS_N];
+};
+
+#define trap_stats ((volatile struct trap_stats_table *) _trap_stats)
+
+static void trap_stats_init(void){
+	memset((void *) trap_stats, 0, sizeof(struct trap_stats_table));
+#ifdef CONFIG_CLOCK_FREQUENCY
+	trap_stats->clock_frequency = CONFIG_CLOCK_FREQUENCY;
+#endif
+	trap_stats->n       = TRAP_STATS_N;
+	trap_stats->version = TRAP_STATS_VERSION;
+	trap_stats->magic   = TRAP_STATS_MAGIC;
+}
+
+static uint32_t trap_stats_cause(void){
+	int32_t cause = csr_read(mcause);
+	if(cause < 0)
+		return TRAP_STATS_TIMER_INTERRUPT;
+	switch(cause){
+		case CAUSE_UNALIGNED_LOAD:  return TRAP_STATS_UNALIGNED_LOAD;
+		case CAUSE_UNALIGNED_STORE: return TRAP_STATS_UNALIGNED_STORE;
+		case CAUSE_ILLEGAL_INSTRUCTION:
+			switch(csr_read(mbadaddr) & 0x7f){
+				case 0x2f: return TRAP_STATS_ATOMIC;
+				case 0x73: return TRAP_STATS_CSR_TIME;
+			}
+			break;
+		case CAUSE_SCALL:
+			switch(vexriscv_read_register(17)){
+				case SBI_SET_TIMER:       return TRAP_STATS_SBI_SET_TIMER;
+				case SBI_CONSOLE_PUTCHAR: return TRAP_STATS_SBI_CONSOLE_PUTCHAR;
+				case SBI_CONSOLE_GETCHAR: return TRAP_STATS_SBI_CONSOLE_GETCHAR;
+				case SBI_CONSOLE_WRITE:   return TRAP_STATS_SBI_CONSOLE_WRITE;
+			}
+			break;
+	}
+	return TRAP_STATS_OTHER;
+}
+
+static void trap_stats_record(uint32_t cause, uint32_t cycles){
+	volatile struct trap_stats_entry *entry = &trap_stats->entries[cause];
+	uint32_t cycles_lsb = entry->cycles_lsb + cycles;
+	entry->count++;
+	entry->cycles_msb += cycles_lsb < cycles;
+	entry->cycles_lsb  = cycles_lsb;
+	if(cycles > entry->max_cycles)
+		entry->max_cycles = cycles;
+}
+#endif
+
+/* Simulation snapshot */
+
+#ifdef SIM_SNAPSHOT
+/* Linux state saved at a fixed address (256 bytes before the trap statistics, see linker.ld) on
+   request from Linux (/dev/mem, see sim_snapshot in rootfs overlay): on the next trap, the supervisor
+   registers and CSRs are saved here and the simulation dumps main_ram and emulator_ram (including
+   this state) to snapshot files. A simulation started from these files (sim.py --restore) resumes
+   Linux from this state instead of booting it. */
+#define SIM_SNAPSHOT_MAGIC   0x504e5353 /* "SSNP" */
+#define SIM_SNAPSHOT_REQUEST 0x51455253 /* "SREQ" */
+
+#define VEXRISCV_SUPERVISOR_IRQ_MASK 0xdc0
+
+struct sim_snapshot_state {
+	uint32_t magic;
+	uint32_t request;
+	uint32_t regs[32];
+	uint32_t mepc;
+	uint32_t mstatus;
+	uint32_t mie;
+	uint32_t mip;
+	uint32_t stvec;
+	uint32_t sscratch;
+	uint32_t sepc;
+	uint32_t scause;
+	uint32_t sbadaddr;
+	uint32_t satp;
+	uint32_t irq_mask;
+	uint32_t time_lsb;
+	uint32_t time_msb;
+	uint32_t time_cmp_lsb;
+	uint32_t time_cmp_msb;
+};
+
+#define sim_snapshot ((volatile struct sim_snapshot_state *) _sim_snapshot)
+
+static void sim_snapshot_save(void){
+	uint32_t *frame = (uint32_t *) ((uint32_t) (&_sp) - 32*4);
+	uint64_t time;
+	int i;
+	console_tx_flush();
+	time = litex_read_cpu_timer() + time_offset;
+	sim_snapshot->request = 0;
+	sim_snapshot->regs[0] = 0;
+	for(i=1; i<32; i++)
+		sim_snapshot->regs[i] = frame[i];
+	sim_snapshot->regs[2]      = csr_read(mscratch); /* sp of the trapped code, swapped on trap entry */
+	sim_snapshot->mepc         = csr_read(mepc);
+	sim_snapshot->mstatus      = csr_read(mstatus);
+	sim_snapshot->mie          = (csr_read(mie) & ~MIE_MTIE) | (linux_timer_pending ? MIE_MTIE : 0);
+	sim_snapshot->mip          = csr_read(mip) & MIP_STIP;
+	sim_snapshot->stvec        = csr_read(stvec);
+	sim_snapshot->sscratch     = csr_read(sscratch);
+	sim_snapshot->sepc         = csr_read(sepc);
+	sim_snapshot->scause       = csr_read(scause);
+	sim_snapshot->sbadaddr     = csr_read(sbadaddr);
+	sim_snapshot->satp         = csr_read(satp);
+	sim_snapshot->irq_mask     = csr_read(VEXRISCV_SUPERVISOR_IRQ_MASK);
+	sim_snapshot->time_lsb     = time;
+	sim_snapshot->time_msb     = time >> 32;
+	sim_snapshot->time_cmp_lsb = time_cmp;
+	sim_snapshot->time_cmp_msb = time_cmp >> 32;
+	sim_snapshot->magic        = SIM_SNAPSHOT_MAGIC;
+	/* Dump the memories (the CPU is in this trap, memories are not modified until the dump is done) */
+	supervisor_snapshot_write(1);
+}
+
+static void sim_snapshot_restore(void){
+	uint32_t *frame = (uint32_t *) ((uint32_t) (&_sp) - 32*4);
+	uint64_t time = ((uint64_t) sim_snapshot->time_msb << 32) | sim_snapshot->time_lsb;
+	uint64_t cmp;
+	int i;
+
+	printf("Restoring simulation snapshot (pc 0x%08x)\n", sim_snapshot->mepc);
+	uart_sync();
+
+	/* Time base: offset the CPU timer to the snapshot time, reload the memory-mapped time counter */
+	time_offset = time - litex_read_cpu_timer();
+	time_cmp    = ((uint64_t) sim_snapshot->time_cmp_msb << 32) | sim_snapshot->time_cmp_lsb;
+	cmp = (time_cmp > time_offset) ? time_cmp - time_offset : 0;
+	litex_write_cpu_timer_cmp(cmp, cmp >> 32);
+	linux_timer_cmp     = cmp;
+	linux_timer_pending = (sim_snapshot->mie & MIE_MTIE) != 0;
+#ifdef MTIME_BASE
+	time = litex_read_cpu_timer() + time_offset;
+	*((volatile uint32_t *) (MTIME_BASE + 4)) = time >> 32;
+	*((volatile uint32_t *) (MTIME_BASE + 0)) = time;
+#endif
+
+	/* Supervisor CSRs */
+	csr_write(stvec,    sim_snapshot->stvec);
+	csr_write(sscratch, sim_snapshot->sscratch);
+	csr_write(sepc,     sim_snapshot->sepc);
+	csr_write(scause,   sim_snapshot->scause);
+	csr_write(sbadaddr, sim_snapshot->sbadaddr);
+	csr_write(satp,     sim_snapshot->satp);
+	csr_write(VEXRISCV_SUPERVISOR_IRQ_MASK, sim_snapshot->irq_mask);
+	if(sim_snapshot->mip & MIP_STIP)
+		csr_set(sip, MIP_STIP);
+	csr_write(mie,      sim_snapshot->mie);
+	csr_write(mstatus,  sim_snapshot->mstatus);
+	csr_write(mepc,     sim_snapshot->mepc);
+
+	/* Registers: resume through the trap exit, as when returning from the snapshot trap */
+	for(i=1; i<32; i++)
+		frame[i] = sim_snapshot->regs[i];
+	csr_write(mscratch, sim_snapshot->regs[2]);
+	__asm__ __volatile__ (
+		" mv sp, %0\n"
+		" j vexriscv_machine_mode_trap_exit\n"
+		 : : "r" (frame)
+	);
+}
+#endif
+
+static void vexriscv_machine_mode_trap_handler(void) {
 	int32_t cause = csr_read(mcause);
 
 	/* Interrupt */
 	if(cause < 0){
 		switch(cause & 0xff){
 			case CAUSE_MACHINE_TIMER: {
-				csr_set(sip, MIP_STIP);
-				csr_clear(mie, MIE_MTIE);
+				machine_timer_interrupt();
+				lr_reservation_valid = 0;
 			} break;
 			default: litex_stop(); break;
 		}
 	/* Exception */
 	} else {
 		switch(cause){
-		    case CAUSE_UNALIGNED_LOAD:{
-			    uint32_t mepc = csr_read(mepc);
-			    uint32_t mstatus = csr_read(mstatus);
-			    uint32_t instruction = vexriscv_read_instruction(mepc);
-			    uint32_t address = csr_read(mbadaddr);
-			    uint32_t func3 =(instruction >> 12) & 0x7;
-			    uint32_t rd = (instruction >> 7) & 0x1F;
-			    int32_t readValue;
-			    int32_t fail = 1;
-
-			    switch(func3){
-			    case 1: fail = vexriscv_read_half_unaligned(address, &readValue); break;  //LH
-			    case 2: fail = vexriscv_read_word_unaligned(address, &readValue); break; //LW
-			    case 5: fail = vexriscv_read_half_unaligned(address, &readValue) & 0xFFFF; break; //LHU
-			    }
-
-			    if(fail){
-				    vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
-				    return;
-			    }
-
-			    vexriscv_write_register(rd, readValue);
-			    csr_write(mepc, mepc + 4);
-			    csr_write(mtvec, vexriscv_machine_mode_trap_entry); //Restore mtvec
-		    }break;
-		    case CAUSE_UNALIGNED_STORE:{
-			    uint32_t mepc = csr_read(mepc);
-			    uint32_t mstatus = csr_read(mstatus);
-			    uint32_t instruction = vexriscv_read_instruction(mepc);
-			    uint32_t address = csr_read(mbadaddr);
-			    uint32_t func3 =(instruction >> 12) & 0x7;
-			    int32_t writeValue = vexriscv_read_register((instruction >> 20) & 0x1F);
-			    int32_t fail = 1;
-
-			    switch(func3){
-			    case 1: fail = vexriscv_write_short_unaligned(address, writeValue); break; //SH
-			    case 2: fail = vexriscv_write_word_unaligned(address, writeValue); break; //SW
-			    }
-
-			    if(fail){
-				    vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
-				    return;
-			    }
-
-			    csr_write(mepc, mepc + 4);
-			    csr_write(mtvec, vexriscv_machine_mode_trap_entry); //Restore mtvec
-		    }break;
+			/* Unaligned load/store */
+			case CAUSE_UNALIGNED_LOAD:
+			case CAUSE_UNALIGNED_STORE:
+#ifdef UNALIGNED_BENCH
+				if(unaligned_legacy) {
+					vexriscv_emulate_unaligned_legacy(cause);
+					break;
+				}
+#endif
+				vexriscv_emulate_unaligned(cause);
+				break;
 			/* Illegal instruction */
 			case CAUSE_ILLEGAL_INSTRUCTION:{
 				uint32_t mepc = csr_read(mepc);
@@ -426,41 +1059,15 @@ void vexriscv_machine_mode_trap(void) {
 					/* Atomic */
 					case 0x2f:
 						switch(funct3){
-							case 0x2:{
-								uint32_t sel = instr >> 27;
-								uint32_t addr = vexriscv_read_register((instr >> 15) & 0x1f);
-								int32_t src = vexriscv_read_register((instr >> 20) & 0x1f);
-								uint32_t rd = (instr >> 7) & 0x1f;
-								int32_t read_value;
-								int32_t write_value = 0
-								;
-								if(vexriscv_read_word(addr, &read_value)) {
-									vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
-									return;
-								}
-
-								switch(sel){
-									case 0x0:  write_value = src + read_value; break;
-									case 0x1:  write_value = src; break;
-									case 0x2:  break; /*  LR, SC done in hardware (cheap) and require */
-									case 0x3:  break; /*  to keep track of context switches */
-									case 0x4:  write_value = src ^ read_value; break;
-									case 0xC:  write_value = src & read_value; break;
-									case 0x8:  write_value = src | read_value; break;
-									case 0x10: write_value = min(src, read_value); break;
-									case 0x14: write_value = max(src, read_value); break;
-									case 0x18: write_value = min((unsigned int)src, (unsigned int)read_value); break;
-									case 0x1C: write_value = max((unsigned int)src, (unsigned int)read_value); break;
-									default: litex_stop(); return; break;
-								}
-								if(vexriscv_write_word(addr, write_value)){
-									vexriscv_machine_mode_trap_to_supervisor_trap(mepc, mstatus);
-									return;
+							case 0x2:
+#ifdef ATOMIC_BENCH
+								if(atomic_legacy) {
+									vexriscv_emulate_atomic_legacy(instr, mepc, mstatus);
+									break;
 								}
-								vexriscv_write_register(rd, read_value);
-								csr_write(mepc, mepc + 4);
-								csr_write(mtvec, vexriscv_machine_mode_trap_entry); /* Restore MTVEC */
-							} break;
+#endif
+								vexriscv_emulate_atomic(instr, mepc, mstatus);
+								break;
 							default: litex_stop(); break;
 						} break;
 					/* CSR */
@@ -479,10 +1086,10 @@ void vexriscv_machine_mode_trap(void) {
 						switch(csrAddress){
 							case RDCYCLE :
 							case RDINSTRET:
-							case RDTIME  : old = litex_read_cpu_timer_lsb(); break;
+							case RDTIME  : old = vexriscv_read_time(mepc, mstatus, 0); break;
 							case RDCYCLEH :
 							case RDINSTRETH:
-							case RDTIMEH : old = litex_read_cpu_timer_msb(); break;
+							case RDTIMEH : old = vexriscv_read_time(mepc, mstatus, 1); break;
 							default: litex_stop(); break;
 						}
 						if(write) {
@@ -506,17 +1113,52 @@ void vexriscv_machine_mode_trap(void) {
 				__attribute__((unused)) uint32_t a2 = vexriscv_read_register(12);
 				switch(which){
 					case SBI_CONSOLE_PUTCHAR: {
-						litex_putchar(a0);
+						console_tx_queue(a0);
 						csr_write(mepc, csr_read(mepc) + 4);
 					} break;
+					case SBI_CONSOLE_WRITE: {
+						uint32_t mepc = csr_read(mepc);
+						vexriscv_write_register(10, console_tx_queue_buffer(a0, a1, mepc, csr_read(mstatus)));
+						csr_write(mepc, mepc + 4);
+					} break;
 					case SBI_CONSOLE_GETCHAR: {
+						console_tx_flush();
 						vexriscv_write_register(10, litex_getchar());
 						csr_write(mepc, csr_read(mepc) + 4);
 					} break;
+					case SBI_CLEAR_IPI: {
+						csr_clear(sip, MIP_SSIP);
+						csr_write(mepc, csr_read(mepc) + 4);
+					} break;
+					case SBI_SEND_IPI: {
+						uint32_t mepc = csr_read(mepc);
+						if(vexriscv_sbi_hart_selected(a0, mepc, csr_read(mstatus)))
+							csr_set(sip, MIP_SSIP);
+						csr_write(mepc, mepc + 4);
+					} break;
+					case SBI_REMOTE_FENCE_I: {
+						uint32_t mepc = csr_read(mepc);
+						if(vexriscv_sbi_hart_selected(a0, mepc, csr_read(mstatus)))
+							__asm__ __volatile__ ("fence.i" : : : "memory");
+						csr_write(mepc, mepc + 4);
+					} break;
+					case SBI_REMOTE_SFENCE_VMA:
+					case SBI_REMOTE_SFENCE_VMA_ASID: {
+						uint32_t mepc = csr_read(mepc);
+						if(vexriscv_sbi_hart_selected(a0, mepc, csr_read(mstatus)))
+							__asm__ __volatile__ ("sfence.vma" : : : "memory");
+						csr_write(mepc, mepc + 4);
+					} break;
 					case SBI_SET_TIMER: {
-						litex_write_cpu_timer_cmp(a0, a1);
-						csr_set(mie, MIE_MTIE);
+						uint64_t cmp = ((uint64_t) a1 << 32) | a0;
+#ifdef SIM_SNAPSHOT
+						time_cmp = cmp;
+						cmp = (time_cmp > time_offset) ? time_cmp - time_offset : 0;
+#endif
+						linux_timer_cmp     = cmp;
+						linux_timer_pending = 1;
 						csr_clear(sip, MIP_STIP);
+						machine_timer_update();
 						csr_write(mepc, csr_read(mepc) + 4);
 					} break;
 					default: litex_stop(); break;
@@ -525,6 +1167,29 @@ void vexriscv_machine_mode_trap(void) {
 			default: litex_stop(); break;
 		}
 	}
+
+	/* Console output: drained at the end of each trap, then from the machine timer interrupt */
+	if(console_tx_tail != console_tx_head) {
+		console_tx_drain();
+		if(console_tx_tail != console_tx_head && !console_timer_pending)
+			machine_timer_update();
+	}
+}
+
+void vexriscv_machine_mode_trap(void) {
+#ifdef TRAP_STATS
+	/* Cycles of the C handler (CPU timer, 32-bit delta), save/restore of registers excluded. */
+	uint32_t cause = trap_stats_cause();
+	uint32_t start = litex_read_cpu_timer_lsb();
+	vexriscv_machine_mode_trap_handler();
+	trap_stats_record(cause, litex_read_cpu_timer_lsb() - start);
+#else
+	vexriscv_machine_mode_trap_handler();
+#endif
+#ifdef SIM_SNAPSHOT
+	if(sim_snapshot->request == SIM_SNAPSHOT_REQUEST)
+		sim_snapshot_save();
+#endif
 }
 
 static void vexriscv_machine_mode_boot(void) {
@@ -536,6 +1201,140 @@ static void vexriscv_machine_mode_boot(void) {
 	);
 }
 
+/* Benchmarks */
+
+/* Run in supervisor mode (as Linux) before booting Linux and report the cycles per emulated
+   instruction (trap entry/exit included) with the legacy and current emulation, or per CSR access. */
+
+#ifdef UNALIGNED_BENCH
+#define UNALIGNED_BENCH_ITERATIONS 256
+
+static uint8_t unaligned_bench_buffer[16] __attribute__((aligned(4)));
+
+static uint32_t unaligned_bench_run(uint32_t *errors){
+	volatile uint8_t *buf = unaligned_bench_buffer;
+	uint32_t start, i;
+	start = litex_read_cpu_timer_lsb();
+	for(i=0; i<UNALIGNED_BENCH_ITERATIONS; i++) {
+		uint32_t offset = 1 + (i % 3);
+		uint32_t w = 0x80018001 + i;
+		*(volatile uint32_t *)(buf + offset) = w;                              /* SW  */
+		if(*(volatile uint32_t *)(buf + offset) != w) (*errors)++;             /* LW  */
+		*(volatile uint16_t *)(buf + (offset | 1)) = w;                        /* SH  */
+		if(*(volatile int16_t *)(buf + (offset | 1)) != (int16_t) w) (*errors)++;  /* LH  */
+		if(*(volatile uint16_t *)(buf + (offset | 1)) != (uint16_t) w) (*errors)++; /* LHU */
+	}
+	return (litex_read_cpu_timer_lsb() - start)/(5*UNALIGNED_BENCH_ITERATIONS);
+}
+
+static void unaligned_bench(void){
+	uint32_t legacy_errors = 0, fast_errors = 0;
+	uint32_t legacy_cycles, fast_cycles;
+	unaligned_legacy = 1;
+	legacy_cycles = unaligned_bench_run(&legacy_errors);
+	unaligned_legacy = 0;
+	fast_cycles   = unaligned_bench_run(&fast_errors);
+	printf("Unaligned access emulation: legacy %d cycles/access (%d errors), fast %d cycles/access (%d errors)\n",
+		legacy_cycles, legacy_errors, fast_cycles, fast_errors);
+}
+#endif
+
+#ifdef ATOMIC_BENCH
+#define ATOMIC_BENCH_ITERATIONS 256
+
+static volatile uint32_t atomic_bench_word;
+
+static uint32_t atomic_bench_run(uint32_t *errors){
+	uint32_t start, i, old, tmp;
+	atomic_bench_word = 0;
+	start = litex_read_cpu_timer_lsb();
+	for(i=0; i<ATOMIC_BENCH_ITERATIONS; i++) {
+		/* atomic_add_return */
+		__asm__ __volatile__ ("amoadd.w %0, %2, (%1)" : "=r" (old) : "r" (&atomic_bench_word), "r" (1) : "memory");
+		if(old != 2*i) (*errors)++;
+		/* spinlock like lr/sc increment */
+		__asm__ __volatile__ (
+			"1:	lr.w     %0, (%2)\n"
+			"	addi     %1, %0, 1\n"
+			"	sc.w     %1, %1, (%2)\n"
+			"	bnez     %1, 1b\n"
+			: "=&r" (old), "=&r" (tmp) : "r" (&atomic_bench_word) : "memory");
+		if(old != 2*i + 1) (*errors)++;
+	}
+	return (litex_read_cpu_timer_lsb() - start)/(2*ATOMIC_BENCH_ITERATIONS);
+}
+
+static void atomic_bench(void){
+	uint32_t legacy_errors = 0, fast_errors = 0;
+	uint32_t legacy_cycles, fast_cycles;
+	atomic_legacy = 1;
+	legacy_cycles = atomic_bench_run(&legacy_errors);
+	atomic_legacy = 0;
+	fast_cycles   = atomic_bench_run(&fast_errors);
+	printf("Atomics (amoadd.w, lr.w/sc.w): legacy %d cycles/atomic (%d errors), fast %d cycles/atomic (%d errors)\n",
+		legacy_cycles, legacy_errors, fast_cycles, fast_errors);
+}
+#endif
+
+#ifdef CSR_BENCH
+/* CSR accesses of the SBI console/timer paths: a 32-bit CSR is 4 bus accesses with 8-bit CSRs, 1 with
+   32-bit CSRs (--csr-data-width). */
+#define CSR_BENCH_ITERATIONS 256
+
+#ifndef CONFIG_CSR_DATA_WIDTH
+#define CONFIG_CSR_DATA_WIDTH 8
+#endif
+
+static void csr_bench(void){
+	uint32_t uart_cycles, time_cycles, time_cmp_cycles;
+	uint32_t start, i;
+	volatile uint32_t sink = 0;
+	start = litex_read_cpu_timer_lsb();
+	for(i=0; i<CSR_BENCH_ITERATIONS; i++)
+		sink += uart_txfull_read() + uart_rxempty_read();       /* putchar/getchar status */
+	uart_cycles = (litex_read_cpu_timer_lsb() - start)/(2*CSR_BENCH_ITERATIONS);
+	start = litex_read_cpu_timer_lsb();
+	for(i=0; i<CSR_BENCH_ITERATIONS; i++)
+		sink += litex_read_cpu_timer();                         /* RDTIME */
+	time_cycles = (litex_read_cpu_timer_lsb() - start)/CSR_BENCH_ITERATIONS;
+	start = litex_read_cpu_timer_lsb();
+	for(i=0; i<CSR_BENCH_ITERATIONS; i++)
+		litex_write_cpu_timer_cmp(0xffffffff, 0xffffffff);     /* SBI_SET_TIMER (no interrupt) */
+	time_cmp_cycles = (litex_read_cpu_timer_lsb() - start)/CSR_BENCH_ITERATIONS;
+	printf("CSR accesses (%d-bit CSRs): uart status %d cycles/read, timer %d cycles/read, timer compare %d cycles/write\n",
+		CONFIG_CSR_DATA_WIDTH, uart_cycles, time_cycles, time_cmp_cycles);
+}
+#endif
+
+#if defined(UNALIGNED_BENCH) || defined(ATOMIC_BENCH) || defined(CSR_BENCH)
+#define EMULATOR_BENCH
+
+static uint32_t bench_stack[256] __attribute__((aligned(16)));
+
+static void emulator_bench(void){
+#ifdef UNALIGNED_BENCH
+	unaligned_bench();
+#endif
+#ifdef ATOMIC_BENCH
+	atomic_bench();
+#endif
+#ifdef CSR_BENCH
+	csr_bench();
+#endif
+	/* Boot Linux, already in supervisor mode */
+	((void (*)(uint32_t, uint32_t)) LINUX_IMAGE_BASE)(0, LINUX_DTB_BASE);
+}
+
+static void vexriscv_machine_mode_bench(void) {
+	csr_write(mepc, emulator_bench);
+	__asm__ __volatile__ (
+		" mv sp, %0\n"
+		" mret"
+		 : : "r" (&bench_stack[256])
+	);
+}
+#endif
+
 /* Main */
 
 int main(void)
@@ -546,9 +1345,22 @@ int main(void)
 	puts("VexRiscv Machine Mode software built "__DATE__" "__TIME__"");
 #ifdef CSR_FRAMEBUFFER_BASE
 	framebuffer_init();
+#endif
+#ifdef TRAP_STATS
+	trap_stats_init();
+	printf("Trap statistics at 0x%08x\n", (uint32_t) _trap_stats);
+#endif
+#ifdef SIM_SNAPSHOT
+	if(sim_snapshot->magic == SIM_SNAPSHOT_MAGIC) {
+		vexriscv_machine_mode_init();
+		sim_snapshot_restore();
+	}
 #endif
 	printf("--========== \e[1mBooting Linux\e[0m =============--\n");
 	uart_sync();
 	vexriscv_machine_mode_init();
+#ifdef EMULATOR_BENCH
+	vexriscv_machine_mode_bench();
+#endif
 	vexriscv_machine_mode_boot();
 }
@@ -17,6 +17,7 @@
 
 #define MIE_MTIE (1 << 7)
 #define MIP_STIP (1 << 5)
+#define MIP_SSIP (1 << 1)
 
 #define MSTATUS_UIE  0x00000001
 #define MSTATUS_SIE  0x00000002
@@ -84,6 +85,9 @@
 #define SBI_REMOTE_SFENCE_VMA_ASID 7
 #define SBI_SHUTDOWN               8
 
+/* LiteX extension (SBI vendor extension space): a0 buffer, a1 length, returns the characters written */
+#define SBI_CONSOLE_WRITE          0x09000000
+
 #define csr_swap(csr, val)					\
 ({								\
 	unsigned long __v = (unsigned long)(val);		\
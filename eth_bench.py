@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import socket
+import struct
+import argparse
+
+# Ethernet benchmark (net_bench server running on the target) --------------------------------------
+
+class EthBench:
+    """Measures UDP round-trip latency, packet rate and TCP throughput (both directions) against net_bench."""
+    def __init__(self, ip, port=5001, timeout=5):
+        self.ip      = ip
+        self.port    = port
+        self.timeout = timeout
+
+    def latency(self, count, size=64):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(self.timeout)
+        payload = bytes(size)
+        rtts = []
+        lost = 0
+        for i in range(count):
+            start = time.perf_counter()
+            s.sendto(payload, (self.ip, self.port))
+            try:
+                s.recvfrom(size)
+                rtts.append(time.perf_counter() - start)
+            except socket.timeout:
+                lost += 1
+        s.close()
+        return rtts, lost
+
+    def packet_rate(self, count, size=64, window=16):
+        """UDP echo packets per second, with up to window packets in flight."""
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(self.timeout)
+        payload = bytes(size)
+        sent = received = lost = 0
+        start = time.perf_counter()
+        while sent < count or sent - received - lost > 0:
+            while sent < count and sent - received - lost < window:
+                s.sendto(payload, (self.ip, self.port))
+                sent += 1
+            try:
+                s.recvfrom(size)
+                received += 1
+            except socket.timeout:
+                # Packets in flight lost.
+                lost = sent - received
+        duration = time.perf_counter() - start
+        s.close()
+        return received/duration, lost
+
+    def throughput(self, mode, length):
+        s = socket.create_connection((self.ip, self.port), timeout=self.timeout)
+        s.sendall(mode.encode() + struct.pack(">Q", length))
+        start = time.perf_counter()
+        if mode == "r":
+            data = bytes(16384)
+            remaining = length
+            while remaining > 0:
+                n = min(remaining, len(data))
+                s.sendall(data[:n])
+                remaining -= n
+            s.recv(1)
+        else:
+            remaining = length
+            while remaining > 0:
+                n = len(s.recv(min(remaining, 65536)))
+                if n == 0:
+                    raise IOError("Connection closed")
+                remaining -= n
+        duration = time.perf_counter() - start
+        s.close()
+        return 8*length/duration
+
+def main():
+    parser = argparse.ArgumentParser(description="Linux on LiteX-VexRiscv Ethernet benchmark (run net_bench on the target)")
+    parser.add_argument("ip", help="target IP address")
+    parser.add_argument("--port", type=int, default=5001, help="net_bench port")
+    parser.add_argument("--count", type=int, default=100, help="number of UDP echo packets for latency")
+    parser.add_argument("--rate-count", type=int, default=1000, help="number of UDP echo packets for packet rate")
+    parser.add_argument("--rate-window", type=int, default=16, help="UDP echo packets in flight for packet rate")
+    parser.add_argument("--size", type=int, default=1*1024*1024, help="TCP transfer size (bytes) for throughput")
+    parser.add_argument("--timeout", type=float, default=5, help="timeout (s)")
+    args = parser.parse_args()
+
+    bench = EthBench(args.ip, args.port, args.timeout)
+    try:
+        rtts, lost = bench.latency(args.count)
+        if rtts:
+            rtts.sort()
+            print("Latency (UDP echo): min {:.3f}ms avg {:.3f}ms p99 {:.3f}ms max {:.3f}ms, {}/{} lost".format(
+                1e3*rtts[0], 1e3*sum(rtts)/len(rtts), 1e3*rtts[int(0.99*(len(rtts) - 1))], 1e3*rtts[-1],
+                lost, args.count))
+        else:
+            print("Latency (UDP echo): all {} packets lost".format(args.count))
+        rate, lost = bench.packet_rate(args.rate_count, window=args.rate_window)
+        print("Packet rate (UDP echo, 64 bytes): {:.0f} packets/s, {}/{} lost".format(rate, lost, args.rate_count))
+        for mode, name in [("r", "host -> target"), ("t", "target -> host")]:
+            print("Throughput (TCP, {}): {:.2f} Mbps".format(name, bench.throughput(mode, args.size)/1e6))
+    except (OSError, IOError) as e:
+        print(e)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
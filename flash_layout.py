@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import json
+import shutil
+
+kB = 1024
+mB = kB*1024
+
+# Flash Images -------------------------------------------------------------------------------------
+
+# Images copied from SPI Flash to RAM by the BIOS, in flash order.
+flash_images = [
+    # name,      filename,                 ram address, ram size,  fixed offset, min size
+    ("image",    "buildroot/Image",        0xc0000000,  8*mB,      0x00400000,   4*mB),
+    ("rootfs",   "buildroot/rootfs.cpio",  0xc0800000,  8*mB,      0x00800000,   4*mB),
+    ("dtb",      "buildroot/rv32.dtb",     0xc1000000,  1*mB,      0x00f00000,   64*kB),
+    ("emulator", "emulator/emulator.bin",  0x20000000,  0x4000,    0x00f80000,   64*kB),
+]
+
+# Root filesystems mounted by Linux directly from SPI Flash (MTD), instead of the initramfs copied to RAM.
+flash_rootfs_types = ["squashfs", "jffs2"]
+
+# Flash Layout -------------------------------------------------------------------------------------
+
+def _align(x, alignment):
+    return (x + alignment - 1)//alignment*alignment
+
+def compress_rootfs(filename):
+    """Compress a cpio rootfs with gzip (natively unpacked by the kernel with CONFIG_RD_GZIP)."""
+    gz_filename = filename + ".gz"
+    if (not os.path.exists(gz_filename) or
+        os.path.getmtime(gz_filename) < os.path.getmtime(filename)):
+        with open(filename, "rb") as f, gzip.open(gz_filename + ".tmp", "wb", compresslevel=9) as gz:
+            shutil.copyfileobj(f, gz)
+        os.replace(gz_filename + ".tmp", gz_filename)
+    return gz_filename
+
+class FlashLayout:
+    """SPI Flash layout of the bitstream and Linux images.
+
+    With pack=False the historical fixed offsets are used, with pack=True the images are packed from
+    their actual sizes. Images are aligned on the flash sector size and the layout is checked against
+    the flash size, the bitstream region and the RAM windows the BIOS copies the images to. Images
+    that do not exist yet (DTB, emulator before the first build) use their minimum size.
+
+    With flash_rootfs (squashfs/jffs2), the rootfs region holds a filesystem mounted by Linux from the
+    SPI Flash (MTD partition of the region): it is not copied to RAM (no RAM address).
+    """
+    def __init__(self, sector_size, flash_size=16*mB, boot_offset=0x00400000,
+        pack=False, compress_rootfs=False, flash_rootfs=None):
+        assert flash_rootfs in [None] + flash_rootfs_types
+        self.sector_size     = sector_size
+        self.flash_size      = flash_size
+        self.boot_offset     = boot_offset
+        self.pack            = pack
+        self.compress_rootfs = compress_rootfs
+        self.flash_rootfs    = flash_rootfs
+        self.regions         = [] # (name, filename, offset, size, ram_address)
+
+    def plan(self):
+        self.regions = []
+        offset = self.boot_offset
+        for n, (name, filename, ram_address, ram_size, fixed_offset, min_size) in enumerate(flash_images):
+            if name == "rootfs" and self.flash_rootfs is not None:
+                filename    = "buildroot/rootfs.{}".format(self.flash_rootfs)
+                ram_address = None
+                ram_size    = self.flash_size
+            elif name == "rootfs" and self.compress_rootfs and os.path.exists(filename):
+                filename = compress_rootfs(filename)
+            size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            if size > ram_size:
+                if ram_address is None:
+                    raise ValueError("{} ({} bytes) does not fit in the {} bytes flash".format(
+                        filename, size, ram_size))
+                raise ValueError("{} ({} bytes) does not fit in its {} bytes RAM window at 0x{:08x}".format(
+                    filename, size, ram_size, ram_address))
+            if self.pack:
+                offset = _align(offset, self.sector_size)
+                region_size = _align(max(size, min_size), self.sector_size)
+            else:
+                offset = fixed_offset
+                if n + 1 < len(flash_images):
+                    region_size = flash_images[n + 1][4] - offset
+                else:
+                    region_size = self.flash_size - offset
+                if size > region_size:
+                    raise ValueError("{} ({} bytes) overlaps next flash region at 0x{:08x}".format(
+                        filename, size, offset + region_size))
+            if offset + region_size > self.flash_size:
+                raise ValueError("{} region 0x{:08x}-0x{:08x} exceeds the {} bytes flash".format(
+                    filename, offset, offset + region_size, self.flash_size))
+            self.regions.append((name, filename, offset, region_size, ram_address))
+            offset += region_size
+
+    def check_bitstream(self, filename):
+        if os.path.getsize(filename) > self.boot_offset:
+            raise ValueError("{} overlaps Linux images at 0x{:08x}".format(filename, self.boot_offset))
+
+    def flash_regions(self, bitstream):
+        self.check_bitstream(bitstream)
+        flash_regions = {bitstream: "0x{:08x}".format(0)}
+        for name, filename, offset, size, ram_address in self.regions:
+            flash_regions[filename] = "0x{:08x}".format(offset)
+        return flash_regions
+
+    def get_constants(self):
+        offsets = {name: offset for name, filename, offset, size, ram_address in self.regions}
+        boot_address = offsets["image"]
+        constants = {
+            "FLASH_BOOT_ADDRESS":             boot_address,
+            "KERNEL_IMAGE_FLASH_OFFSET":      offsets["image"]    - boot_address,
+            "ROOTFS_IMAGE_FLASH_OFFSET":      offsets["rootfs"]   - boot_address,
+            "DEVICE_TREE_IMAGE_FLASH_OFFSET": offsets["dtb"]      - boot_address,
+            "EMULATOR_IMAGE_FLASH_OFFSET":    offsets["emulator"] - boot_address,
+        }
+        if self.get_flash_rootfs() is not None:
+            # Rootfs mounted from flash: nothing for the BIOS to copy.
+            del constants["ROOTFS_IMAGE_FLASH_OFFSET"]
+        return constants
+
+    def get_rootfs(self):
+        for name, filename, offset, size, ram_address in self.regions:
+            if name == "rootfs":
+                return filename
+
+    def get_flash_rootfs(self):
+        """Type, flash offset and size of the rootfs mounted from flash (None for an initramfs)."""
+        for name, filename, offset, size, ram_address in self.regions:
+            if name == "rootfs" and ram_address is None:
+                return {"type": os.path.splitext(filename)[1][1:], "offset": offset, "size": size}
+
+    def write_images_json(self, filename):
+        images = {filename: "0x{:08x}".format(ram_address)
+            for name, filename, offset, size, ram_address in self.regions if ram_address is not None}
+        with open(filename, "w") as f:
+            json.dump(images, f, indent=4)
+
+    def save(self, filename):
+        layout = [{"name": name, "filename": filename, "offset": offset, "size": size, "ram_address": ram_address}
+            for name, filename, offset, size, ram_address in self.regions]
+        with open(filename, "w") as f:
+            json.dump(layout, f, indent=4)
+
+    def load(self, filename):
+        """Load the layout the BIOS has been built with and check the current images still fit."""
+        with open(filename) as f:
+            layout = json.load(f)
+        self.regions = [(r["name"], r["filename"], r["offset"], r["size"], r["ram_address"]) for r in layout]
+        self.check()
+
+    def check(self):
+        for name, filename, offset, size, ram_address in self.regions:
+            if name == "rootfs" and filename.endswith(".gz"):
+                compress_rootfs(filename[:-len(".gz")])
+            if os.path.exists(filename) and os.path.getsize(filename) > size:
+                raise ValueError("{} no longer fits in its {} bytes flash region, rebuild needed".format(
+                    filename, size))
+
+    def summary(self):
+        for name, filename, offset, size, ram_address in self.regions:
+            used = os.path.getsize(filename) if os.path.exists(filename) else 0
+
+            print("{:<10} 0x{:08x}-0x{:08x} {:>9} / {:>9} bytes  {}".format(
+                name, offset, offset + size - 1, used, size, filename))
@@ -1,23 +1,41 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import json
+import hashlib
 import argparse
-
-parser = argparse.ArgumentParser(description="LiteX's CSR JSON to Linux DTS generator")
-parser.add_argument("csr_json", help="CSR JSON file")
-args = parser.parse_args()
-
-d = json.load(open(args.csr_json))
+import subprocess
 
 kB = 1024
 mB = kB*1024
 
-aliases = {}
+# Interrupts ---------------------------------------------------------------------------------------
+
+def interrupts(d, name):
+    # Interrupt of a peripheral on the VexRiscv interrupt controller, from the interrupt constants.
+    irq = d["constants"].get(name + "_interrupt")
+    if irq is None:
+        return ""
+    return """
+			interrupt-parent = <&intc0>;
+			interrupts = <{}>;""".format(irq)
+
+# DTS generation -----------------------------------------------------------------------------------
+
+def generate_dts(d, initrd_size=None, flash_rootfs=None):
+    """Generate the DTS from the CSR JSON.
 
-# Header -------------------------------------------------------------------------------------------
+    initrd_size: size of the initramfs loaded at main_ram + 8MB (default: 8MB window).
+    flash_rootfs: rootfs mounted from SPI Flash instead of an initramfs, as a dict with its type
+    (squashfs/jffs2), flash offset and size (see flash_layout.py).
+    """
+    aliases = {}
+    sys_clk_freq = int(50e6) if "sim" in d["constants"] else d["constants"]["config_clock_frequency"]
 
-dts = """
+    # Header ---------------------------------------------------------------------------------------
+
+    dts = """
 /dts-v1/;
 
 / {
@@ -27,25 +45,44 @@ dts = """
 	model = "VexRiscv SoCLinux";
 """
 
-# Boot Arguments -----------------------------------------------------------------------------------
+    # Boot Arguments -------------------------------------------------------------------------------
+
+    bootargs = "mem={main_ram_size_mb}M@0x{main_ram_base:x} rootwait console=liteuart earlycon=sbi".format(
+        main_ram_base=d["memories"]["main_ram"]["base"],
+        main_ram_size_mb=d["memories"]["main_ram"]["size"]//mB)
+    if flash_rootfs is None:
+        bootargs += " root=/dev/ram0"
+    else:
+        # Flash split in boot (bitstream, kernel), rootfs and images (DTB, emulator) MTD partitions
+        # on the "spi" MTD device of the LiteX SPI Flash driver: the rootfs is mtdblock1 (read-only
+        # for squashfs, read-write for jffs2).
+        read_only = flash_rootfs["type"] == "squashfs"
+        bootargs += " root=/dev/mtdblock1 rootfstype={type} {mode} mtdparts=spi:0x{offset:x}(boot)ro,0x{size:x}(rootfs){ro},-(images)ro".format(
+            type   = flash_rootfs["type"],
+            mode   = "ro" if read_only else "rw",
+            offset = flash_rootfs["offset"],
+            size   = flash_rootfs["size"],
+            ro     = "ro" if read_only else "")
+    bootargs += " init=/sbin/init swiotlb=32"
 
-dts += """
+    dts += """
 	chosen {{
-		bootargs = "mem={main_ram_size_mb}M@0x{main_ram_base:x} rootwait console=liteuart earlycon=sbi root=/dev/ram0 init=/sbin/init swiotlb=32";
+		bootargs = "{bootargs}";""".format(bootargs=bootargs)
+    if flash_rootfs is None:
+        dts += """
 		linux,initrd-start = <0x{linux_initrd_start:x}>;
-		linux,initrd-end   = <0x{linux_initrd_end:x}>;
-	}};
-""".format(
-		main_ram_base=d["memories"]["main_ram"]["base"],
-		main_ram_size=d["memories"]["main_ram"]["size"],
-		main_ram_size_mb=d["memories"]["main_ram"]["size"]//mB,
-
-		linux_initrd_start=d["memories"]["main_ram"]["base"] + 8*mB,
-		linux_initrd_end=d["memories"]["main_ram"]["base"] + 16*mB)
+		linux,initrd-end   = <0x{linux_initrd_end:x}>;""".format(
+            linux_initrd_start=d["memories"]["main_ram"]["base"] + 8*mB,
+            linux_initrd_end=d["memories"]["main_ram"]["base"] + 8*mB + (8*mB if initrd_size is None else initrd_size))
+    dts += """
+	};
+"""
 
-# CPU ----------------------------------------------------------------------------------------------
+    # CPU ------------------------------------------------------------------------------------------
 
-dts += """
+    # ISA: M (multiplications/divisions) in hardware on all the Linux variants. A: LR/SC in hardware,
+    # AMOs emulated by the machine mode emulator.
+    dts += """
 	cpus {{
 		#address-cells = <0x1>;
 		#size-cells = <0x0>;
@@ -73,31 +110,34 @@ dts += """
 			tlb-split;
 		}};
 	}};
-""".format(sys_clk_freq=int(50e6) if "sim" in d["constants"] else d["constants"]["config_clock_frequency"])
+""".format(sys_clk_freq=sys_clk_freq)
 
-# Memory -------------------------------------------------------------------------------------------
+    # Memory ---------------------------------------------------------------------------------------
 
-dts += """
+    dts += """
 	memory@{main_ram_base:x} {{
 		device_type = "memory";
 		reg = <0x0 0x{main_ram_base:x} 0x1 0x{main_ram_size:x}>;
 	}};
 """.format(main_ram_base=d["memories"]["main_ram"]["base"],
-		   main_ram_size=d["memories"]["main_ram"]["size"])
+               main_ram_size=d["memories"]["main_ram"]["size"])
 
-# SoC ----------------------------------------------------------------------------------------------
+    # SoC ------------------------------------------------------------------------------------------
 
-dts += """
-	soc {
+    # CSR data width: subregisters width of the CSRs (offsets of the CSRs in their bank), inherited by
+    # the LiteX drivers of the soc bus.
+    dts += """
+	soc {{
 		#address-cells = <0x2>;
 		#size-cells = <0x2>;
 		compatible = "simple-bus";
 		ranges;
-"""
+		litex,csr-data-width = <{csr_data_width}>;
+""".format(csr_data_width=d["constants"].get("config_csr_data_width", 8))
 
-# Interrupt controller
+    # Interrupt controller
 
-dts += """
+    dts += """
 		intc0: interrupt-controller {
 			interrupt-controller;
 			#interrupt-cells = <1>;
@@ -106,41 +146,76 @@ dts += """
 		};
 """
 
-	# UART -----------------------------------------------------------------------------------------
+    # MTime ----------------------------------------------------------------------------------------
 
-if "uart" in d["csr_bases"]:
-	aliases["serial0"] = "liteuart0"
-	dts += """
+    if "mtime" in d["memories"]:
+        dts += """
+		mtime0: timer@{mtime_base:x} {{
+			compatible = "litex,mtime";
+			reg = <0x0 0x{mtime_base:x} 0x0 0x8>;
+			clock-frequency = <{sys_clk_freq}>;
+		}};
+""".format(mtime_base=d["memories"]["mtime"]["base"], sys_clk_freq=sys_clk_freq)
+
+    # UART -----------------------------------------------------------------------------------------
+
+    if "uart" in d["csr_bases"]:
+        aliases["serial0"] = "liteuart0"
+        dts += """
 		liteuart0: serial@{uart_csr_base:x} {{
 			device_type = "serial";
 			compatible = "litex,liteuart";
-			reg = <0x0 0x{uart_csr_base:x} 0x0 0x100>;
+			reg = <0x0 0x{uart_csr_base:x} 0x0 0x100>;{uart_interrupts}
 			status = "okay";
 		}};
-	""".format(uart_csr_base=d["csr_bases"]["uart"])
+	""".format(uart_csr_base=d["csr_bases"]["uart"],
+                   uart_interrupts=interrupts(d, "uart"))
 
-	# Ethernet MAC ---------------------------------------------------------------------------------
+    # Timer ----------------------------------------------------------------------------------------
 
-if "ethmac" in d["csr_bases"]:
-	dts += """
+    if "timer0" in d["csr_bases"]:
+        dts += """
+		timer0: timer@{timer0_csr_base:x} {{
+			compatible = "litex,timer";
+			reg = <0x0 0x{timer0_csr_base:x} 0x0 0x100>;{timer0_interrupts}
+			status = "disabled";
+		}};
+	""".format(timer0_csr_base=d["csr_bases"]["timer0"],
+                   timer0_interrupts=interrupts(d, "timer0"))
+
+    # Ethernet MAC ---------------------------------------------------------------------------------
+
+    if "ethmac" in d["csr_bases"]:
+        # Rx/Tx slots in the ethmac memory (SRAM) or in main_ram (DMA, the ethmac memory being the slots base
+        # addresses registers).
+        ethmac_dma       = "ethmac_dma" in d["constants"]
+        ethmac_slot_size = d["constants"].get("ethmac_slot_size", 0x800)
+        ethmac_rx_slots  = d["constants"]["ethmac_rx_slots"]
+        ethmac_tx_slots  = d["constants"]["ethmac_tx_slots"]
+        dts += """
 		mac0: mac@{ethmac_csr_base:x} {{
-			compatible = "litex,liteeth";
+			compatible = "{ethmac_compatible}";
 			reg = <0x0 0x{ethmac_csr_base:x} 0x0 0x7c
 				0x0 0x{ethphy_csr_base:x} 0x0 0x0a
-				0x0 0x{ethmac_mem_base:x} 0x0 0x2000>;
+				0x0 0x{ethmac_mem_base:x} 0x0 0x{ethmac_mem_size:x}>;{ethmac_interrupts}
 			tx-fifo-depth = <{ethmac_tx_slots}>;
 			rx-fifo-depth = <{ethmac_rx_slots}>;
+			litex,slot-size = <0x{ethmac_slot_size:x}>;
 		}};
 	""".format(ethphy_csr_base=d["csr_bases"]["ethphy"],
-			   ethmac_csr_base=d["csr_bases"]["ethmac"],
-			   ethmac_mem_base=d["memories"]["ethmac"]["base"],
-			   ethmac_tx_slots=d["constants"]["ethmac_tx_slots"],
-			   ethmac_rx_slots=d["constants"]["ethmac_rx_slots"])
-
-	# Leds -----------------------------------------------------------------------------------------
-
-if "leds" in d["csr_bases"]:
-	dts += """
+                   ethmac_csr_base=d["csr_bases"]["ethmac"],
+                   ethmac_compatible="litex,liteeth-dma" if ethmac_dma else "litex,liteeth",
+                   ethmac_mem_base=d["memories"]["ethmac"]["base"],
+                   ethmac_mem_size=0x8 if ethmac_dma else (ethmac_rx_slots + ethmac_tx_slots)*ethmac_slot_size,
+                   ethmac_tx_slots=ethmac_tx_slots,
+                   ethmac_rx_slots=ethmac_rx_slots,
+                   ethmac_slot_size=ethmac_slot_size,
+                   ethmac_interrupts=interrupts(d, "ethmac"))
+
+    # Leds -----------------------------------------------------------------------------------------
+
+    if "leds" in d["csr_bases"]:
+        dts += """
 		leds: gpio@{leds_csr_base:x} {{
 			compatible = "litex,gpio";
 			reg = <0x0 0x{leds_csr_base:x} 0x0 0x4>;
@@ -149,11 +224,11 @@ if "leds" in d["csr_bases"]:
 		}};
 	""".format(leds_csr_base=d["csr_bases"]["leds"])
 
-	# RGB Led --------------------------------------------------------------------------------------
+    # RGB Led --------------------------------------------------------------------------------------
 
-for name in ["rgb_led_r0", "rgb_led_g0", "rgb_led_b0"]:
-	if name in d["csr_bases"]:
-	    dts += """
+    for name in ["rgb_led_r0", "rgb_led_g0", "rgb_led_b0"]:
+        if name in d["csr_bases"]:
+            dts += """
 		{pwm_name}: pwm@{pwm_csr_base:x} {{
 	        compatible = "litex,pwm";
 	        reg = <0x0 0x{pwm_csr_base:x} 0x0 0x24>;
@@ -162,12 +237,12 @@ for name in ["rgb_led_r0", "rgb_led_g0", "rgb_led_b0"]:
 	        status = "okay";
 	    }};
 	""".format(pwm_name=name,
-		       pwm_csr_base=d["csr_bases"][name])
+                   pwm_csr_base=d["csr_bases"][name])
 
-	# Switches -------------------------------------------------------------------------------------
+    # Switches -------------------------------------------------------------------------------------
 
-if "switches" in d["csr_bases"]:
-	dts += """
+    if "switches" in d["csr_bases"]:
+        dts += """
 		switches: gpio@{switches_csr_base:x} {{
 			compatible = "litex,gpio";
 			reg = <0x0 0x{switches_csr_base:x} 0x0 0x4>;
@@ -176,12 +251,12 @@ if "switches" in d["csr_bases"]:
 		}};
 	""".format(switches_csr_base=d["csr_bases"]["switches"])
 
-	# SPI ------------------------------------------------------------------------------------------
+    # SPI ------------------------------------------------------------------------------------------
 
-if "spi" in d["csr_bases"]:
-    aliases["spi0"] = "litespi0"
+    if "spi" in d["csr_bases"]:
+        aliases["spi0"] = "litespi0"
 
-    dts += """
+        dts += """
 	    litespi0: spi@{spi_csr_base:x} {{
 		    compatible = "litex,litespi";
 		    reg = <0x0 0x{spi_csr_base:x} 0x0 0x100>;
@@ -203,27 +278,31 @@ if "spi" in d["csr_bases"]:
 	    }};
     """.format(spi_csr_base=d["csr_bases"]["spi"])
 
-	# SPIFLASH ---------------------------------------------------------------------------------------
+    # SPIFLASH -------------------------------------------------------------------------------------
 
-if "spiflash" in d["csr_bases"]:
-    aliases["spiflash"] = "litespiflash"
+    if "spiflash" in d["csr_bases"]:
+        aliases["spiflash"] = "litespiflash"
 
-    dts += """
+        dts += """
 	    litespiflash: spiflash@{spiflash_csr_base:x} {{
 		    compatible = "litex,spiflash";
-		    reg = <0x0 0x{spiflash_csr_base:x} 0x0 0x100>;
+		    reg = <0x0 0x{spiflash_csr_base:x} 0x0 0x100>,
+			  <0x0 0x{spiflash_base:x} 0x0 0x{spiflash_size:x}>;
 		    status = "okay";
 			flash: flash@0 {{
 				compatible = "jedec,spi-nor";
 				reg = <0x0 0x0 0x0 0x{spiflash_size:x}>;
 		    }};
 	    }};
-    """.format(spiflash_csr_base=d["csr_bases"]["spiflash"], spiflash_size=d["memories"]["spiflash"]["size"])
+    """.format(
+        spiflash_csr_base = d["csr_bases"]["spiflash"],
+        spiflash_base     = d["memories"]["spiflash"]["base"],
+        spiflash_size     = d["memories"]["spiflash"]["size"])
 
-	# I2C ------------------------------------------------------------------------------------------
+    # I2C ------------------------------------------------------------------------------------------
 
-if "i2c0" in d["csr_bases"]:
-    dts += """
+    if "i2c0" in d["csr_bases"]:
+        dts += """
 		i2c0: i2c@{i2c0_csr_base:x} {{
 			compatible = "litex,i2c";
 			reg = <0x0 0x{i2c0_csr_base:x} 0x0 0x5>;
@@ -231,10 +310,10 @@ if "i2c0" in d["csr_bases"]:
 		}};
 """.format(i2c0_csr_base=d["csr_bases"]["i2c0"])
 
-	# XADC -----------------------------------------------------------------------------------------
+    # XADC -----------------------------------------------------------------------------------------
 
-if "xadc" in d["csr_bases"]:
-    dts += """
+    if "xadc" in d["csr_bases"]:
+        dts += """
 		hwmon0: xadc@{xadc_csr_base:x} {{
 			compatible = "litex,hwmon-xadc";
 			reg = <0x0 0x{xadc_csr_base:x} 0x0 0x20>;
@@ -242,14 +321,14 @@ if "xadc" in d["csr_bases"]:
 		}};
 """.format(xadc_csr_base=d["csr_bases"]["xadc"])
 
-	# Framebuffer ----------------------------------------------------------------------------------
+    # Framebuffer ----------------------------------------------------------------------------------
 
-if "framebuffer" in d["csr_bases"]:
-    # FIXME: dynamic framebuffer base and size
-    framebuffer_base   = 0xc8000000
-    framebuffer_width  = 1280
-    framebuffer_height = 720
-    dts += """
+    if "framebuffer" in d["csr_bases"]:
+        # FIXME: dynamic framebuffer base and size
+        framebuffer_base   = 0xc8000000
+        framebuffer_width  = 1280
+        framebuffer_height = 720
+        dts += """
 		framebuffer0: framebuffer@f0000000 {{
 			compatible = "simple-framebuffer";
 			reg = <0x0 0x{framebuffer_base:x} 0x0 0x{framebuffer_size:x}>;
@@ -259,15 +338,15 @@ if "framebuffer" in d["csr_bases"]:
 			format = "a8b8g8r8";
 		}};
 	""".format(framebuffer_base=framebuffer_base,
-               framebuffer_width=framebuffer_width,
-               framebuffer_height=framebuffer_height,
-               framebuffer_size=framebuffer_width*framebuffer_height*4,
-               framebuffer_stride=framebuffer_width*4)
+                   framebuffer_width=framebuffer_width,
+                   framebuffer_height=framebuffer_height,
+                   framebuffer_size=framebuffer_width*framebuffer_height*4,
+                   framebuffer_stride=framebuffer_width*4)
 
-	#·ICAPBitstream --------------------------------------------------------------------------------
+    #·ICAPBitstream --------------------------------------------------------------------------------
 
-if "icap_bit" in d["csr_bases"]:
-    dts += """
+    if "icap_bit" in d["csr_bases"]:
+        dts += """
 		fpga0: icap@{icap_csr_base:x} {{
 			compatible = "litex,fpga-icap";
 			reg = <0x0 0x{icap_csr_base:x} 0x0 0x14>;
@@ -275,44 +354,133 @@ if "icap_bit" in d["csr_bases"]:
 		}};
 """.format(icap_csr_base=d["csr_bases"]["icap_bit"])
 
-dts += """
+    dts += """
 	};
 """
 
-# Aliases -----------------------------------------------------------------------------------------
+    # Aliases --------------------------------------------------------------------------------------
 
-if aliases:
-    dts += """
+    if aliases:
+        dts += """
 	aliases {
 """
-    for alias in aliases:
-    	dts += """
+        for alias in aliases:
+            dts += """
 	   {} = &{};
 """.format(alias, aliases[alias])
-    dts += """
+        dts += """
 	};
 """
 
-dts += """
+    dts += """
 };
 """
 
-# --------------------------------------------------------------------------------------------------
+    # ----------------------------------------------------------------------------------------------
 
-if "leds" in d["csr_bases"]:
-	dts += """
+    if "leds" in d["csr_bases"]:
+        dts += """
 &leds {
 	litex,ngpio = <4>;
 	status = "okay";
 };
 	"""
 
-if "switches" in d["csr_bases"]:
-	dts += """
+    if "switches" in d["csr_bases"]:
+        dts += """
 &switches {
 	litex,ngpio = <4>;
 	status = "okay";
 };
 	"""
 
-print(dts)
+    return dts
+
+# Incremental DTS/DTB generation -------------------------------------------------------------------
+
+def _hash(*filenames):
+    h = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def _read_stamp(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_atomic(filename, content, mode="w"):
+    tmp = filename + ".tmp"
+    with open(tmp, mode) as f:
+        f.write(content)
+    os.replace(tmp, filename)
+
+def write_dts(csr_json, dts_filename, **kwargs):
+    """Generate DTS from CSR JSON, skipping it if CSR JSON, generator and options are unchanged.
+
+    Returns True when the DTS has been (re)generated.
+    """
+    stamp_filename = dts_filename + ".stamp"
+    stamp   = _read_stamp(stamp_filename)
+    inputs  = [csr_json, os.path.abspath(__file__)]
+    mtimes  = [os.stat(filename).st_mtime for filename in inputs]
+    options = json.loads(json.dumps(kwargs, sort_keys=True))
+    if os.path.exists(dts_filename) and stamp.get("options") == options:
+        # Fast path: unchanged mtimes, then content hash (ex: csr.json rewritten identically).
+        if stamp.get("mtimes") == mtimes:
+            return False
+        if stamp.get("hash") == _hash(*inputs):
+            stamp["mtimes"] = mtimes
+            _write_atomic(stamp_filename, json.dumps(stamp))
+            return False
+    with open(csr_json) as f:
+        d = json.load(f)
+    _write_atomic(dts_filename, generate_dts(d, **kwargs))
+    _write_atomic(stamp_filename, json.dumps({"mtimes": mtimes, "hash": _hash(*inputs), "options": options}))
+    return True
+
+def compile_dts(dts_filename, dtb_filename):
+    """Compile DTS to DTB with dtc, skipping it if DTB is already compiled from this DTS.
+
+    DTB is written atomically and a RuntimeError is raised on dtc errors. Returns True when the DTB
+    has been (re)compiled.
+    """
+    stamp_filename = dtb_filename + ".stamp"
+    dts_hash = _hash(dts_filename)
+    if os.path.exists(dtb_filename) and _read_stamp(stamp_filename).get("hash") == dts_hash:
+        return False
+    tmp = dtb_filename + ".tmp"
+    r = subprocess.run(["dtc", "-O", "dtb", "-o", tmp, dts_filename],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if r.returncode != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RuntimeError("dtc failed on {}:\n{}".format(dts_filename, r.stdout.decode(errors="replace")))
+    os.replace(tmp, dtb_filename)
+    _write_atomic(stamp_filename, json.dumps({"hash": dts_hash}))
+    return True
+
+# Main ---------------------------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="LiteX's CSR JSON to Linux DTS generator")
+    parser.add_argument("csr_json", help="CSR JSON file")
+    parser.add_argument("--initrd-size", type=lambda x: int(x, 0), default=None, help="initrd size (default: 8MB)")
+    parser.add_argument("--flash-rootfs", default=None, metavar="TYPE:OFFSET:SIZE",
+        help="rootfs mounted from SPI Flash instead of initrd, ex: squashfs:0x800000:0x700000")
+    args = parser.parse_args()
+
+    d = json.load(open(args.csr_json))
+
+    flash_rootfs = None
+    if args.flash_rootfs is not None:
+        _type, offset, size = args.flash_rootfs.split(":")
+        flash_rootfs = {"type": _type, "offset": int(offset, 0), "size": int(size, 0)}
+
+    print(generate_dts(d, initrd_size=args.initrd_size, flash_rootfs=flash_rootfs))
+
+if __name__ == "__main__":
+    main()
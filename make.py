@@ -2,79 +2,212 @@
 
 import argparse
 import os
+import re
+import sys
+import json
+import hashlib
+import tempfile
+import subprocess
+import time
+import traceback
+import multiprocessing
+import multiprocessing.connection
 
 from litex.soc.integration.builder import Builder
 
 from soc_linux import SoCLinux
+from build_cache import BuildCache
+from flash_layout import FlashLayout, flash_rootfs_types
 
 kB = 1024
 
 # Board definition----------------------------------------------------------------------------------
 
 class Board:
+    toolchain = None
     def __init__(self, soc_cls, soc_capabilities):
         self.soc_cls = soc_cls
         self.soc_capabilities = soc_capabilities
 
-    def load(self):
+    def load(self, cable=None):
         raise NotImplementedError
 
-    def flash(self):
+    def flash(self, force=False, sectors=False, cable=None):
         raise NotImplementedError
 
+    def call(self, cmd):
+        if os.system(cmd) != 0:
+            raise OSError("\"{}\" failed".format(cmd))
+
+    def check_cable(self, cable):
+        if cable is not None:
+            raise NotImplementedError("JTAG cable selection not supported on {}".format(type(self).__name__))
+
+    def openocd_config(self, config, cable=None):
+        """Return OpenOCD config, with JTAG cable selection (serial number or USB location) if specified."""
+        if cable is None:
+            return config
+        with open(config) as f:
+            content = f.read()
+        interface = re.search(r"^interface\s+(\w+)", content, re.MULTILINE)
+        interface = interface.group(1) if interface else None
+        if interface == "ftdi":
+            location = re.match(r"^\d+-[\d.]+$", cable) is not None
+            selection = "ftdi_location {}" if location else "ftdi_serial \"{}\""
+        elif interface == "ft232r":
+            selection = "ft232r_serial_desc \"{}\""
+        else:
+            raise NotImplementedError("JTAG cable selection not supported with {} interface".format(interface))
+        os.makedirs(os.path.join("build", "prog"), exist_ok=True)
+        filename = os.path.join("build", "prog", "{}_{}.cfg".format(
+            os.path.splitext(os.path.basename(config))[0], re.sub(r"\W", "_", cable)))
+        with open(filename, "w") as f:
+            f.write(content)
+            f.write("\n" + selection.format(cable) + "\n")
+            # Allow concurrent OpenOCD instances.
+            f.write("gdb_port disabled\ntelnet_port disabled\ntcl_port disabled\n")
+        return filename
+
+    def openocd_flash(self, prog, address, filename):
+        """Program filename at address through the OpenOCD flash proxy of prog, and verify it.
+
+        LiteX's OpenOCD.flash ignores OpenOCD errors: programming and verification (flash verify_bank)
+        are done here in a single OpenOCD run whose exit status is checked.
+        """
+        script = "; ".join([
+            "init",
+            "jtagspi_init 0 {{{}}}".format(prog.find_flash_proxy()),
+            "jtagspi_program {{{}}} 0x{:x}".format(filename, address),
+            "flash verify_bank 0 {{{}}} 0x{:x}".format(filename, address),
+            "fpga_program",
+            "exit"
+        ])
+        if subprocess.call(["openocd", "-f", prog.config, "-c", script]) != 0:
+            raise OSError("Flashing {} at 0x{:08x} failed".format(filename, address))
+
+    def get_flash_layout(self, board_name, pack=False, compress_rootfs=False):
+        layout = FlashLayout(self.SPIFLASH_SECTOR_SIZE, pack=pack, compress_rootfs=compress_rootfs)
+        layout_filename = os.path.join("build", board_name, "flash_layout.json")
+        if os.path.exists(layout_filename):
+            layout.load(layout_filename)
+        else:
+            layout.plan()
+        return layout
+
+    def flash_regions(self, prog, flash_regions, manifest_filename, force=False, sectors=False):
+        """Program flash regions whose content changed since last flash.
+
+        SHA-256 of last-flashed images (and of their SPIFLASH_SECTOR_SIZE sectors) are recorded in a
+        manifest once programmed and verified. With sectors=True, only changed sectors of a changed
+        region are programmed.
+        """
+        manifest = {}
+        if os.path.exists(manifest_filename) and not force:
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+        flashed = skipped = 0
+        for filename, base in flash_regions.items():
+            base = int(base, 16)
+            with open(filename, "rb") as f:
+                data = f.read()
+            sector_size = self.SPIFLASH_SECTOR_SIZE
+            entry = {
+                "base":    base,
+                "sha256":  hashlib.sha256(data).hexdigest(),
+                "sectors": [hashlib.sha256(data[i:i+sector_size]).hexdigest()
+                    for i in range(0, len(data), sector_size)],
+            }
+            previous = manifest.get(filename, {})
+            if previous.get("base") != base:
+                previous = {}
+            if previous.get("sha256") == entry["sha256"]:
+                print("Skipping {} at 0x{:08x} (unchanged)".format(filename, base))
+                skipped += len(data)
+                continue
+            # Changed sectors, merged in contiguous ranges.
+            ranges = [(0, len(entry["sectors"]))]
+            if sectors and previous:
+                ranges = []
+                for n, sector_hash in enumerate(entry["sectors"]):
+                    if n < len(previous["sectors"]) and previous["sectors"][n] == sector_hash:
+                        continue
+                    if ranges and ranges[-1][1] == n:
+                        ranges[-1] = (ranges[-1][0], n + 1)
+                    else:
+                        ranges.append((n, n + 1))
+            for start, end in ranges:
+                region = data[start*sector_size:end*sector_size]
+                if (start, end) == (0, len(entry["sectors"])):
+                    print("Flashing {} at 0x{:08x}".format(filename, base))
+                    self.openocd_flash(prog, base, filename)
+                else:
+                    print("Flashing {} sectors {}-{} at 0x{:08x}".format(filename, start, end - 1,
+                        base + start*sector_size))
+                    with tempfile.NamedTemporaryFile(suffix=".bin", delete=False) as f:
+                        f.write(region)
+                    try:
+                        self.openocd_flash(prog, base + start*sector_size, f.name)
+                    finally:
+                        os.remove(f.name)
+                flashed += len(region)
+                skipped -= len(region)
+            skipped += len(data)
+            manifest[filename] = entry
+            os.makedirs(os.path.dirname(manifest_filename), exist_ok=True)
+            with open(manifest_filename, "w") as f:
+                json.dump(manifest, f, indent=4)
+        print("Flashed {} bytes, skipped {} unchanged bytes".format(flashed, skipped))
+
 # Arty support -------------------------------------------------------------------------------------
 
 class Arty(Board):
+    toolchain = "vivado"
     SPIFLASH_PAGE_SIZE = 256
     SPIFLASH_SECTOR_SIZE = 64*kB
     def __init__(self):
         from litex_boards.targets import arty
         Board.__init__(self, arty.EthernetSoC, {"serial", "ethernet", "spiflash", "leds", "rgb_led", "switches", "spi", "i2c", "xadc", "icap_bit"})
 
-    def load(self):
+    def load(self, cable=None):
         from litex.build.openocd import OpenOCD
-        prog = OpenOCD("prog/openocd_xilinx.cfg")
+        prog = OpenOCD(self.openocd_config("prog/openocd_xilinx.cfg", cable))
         prog.load_bitstream("build/arty/gateware/top.bit")
 
-    def flash(self):
-        flash_regions = {
-            "build/arty/gateware/top.bin": "0x00000000", # FPGA image:  loaded at startup
-            "buildroot/Image":             "0x00400000", # Linux Image: copied to 0xc0000000 by bios
-            "buildroot/rootfs.cpio":       "0x00800000", # File System: copied to 0xc0800000 by bios
-            "buildroot/rv32.dtb":          "0x00f00000", # Device tree: copied to 0xc1000000 by bios
-            "emulator/emulator.bin":       "0x00f80000", # MM Emulator: copied to 0x20000000 by bios
-        }
+    def flash(self, force=False, sectors=False, cable=None):
+        # FPGA image at 0, Linux images copied to RAM by bios (see flash_layout.py).
+        flash_regions = self.get_flash_layout("arty").flash_regions("build/arty/gateware/top.bin")
         from litex.build.openocd import OpenOCD
-        prog = OpenOCD("prog/openocd_xilinx.cfg",
+        prog = OpenOCD(self.openocd_config("prog/openocd_xilinx.cfg", cable),
             flash_proxy_basename="prog/bscan_spi_xc7a35t.bit")
         prog.set_flash_proxy_dir(".")
-        for filename, base in flash_regions.items():
-            base = int(base, 16)
-            print("Flashing {} at 0x{:08x}".format(filename, base))
-            prog.flash(base, filename)
+        manifest = "flash_manifest.json" if cable is None else "flash_manifest_{}.json".format(cable)
+        self.flash_regions(prog, flash_regions, os.path.join("build/arty", manifest), force, sectors)
 
 # NeTV2 support ------------------------------------------------------------------------------------
 
 class NeTV2(Board):
+    toolchain = "vivado"
     SPIFLASH_PAGE_SIZE = 256
     SPIFLASH_SECTOR_SIZE = 64*kB
     def __init__(self):
         from litex_boards.targets import netv2
         Board.__init__(self, netv2.EthernetSoC, {"serial", "ethernet", "framebuffer", "spiflash", "leds", "xadc"})
 
-    def load(self):
+    def load(self, cable=None):
         from litex.build.openocd import OpenOCD
-        prog = OpenOCD("prog/openocd_netv2_rpi.cfg")
+        prog = OpenOCD(self.openocd_config("prog/openocd_netv2_rpi.cfg", cable))
         prog.load_bitstream("build/netv2/gateware/top.bit")
 
 # Genesys2 support ---------------------------------------------------------------------------------
 
 class Genesys2(Board):
+    toolchain = "vivado"
     def __init__(self):
         from litex_boards.targets import genesys2
         Board.__init__(self, genesys2.BaseSoC, {"serial"})
 
-    def load(self):
+    def load(self, cable=None):
+        self.check_cable(cable)
         from litex.build.xilinx import VivadoProgrammer
         prog = VivadoProgrammer()
         prog.load_bitstream("build/genesys2/gateware/top.bit")
@@ -82,11 +215,13 @@ class Genesys2(Board):
 # KCU105 support -----------------------------------------------------------------------------------
 
 class KCU105(Board):
+    toolchain = "vivado"
     def __init__(self):
         from litex_boards.targets import kcu105
         Board.__init__(self, kcu105.EthernetSoC, {"serial", "ethernet"})
 
-    def load(self):
+    def load(self, cable=None):
+        self.check_cable(cable)
         from litex.build.xilinx import VivadoProgrammer
         prog = VivadoProgrammer()
         prog.load_bitstream("build/kcu105/gateware/top.bit")
@@ -95,11 +230,13 @@ class KCU105(Board):
 # Nexys4DDR support --------------------------------------------------------------------------------
 
 class Nexys4DDR(Board):
+    toolchain = "vivado"
     def __init__(self):
         from litex_boards.targets import nexys4ddr
         Board.__init__(self, nexys4ddr.EthernetSoC, {"serial", "ethernet"})
 
-    def load(self):
+    def load(self, cable=None):
+        self.check_cable(cable)
         from litex.build.xilinx import VivadoProgrammer
         prog = VivadoProgrammer()
         prog.load_bitstream("build/nexys4ddr/gateware/top.bit")
@@ -107,11 +244,13 @@ class Nexys4DDR(Board):
 # NexysVideo support --------------------------------------------------------------------------------
 
 class NexysVideo(Board):
+    toolchain = "vivado"
     def __init__(self):
         from litex_boards.targets import nexys_video
         Board.__init__(self, nexys_video.EthernetSoC, {"serial", "framebuffer"})
 
-    def load(self):
+    def load(self, cable=None):
+        self.check_cable(cable)
         from litex.build.xilinx import VivadoProgrammer
         prog = VivadoProgrammer()
         prog.load_bitstream("build/nexys_video/gateware/top.bit")
@@ -119,60 +258,367 @@ class NexysVideo(Board):
 # MiniSpartan6 support -----------------------------------------------------------------------------
 
 class MiniSpartan6(Board):
+    toolchain = "ise"
     def __init__(self):
         from litex_boards.targets import minispartan6
         Board.__init__(self, minispartan6.BaseSoC, {"serial"})
 
-    def load(self):
-        os.system("xc3sprog -c ftdi build/minispartan6/gateware/top.bit")
+    def load(self, cable=None):
+        serial = "" if cable is None else "-s {} ".format(cable)
+        self.call("xc3sprog -c ftdi {}build/minispartan6/gateware/top.bit".format(serial))
 
 
 # Versa ECP5 support -------------------------------------------------------------------------------
 
 class VersaECP5(Board):
+    toolchain = "trellis"
     SPIFLASH_PAGE_SIZE = 256
     SPIFLASH_SECTOR_SIZE = 64*kB
     def __init__(self):
         from litex_boards.targets import versa_ecp5
         Board.__init__(self, versa_ecp5.EthernetSoC, {"serial", "ethernet", "spiflash"})
 
-    def load(self):
-        os.system("openocd -f prog/ecp5-versa5g.cfg -c \"transport select jtag; init; svf build/versa_ecp5/gateware/top.svf; exit\"")
+    def load(self, cable=None):
+        config = self.openocd_config("prog/ecp5-versa5g.cfg", cable)
+        self.call("openocd -f {} -c \"transport select jtag; init; svf build/versa_ecp5/gateware/top.svf; exit\"".format(config))
 
 # ULX3S support ------------------------------------------------------------------------------------
 
 class ULX3S(Board):
+    toolchain = "trellis"
     def __init__(self):
         from litex_boards.targets import ulx3s
         Board.__init__(self, ulx3s.BaseSoC, {"serial"})
 
-    def load(self):
-        os.system("ujprog build/ulx3s/gateware/top.svf")
+    def load(self, cable=None):
+        self.check_cable(cable)
+        self.call("ujprog build/ulx3s/gateware/top.svf")
 
 # De10Lite support ------------------------------------------------------------------------------------
 
 class De10Lite(Board):
+    toolchain = "quartus"
     def __init__(self):
         from litex_boards.targets import de10lite
         Board.__init__(self, de10lite.BaseSoC, {"serial"})
 
-    def load(self):
+    def load(self, cable=None):
         from litex.build.altera import USBBlaster
-        prog = USBBlaster()
+        prog = USBBlaster() if cable is None else USBBlaster(cable_name=cable)
         prog.load_bitstream("build/de10lite/gateware/top.sof")
 
 # De0Nano support ------------------------------------------------------------------------------------
 
 class De0Nano(Board):
+    toolchain = "quartus"
     def __init__(self):
         from litex_boards.targets import de0nano
         Board.__init__(self, de0nano.BaseSoC, {"serial"})
 
-    def load(self):
+    def load(self, cable=None):
         from litex.build.altera import USBBlaster
-        prog = USBBlaster()
+        prog = USBBlaster() if cable is None else USBBlaster(cable_name=cable)
         prog.load_bitstream("build/de0nano/gateware/top.sof")
 
+# Build ---------------------------------------------------------------------------------------------
+
+def configure_soc(board, board_name, args):
+    soc_kwargs = {}
+    soc_kwargs["uart_baudrate"] = args.uart_baudrate
+    if args.csr_data_width != 8:
+        soc_kwargs["csr_data_width"] = args.csr_data_width
+    if "ethernet" in board.soc_capabilities:
+        if (args.ethmac_rx_slots, args.ethmac_tx_slots) != (2, 2):
+            soc_kwargs["ethmac_rx_slots"] = args.ethmac_rx_slots
+            soc_kwargs["ethmac_tx_slots"] = args.ethmac_tx_slots
+        if args.ethmac_dma:
+            soc_kwargs["ethmac_dma"]       = True
+            soc_kwargs["ethmac_slot_size"] = args.ethmac_slot_size
+    if board_name in ["versa_ecp5", "ulx3s"]:
+        soc_kwargs["toolchain"] = "trellis"
+        soc_kwargs["cpu_variant"] = "linux+no-dsp"
+    if board_name in ["de0nano"]:
+        soc_kwargs["l2_size"] = 1024 # FIXME: Reduce l2_size, blockram not infered correctly?
+    soc = SoCLinux(board.soc_cls, **soc_kwargs)
+    flash_layout = None
+    if "spiflash" in board.soc_capabilities:
+        soc.add_spi_flash(dummy=args.spiflash_dummy, div=args.spiflash_div)
+        soc.add_constant("SPIFLASH_PAGE_SIZE", board.SPIFLASH_PAGE_SIZE)
+        soc.add_constant("SPIFLASH_SECTOR_SIZE", board.SPIFLASH_SECTOR_SIZE)
+        flash_layout = FlashLayout(board.SPIFLASH_SECTOR_SIZE,
+            pack            = args.flash_layout == "packed",
+            compress_rootfs = args.flash_compress_rootfs,
+            flash_rootfs    = args.flash_rootfs)
+        flash_layout.plan()
+    if "ethernet" in board.soc_capabilities:
+        soc.configure_ethernet(local_ip=args.local_ip, remote_ip=args.remote_ip)
+    if "leds" in board.soc_capabilities:
+        soc.add_leds()
+    if "rgb_led" in board.soc_capabilities:
+        soc.add_rgb_led()
+    if "switches" in board.soc_capabilities:
+        soc.add_switches()
+    if "spi" in board.soc_capabilities:
+        soc.add_spi(args.spi_bpw, args.spi_sck_freq)
+    if "i2c" in board.soc_capabilities:
+        soc.add_i2c()
+    if "xadc" in board.soc_capabilities:
+        soc.add_xadc()
+    if "framebuffer" in board.soc_capabilities:
+        soc.add_framebuffer()
+    if "icap_bit" in board.soc_capabilities:
+        soc.add_icap_bitstream()
+    if args.with_mtime:
+        soc.add_mtime()
+    soc.configure_boot(flash_layout)
+
+    config = {
+        "board":        board_name,
+        "soc_kwargs":   soc_kwargs,
+        "capabilities": sorted(board.soc_capabilities),
+        "local_ip":     args.local_ip,
+        "remote_ip":    args.remote_ip,
+        "spi_bpw":      args.spi_bpw,
+        "spi_sck_freq": args.spi_sck_freq,
+        "with_mtime":   args.with_mtime,
+    }
+    if "spiflash" in board.soc_capabilities:
+        config["spiflash_dummy"] = args.spiflash_dummy
+        config["spiflash_div"]   = args.spiflash_div
+    return soc, config, flash_layout
+
+def build_board(board_name, args, lock=None, cache=None):
+    board = supported_boards[board_name]()
+    soc, config, flash_layout = configure_soc(board, board_name, args)
+
+    build_dir = os.path.join("build", board_name)
+    if args.build and cache is not None:
+        # Generate gateware/software without running the toolchain to compute the cache key...
+        builder = Builder(soc, output_dir=build_dir,
+            compile_software=True, compile_gateware=False,
+            csr_json=os.path.join(build_dir, "csr.json"))
+        builder.build()
+        key = cache.key(soc, build_dir, board.toolchain, config)
+        if cache.restore(key, build_dir):
+            print("[{}] build cache hit ({}), skipping toolchain".format(board_name, key[:16]))
+        else:
+            # ...and on a miss, build a fresh SoC (a platform can only be finalized once).
+            print("[{}] build cache miss ({})".format(board_name, key[:16]))
+            soc, _, _ = configure_soc(board, board_name, args)
+            builder = Builder(soc, output_dir=build_dir,
+                csr_json=os.path.join(build_dir, "csr.json"))
+            builder.build()
+            cache.store(key, build_dir)
+    elif args.build:
+        builder = Builder(soc, output_dir=build_dir,
+            csr_json=os.path.join(build_dir, "csr.json"))
+        builder.build()
+    else:
+        builder = Builder(soc, output_dir="build/" + board_name,
+            compile_software=True, compile_gateware=False,
+            csr_json=os.path.join(build_dir, "csr.json"))
+        builder.build()
+
+    # DTB and emulator are written to shared locations (buildroot/, emulator/): serialize.
+    if lock is not None:
+        lock.acquire()
+    try:
+        # Initramfs passed to the kernel with its exact size (required for a compressed one), unless
+        # the rootfs is mounted from flash.
+        initrd_size  = None
+        flash_rootfs = None
+        rootfs = "buildroot/rootfs.cpio" if flash_layout is None else flash_layout.get_rootfs()
+        if flash_layout is not None:
+            flash_rootfs = flash_layout.get_flash_rootfs()
+        if flash_rootfs is None and os.path.exists(rootfs):
+            initrd_size = os.path.getsize(rootfs)
+        soc.generate_dts(board_name, initrd_size, flash_rootfs)
+        soc.compile_dts(board_name)
+        soc.compile_emulator(board_name, args.emulator_trap_stats, args.emulator_csr_bench)
+        if flash_layout is not None:
+            # Check DTB/emulator fit now they are built.
+            flash_layout.check()
+            flash_layout.save(os.path.join(build_dir, "flash_layout.json"))
+            flash_layout.write_images_json(os.path.join(build_dir, "images.json"))
+            flash_layout.summary()
+    finally:
+        if lock is not None:
+            lock.release()
+
+    return board
+
+# Build Scheduler ----------------------------------------------------------------------------------
+
+def _worker(func, func_args, log_filename, mode="w", error_re=None):
+    # Redirect at file descriptor level so toolchains spawned by os.system/subprocess are logged too.
+    log = open(log_filename, mode)
+    log_start = log.tell()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    try:
+        func(*func_args)
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Some tools/programmers only report errors in their output.
+    if error_re is not None:
+        with open(log_filename) as f:
+            f.seek(log_start)
+            if re.search(error_re, f.read(), re.MULTILINE):
+                os._exit(1)
+    os._exit(0)
+
+class BuildScheduler:
+    """Builds boards in parallel worker processes.
+
+    At most `jobs` builds run at once and, for each toolchain listed in `toolchain_jobs`, at most
+    that many builds using this toolchain (ex: to limit concurrent Vivado runs because of RAM).
+    """
+    def __init__(self, args, jobs=1, toolchain_jobs={}, log_dir="build/logs", cache=None):
+        self.args           = args
+        self.jobs           = max(1, jobs)
+        self.toolchain_jobs = toolchain_jobs
+        self.log_dir        = log_dir
+        self.cache          = cache
+        self.lock           = multiprocessing.Lock()
+        self.results        = {}
+
+    def _toolchain(self, board_name):
+        return supported_boards[board_name].toolchain
+
+    def _can_start(self, board_name, running):
+        if len(running) >= self.jobs:
+            return False
+        toolchain = self._toolchain(board_name)
+        if toolchain in self.toolchain_jobs:
+            n = sum(self._toolchain(name) == toolchain for name in running.values())
+            if n >= self.toolchain_jobs[toolchain]:
+                return False
+        return True
+
+    def run(self, board_names):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.results = {board_name: None for board_name in board_names}
+        pending = list(board_names)
+        running = {} # process: board_name
+        start   = {}
+        while pending or running:
+            for board_name in list(pending):
+                if self._can_start(board_name, running):
+                    log_filename = os.path.join(self.log_dir, "{}.log".format(board_name))
+                    p = multiprocessing.Process(target=_worker,
+                        args=(build_board, (board_name, self.args, self.lock, self.cache), log_filename))
+                    p.start()
+                    print("[{}] started ({}), log: {}".format(board_name,
+                        self._toolchain(board_name), log_filename))
+                    pending.remove(board_name)
+                    running[p] = board_name
+                    start[board_name] = time.time()
+            multiprocessing.connection.wait([p.sentinel for p in running])
+            for p in list(running):
+                if p.exitcode is not None:
+                    board_name = running.pop(p)
+                    duration = time.time() - start[board_name]
+                    self.results[board_name] = (p.exitcode == 0, duration)
+                    print("[{}] {} in {:.1f}s".format(board_name,
+                        "done" if p.exitcode == 0 else "FAILED", duration))
+        return self.results
+
+    def summary(self):
+        print("")
+        print("{:<16} {:<10} {:<8} {:>10}".format("Board", "Toolchain", "Status", "Time (s)"))
+        print("-"*47)
+        for board_name, (success, duration) in self.results.items():
+            print("{:<16} {:<10} {:<8} {:>10.1f}".format(board_name,
+                str(self._toolchain(board_name)), "pass" if success else "FAIL", duration))
+
+def parse_toolchain_jobs(s):
+    toolchain_jobs = {}
+    if s:
+        for entry in s.split(","):
+            toolchain, n = entry.split("=")
+            toolchain_jobs[toolchain.strip().lower()] = max(1, int(n))
+    return toolchain_jobs
+
+# Program Farm -------------------------------------------------------------------------------------
+
+def program_target(board_name, cable, args):
+    board = supported_boards[board_name]()
+    if args.load:
+        board.load(cable=cable)
+    if args.flash:
+        board.flash(force=args.flash_force, sectors=args.flash_sectors, cable=cable)
+
+def _target_name(target):
+    board_name, cable = target
+    return board_name if cable is None else "{}_{}".format(board_name, cable)
+
+class ProgramFarm:
+    """Loads/flashes several boards concurrently.
+
+    Targets are (board name, cable) tuples, the cable being the JTAG cable serial number or USB
+    location (None: default cable). Each target is programmed in a worker process reusing the board's
+    load()/flash() with its own log, and retried on failure (OpenOCD "Error:" output included, since
+    the programmers do not always report failures).
+    """
+    def __init__(self, args, jobs=4, retries=2, log_dir="build/logs/prog"):
+        self.args    = args
+        self.jobs    = max(1, jobs)
+        self.retries = retries
+        self.log_dir = log_dir
+        self.results = {}
+
+    def run(self, targets):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.results = {target: None for target in targets}
+        pending  = [(target, 1) for target in targets]
+        running  = {} # process: (target, attempt)
+        start    = {}
+        while pending or running:
+            while pending and len(running) < self.jobs:
+                target, attempt = pending.pop(0)
+                name = _target_name(target)
+                log_filename = os.path.join(self.log_dir, "{}.log".format(re.sub(r"[^\w.-]", "_", name)))
+                p = multiprocessing.Process(target=_worker,
+                    args=(program_target, target + (self.args,), log_filename,
+                        "w" if attempt == 1 else "a", r"^Error: "))
+                p.start()
+                print("[{}] programming (attempt {}), log: {}".format(name, attempt, log_filename))
+                running[p] = (target, attempt)
+                start.setdefault(target, time.time())
+            multiprocessing.connection.wait([p.sentinel for p in running])
+            for p in list(running):
+                if p.exitcode is not None:
+                    target, attempt = running.pop(p)
+                    success = p.exitcode == 0
+                    if not success and attempt <= self.retries:
+                        print("[{}] failed, retrying".format(_target_name(target)))
+                        pending.append((target, attempt + 1))
+                        continue
+                    duration = time.time() - start[target]
+                    self.results[target] = (success, attempt, duration)
+                    print("[{}] {} in {:.1f}s".format(_target_name(target),
+                        "done" if success else "FAILED", duration))
+        return self.results
+
+    def summary(self):
+        print("")
+        print("{:<16} {:<24} {:<8} {:>8} {:>10}".format("Board", "Cable", "Status", "Attempts", "Time (s)"))
+        print("-"*70)
+        for (board_name, cable), (success, attempts, duration) in self.results.items():
+            print("{:<16} {:<24} {:<8} {:>8} {:>10.1f}".format(board_name, str(cable),
+                "pass" if success else "FAIL", attempts, duration))
+
+def parse_target(s):
+    board_name, _, cable = s.partition(":")
+    return (board_name.lower().replace(" ", "_"), cable or None)
+
 # Main ---------------------------------------------------------------------------------------------
 
 supported_boards = {
@@ -198,74 +644,92 @@ def main():
     for name in supported_boards.keys():
         description += "- " + name + "\n"
     parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("--board", required=True, help="FPGA board")
+    parser.add_argument("--board", help="FPGA board")
     parser.add_argument("--build", action="store_true", help="build bitstream")
     parser.add_argument("--load", action="store_true", help="load bitstream (to SRAM)")
     parser.add_argument("--flash", action="store_true", help="flash bitstream/images (to SPI Flash)")
+    parser.add_argument("--flash-force", action="store_true", help="flash all regions, even unchanged ones")
+    parser.add_argument("--flash-sectors", action="store_true", help="only flash changed sectors of changed regions")
+    parser.add_argument("--flash-layout", default="fixed", choices=["fixed", "packed"], help="SPI Flash layout of Linux images (packed: from actual image sizes)")
+    parser.add_argument("--flash-compress-rootfs", action="store_true", help="store gzip-compressed rootfs in SPI Flash")
+    parser.add_argument("--flash-rootfs", default=None, choices=flash_rootfs_types, help="rootfs mounted by Linux from SPI Flash instead of a RAM-copied initramfs")
+    parser.add_argument("--spiflash-dummy", type=int, default=11, help="SPI Flash memory-mapped reads dummy cycles")
+    parser.add_argument("--spiflash-div", type=int, default=2, help="SPI Flash memory-mapped reads clock divider")
     parser.add_argument("--local-ip", default="192.168.1.50", help="local IP address")
     parser.add_argument("--remote-ip", default="192.168.1.100", help="remote IP address of TFTP server")
+    parser.add_argument("--uart-baudrate", type=float, default=1e6, help="UART baudrate")
     parser.add_argument("--spi-bpw", type=int, default=8, help="Bits per word for SPI controller")
     parser.add_argument("--spi-sck-freq", type=int, default=1e6, help="SPI clock frequency")
+    parser.add_argument("--with-mtime", action="store_true", help="add memory-mapped time counter (trap-less Linux clocksource)")
+    parser.add_argument("--ethmac-rx-slots", type=int, default=2, help="Ethernet MAC Rx slots")
+    parser.add_argument("--ethmac-tx-slots", type=int, default=2, help="Ethernet MAC Tx slots")
+    parser.add_argument("--ethmac-slot-size", type=lambda x: int(x, 0), default=0x800, help="Ethernet MAC slot size (DMA only)")
+    parser.add_argument("--ethmac-dma", action="store_true", help="Ethernet MAC with Rx/Tx slots in main_ram (DMA)")
+    parser.add_argument("--csr-data-width", type=int, default=8, choices=[8, 32], help="CSR data width (32: one bus access per CSR up to 32-bit)")
+    parser.add_argument("--emulator-trap-stats", action="store_true", help="enable machine mode emulator trap statistics")
+    parser.add_argument("--emulator-csr-bench", action="store_true", help="run CSR accesses (UART, timer) benchmark before booting Linux")
+    parser.add_argument("--jobs", type=int, default=1, help="number of boards built in parallel")
+    parser.add_argument("--toolchain-jobs", default="", help="per-toolchain parallel build limits (ex: vivado=2,trellis=4)")
+    parser.add_argument("--log-dir", default="build/logs", help="per-board build logs directory (multi-board builds)")
+    parser.add_argument("--target", action="append", default=[], help="board to program with its JTAG cable serial/USB location (ex: arty:210319A8E2B0), can be repeated")
+    parser.add_argument("--program-jobs", type=int, default=4, help="number of targets programmed in parallel")
+    parser.add_argument("--program-retries", type=int, default=2, help="retries on programming failures")
+    parser.add_argument("--build-cache-dir", default="build/cache", help="gateware build cache directory")
+    parser.add_argument("--no-build-cache", action="store_true", help="disable gateware build cache")
     args = parser.parse_args()
 
+    if args.target:
+        farm = ProgramFarm(args,
+            jobs    = args.program_jobs,
+            retries = args.program_retries,
+            log_dir = os.path.join(args.log_dir, "prog"))
+        results = farm.run([parse_target(target) for target in args.target])
+        farm.summary()
+        if not all(success for success, _, _ in results.values()):
+            sys.exit(1)
+        return
+
+    if args.board is None:
+        parser.error("--board or --target required")
+
     if args.board == "all":
         board_names = list(supported_boards.keys())
     else:
         args.board = args.board.lower()
         args.board = args.board.replace(" ", "_")
         board_names = [args.board]
-    for board_name in board_names:
-        board = supported_boards[board_name]()
-        soc_kwargs = {}
-        if board_name in ["versa_ecp5", "ulx3s"]:
-            soc_kwargs["toolchain"] = "trellis"
-            soc_kwargs["cpu_variant"] = "linux+no-dsp"
-        if board_name in ["de0nano"]:
-            soc_kwargs["l2_size"] = 1024 # FIXME: Reduce l2_size, blockram not infered correctly?
-        soc = SoCLinux(board.soc_cls, **soc_kwargs)
-        if "spiflash" in board.soc_capabilities:
-            soc.add_spi_flash()
-            soc.add_constant("SPIFLASH_PAGE_SIZE", board.SPIFLASH_PAGE_SIZE)
-            soc.add_constant("SPIFLASH_SECTOR_SIZE", board.SPIFLASH_SECTOR_SIZE)
-        if "ethernet" in board.soc_capabilities:
-            soc.configure_ethernet(local_ip=args.local_ip, remote_ip=args.remote_ip)
-        if "leds" in board.soc_capabilities:
-            soc.add_leds()
-        if "rgb_led" in board.soc_capabilities:
-            soc.add_rgb_led()
-        if "switches" in board.soc_capabilities:
-            soc.add_switches()
-        if "spi" in board.soc_capabilities:
-            soc.add_spi(args.spi_bpw, args.spi_sck_freq)
-        if "i2c" in board.soc_capabilities:
-            soc.add_i2c()
-        if "xadc" in board.soc_capabilities:
-            soc.add_xadc()
-        if "framebuffer" in board.soc_capabilities:
-            soc.add_framebuffer()
-        if "icap_bit" in board.soc_capabilities:
-            soc.add_icap_bitstream()
-        soc.configure_boot()
-
-        build_dir = os.path.join("build", board_name)
-        if args.build:
-            builder = Builder(soc, output_dir=build_dir,
-                csr_json=os.path.join(build_dir, "csr.json"))
-        else:
-            builder = Builder(soc, output_dir="build/" + board_name,
-                compile_software=True, compile_gateware=False,
-                csr_json=os.path.join(build_dir, "csr.json"))
-        builder.build()
 
-        soc.generate_dts(board_name)
-        soc.compile_dts(board_name)
-        soc.compile_emulator(board_name)
+    # The DTB/emulator images are shared by the boards (last board built): load/flash single boards
+    # (--target to program several boards).
+    if len(board_names) > 1 and (args.load or args.flash):
+        parser.error("--load/--flash require a single --board (use --target to program several boards)")
 
+    cache = None if args.no_build_cache else BuildCache(args.build_cache_dir)
+
+    if len(board_names) == 1:
+        boards = {board_names[0]: build_board(board_names[0], args, cache=cache)}
+    else:
+        scheduler = BuildScheduler(args,
+            jobs           = args.jobs,
+            toolchain_jobs = parse_toolchain_jobs(args.toolchain_jobs),
+            log_dir        = args.log_dir,
+            cache          = cache)
+        results = scheduler.run(board_names)
+        scheduler.summary()
+        boards = {name: supported_boards[name]() for name, (success, _) in results.items() if success}
+
+    if args.build and cache is not None:
+        cache.summary()
+
+    for board_name, board in boards.items():
         if args.load:
             board.load()
 
         if args.flash:
-            board.flash()
+            board.flash(force=args.flash_force, sectors=args.flash_sectors)
+
+    if len(boards) != len(board_names):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
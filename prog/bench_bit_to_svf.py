@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import time
+import argparse
+import textwrap
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bit_to_svf
+
+# Benchmark of bit_to_svf against the previous per-byte converter on a synthetic bitstream
+
+def legacy_write_svf(bs, svf):
+    def bitreverse(x):
+        y = 0
+        for i in range(8):
+            if (x >> (7 - i)) & 1 == 1:
+                y |= (1 << i)
+        return y
+
+    idcode_cmd = bytes([0xE2, 0x00, 0x00, 0x00])
+    idcode = None
+    for i in range(len(bs) - 4):
+        if bs[i:i+4] == idcode_cmd:
+            idcode = bs[i+4] << 24
+            idcode |= bs[i+5] << 16
+            idcode |= bs[i+6] << 8
+            idcode |= bs[i+7]
+            break
+    print(bit_to_svf.svf_header, file=svf)
+    print(bit_to_svf.svf_idcode.format(idcode), file=svf)
+    print(bit_to_svf.svf_init, file=svf)
+    bitf = io.BytesIO(bs)
+    while True:
+        chunk = bitf.read(bit_to_svf.max_row_size//8)
+        if not chunk:
+            break
+        br_chunk = [bitreverse(x) for x in chunk]
+        hex_chunk = ["{:02X}".format(x) for x in reversed(br_chunk)]
+        print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(chunk), "".join(hex_chunk)), 100)), file=svf)
+    print(bit_to_svf.svf_footer, file=svf)
+
+def synthetic_bitstream(size):
+    # ECP5-like preamble followed by VERIFY_ID command and IDCODE (LFE5U-45F), then random data.
+    header = bytes([0xFF, 0xFF, 0xBD, 0xB3]) + bytes([0xE2, 0x00, 0x00, 0x00, 0x41, 0x11, 0x20, 0x43])
+    return header + os.urandom(size - len(header))
+
+def main():
+    parser = argparse.ArgumentParser(description="bit_to_svf benchmark")
+    parser.add_argument("--size", type=float, default=4, help="synthetic bitstream size (MB)")
+    args = parser.parse_args()
+
+    bs = synthetic_bitstream(int(args.size*1024*1024))
+
+    results = {}
+    for name, write_svf in [("legacy", legacy_write_svf), ("bit_to_svf", bit_to_svf.write_svf)]:
+        svf = io.StringIO()
+        start = time.perf_counter()
+        write_svf(bs, svf)
+        results[name] = (time.perf_counter() - start, svf.getvalue())
+        print("{:<12} {:8.3f}s".format(name, results[name][0]))
+
+    assert results["legacy"][1] == results["bit_to_svf"][1], "SVF outputs differ"
+    print("Outputs identical, speedup: {:.1f}x".format(results["legacy"][0]/results["bit_to_svf"][0]))
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,16 @@
 #!/usr/bin/env python3
 
 import sys
-import textwrap
 
 # Very basic bitstream to SVF converter, tested with the ULX3S WiFi interface
 
 max_row_size = 8000 # needed for ULX3S Wifi
+max_line_size = 100
 
+# Bit-reversal table: bytes.translate(bitreverse_table) bit-reverses every byte of a chunk.
+bitreverse_table = bytes(int("{:08b}".format(x)[::-1], 2) for x in range(256))
 
-def bitreverse(x):
-    y = 0
-    for i in range(8):
-        if (x >> (7 - i)) & 1 == 1:
-            y |= (1 << i)
-    return y
-
-with open(sys.argv[1], 'rb') as bitf:
-    bs = bitf.read()
-    # Autodetect IDCODE from bitstream
-    idcode_cmd = bytes([0xE2, 0x00, 0x00, 0x00])
-    idcode = None
-    for i in range(len(bs) - 4):
-        if bs[i:i+4] == idcode_cmd:
-            idcode = bs[i+4] << 24
-            idcode |= bs[i+5] << 16
-            idcode |= bs[i+6] << 8
-            idcode |= bs[i+7]
-            break
-    if idcode is None:
-        print("Failed to find IDCODE in bitstream, check bitstream is valid")
-        sys.exit(1)
-    print("IDCODE in bitstream is 0x%08x" % idcode)
-    bitf.seek(0)
-    with open(sys.argv[2], 'w') as svf:
-        print("""
+svf_header = """
 HDR	0;
 HIR	0;
 TDR	0;
@@ -41,14 +18,16 @@ TIR	0;
 ENDDR	DRPAUSE;
 ENDIR	IRPAUSE;
 STATE	IDLE;
-        """, file=svf)
-        print("""
+        """
+
+svf_idcode = """
 SIR	8	TDI  (E0);
 SDR	32	TDI  (00000000)
         TDO  ({:08X})
         MASK (FFFFFFFF);
-        """.format(idcode), file=svf)
-        print("""
+        """
+
+svf_init = """
 SIR	8	TDI  (1C);
 SDR	510	TDI  (3FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
              FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF);
@@ -69,17 +48,9 @@ RUNTEST	IDLE	2 TCK	1.00E-02 SEC;
 SIR	8	TDI  (7A);
 RUNTEST	IDLE	2 TCK	1.00E-02 SEC;
 
-        """, file=svf)
-        while True:
-            chunk = bitf.read(max_row_size//8)
-            if not chunk:
-                break
-            # Convert chunk to bit-reversed hex
-            br_chunk = [bitreverse(x) for x in chunk]
-            hex_chunk = ["{:02X}".format(x) for x in reversed(br_chunk)]
-            print("\n".join(textwrap.wrap("SDR {} TDI ({});".format(8*len(chunk), "".join(hex_chunk)), 100)), file=svf)
-
-        print("""
+        """
+
+svf_footer = """
 SIR	8	TDI  (FF);
 RUNTEST	IDLE	100 TCK	1.00E-02 SEC;
 
@@ -102,4 +73,53 @@ SIR	8	TDI  (3C);
 SDR	32	TDI  (00000000)
         TDO  (00000100)
         MASK (00002100);
-        """, file=svf)
+        """
+
+def find_idcode(bs):
+    # Autodetect IDCODE from bitstream
+    i = bs.find(bytes([0xE2, 0x00, 0x00, 0x00]))
+    if i < 0 or i + 8 > len(bs):
+        return None
+    return int.from_bytes(bs[i+4:i+8], "big")
+
+def write_svf(bs, svf, idcode=None):
+    """Write SVF programming sequence of bitstream `bs` to file object `svf`, returns IDCODE."""
+    if idcode is None:
+        idcode = find_idcode(bs)
+    if idcode is None:
+        raise ValueError("Failed to find IDCODE in bitstream, check bitstream is valid")
+    svf.write(svf_header + "\n")
+    svf.write(svf_idcode.format(idcode) + "\n")
+    svf.write(svf_init + "\n")
+    bs = memoryview(bs)
+    chunk_size = max_row_size//8
+    for offset in range(0, len(bs), chunk_size):
+        chunk = bs[offset:offset+chunk_size]
+        # Convert chunk to bit-reversed hex (last byte first)
+        row = "SDR {} TDI ({});".format(8*len(chunk),
+            bytes(chunk).translate(bitreverse_table)[::-1].hex().upper())
+        svf.write("\n".join(row[i:i+max_line_size] for i in range(0, len(row), max_line_size)) + "\n")
+    svf.write(svf_footer + "\n")
+    return idcode
+
+def bit_to_svf(bit_filename, svf_filename):
+    """Convert bitstream file to SVF file, returns IDCODE."""
+    with open(bit_filename, "rb") as bitf:
+        bs = bitf.read()
+    idcode = find_idcode(bs)
+    if idcode is None:
+        raise ValueError("Failed to find IDCODE in bitstream, check bitstream is valid")
+    with open(svf_filename, "w", buffering=1 << 20) as svf:
+        write_svf(bs, svf, idcode)
+    return idcode
+
+def main():
+    try:
+        idcode = bit_to_svf(sys.argv[1], sys.argv[2])
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print("IDCODE in bitstream is 0x%08x" % idcode)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import json
+import time
+import zlib
+import struct
+import binascii
+import argparse
+
+import serial
+
+from flash_layout import compress_rootfs
+
+# Serial Flash Loader (SFL) protocol of the LiteX BIOS ---------------------------------------------
+
+sfl_magic_req      = b"sL5DdSMmkekro\n"
+sfl_magic_ack      = b"z6IHG7cYDID6o\n"
+sfl_payload_length = 251
+
+sfl_cmd_abort = 0x00
+sfl_cmd_load  = 0x01
+sfl_cmd_jump  = 0x02
+
+sfl_ack_success  = b"K"
+sfl_ack_crcerror = b"C"
+
+bios_prompt = re.compile(rb"BIOS>\s*$")
+
+def crc16(data):
+    # CRC-16/XMODEM (CCITT polynomial 0x1021, init 0), as in the BIOS.
+    return binascii.crc_hqx(data, 0)
+
+def sfl_frame(cmd, payload):
+    return bytes([len(payload)]) + crc16(bytes([cmd]) + payload).to_bytes(2, "big") + bytes([cmd]) + payload
+
+# DTB patching -------------------------------------------------------------------------------------
+
+def patch_initrd_end(dtb, initrd_end):
+    """Set /chosen linux,initrd-end of a flattened device tree (32-bit cell) to initrd_end."""
+    dtb = bytearray(dtb)
+    magic, totalsize, off_struct, off_strings = struct.unpack(">IIII", dtb[:16])
+    assert magic == 0xd00dfeed, "Invalid DTB"
+    depth = 0
+    chosen_depth = None
+    offset = off_struct
+    while True:
+        token, = struct.unpack(">I", dtb[offset:offset+4])
+        offset += 4
+        if token == 1: # FDT_BEGIN_NODE
+            end = dtb.index(b"\x00", offset)
+            name = dtb[offset:end].decode()
+            depth += 1
+            if depth == 2 and name == "chosen":
+                chosen_depth = depth
+            offset = (end + 1 + 3) & ~3
+        elif token == 2: # FDT_END_NODE
+            if chosen_depth == depth:
+                chosen_depth = None
+            depth -= 1
+        elif token == 3: # FDT_PROP
+            length, nameoff = struct.unpack(">II", dtb[offset:offset+8])
+            offset += 8
+            name_start = off_strings + nameoff
+            name = dtb[name_start:dtb.index(b"\x00", name_start)].decode()
+            if chosen_depth is not None and name == "linux,initrd-end" and length == 4:
+                dtb[offset:offset+4] = struct.pack(">I", initrd_end)
+                return bytes(dtb)
+            offset = (offset + length + 3) & ~3
+        elif token == 4: # FDT_NOP
+            pass
+        else: # FDT_END
+            raise ValueError("linux,initrd-end not found in DTB")
+
+# Serial Boot --------------------------------------------------------------------------------------
+
+class SerialBoot:
+    """Loads Linux images to RAM through the LiteX BIOS over serial.
+
+    Images already in RAM (same CRC32 as reported by the BIOS "crc" command, for example after a
+    failed boot) are skipped, transfers are CRC-checked with retransmission of corrupted frames and the
+    rootfs can be sent gzip-compressed (unpacked by the kernel, the DTB initrd end is patched to match).
+    """
+    def __init__(self, port, baudrate, timeout=5):
+        self.port    = serial.serial_for_url(port, baudrate, timeout=0.05)
+        self.timeout = timeout
+
+    def read_until(self, pattern, timeout=None):
+        data = b""
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        while time.time() < deadline:
+            data += self.port.read(self.port.in_waiting or 1)
+            if pattern.search(data) if hasattr(pattern, "search") else pattern in data:
+                return data
+        raise TimeoutError("Timeout waiting for {}".format(pattern))
+
+    def wait_bios(self, timeout):
+        """Wait for BIOS prompt (returns "prompt") or for the serial boot request (returns "sfl")."""
+        data = b""
+        deadline = time.time() + timeout
+        next_enter = 0
+        while time.time() < deadline:
+            if time.time() > next_enter:
+                self.port.write(b"\n")
+                next_enter = time.time() + 1
+            data += self.port.read(self.port.in_waiting or 1)
+            if sfl_magic_req in data:
+                return "sfl"
+            if bios_prompt.search(data):
+                return "prompt"
+        raise TimeoutError("No BIOS prompt, reset the board")
+
+    def bios_crc(self, address, length):
+        self.port.reset_input_buffer()
+        self.port.write("crc 0x{:08x} {}\n".format(address, length).encode())
+        r = self.read_until(bios_prompt, timeout=self.timeout + length/1e6)
+        m = re.search(rb"CRC32:\s*([0-9a-fA-F]+)", r)
+        return int(m.group(1), 16) if m is not None else None
+
+    def read_reply(self):
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            reply = self.port.read(1)
+            if reply:
+                return reply
+        raise TimeoutError("Timeout waiting for SFL reply")
+
+    def send_frame(self, cmd, payload, retries=8):
+        frame = sfl_frame(cmd, payload)
+        for i in range(retries):
+            self.port.write(frame)
+            reply = self.read_reply()
+            if reply == sfl_ack_success:
+                return
+            if reply != sfl_ack_crcerror:
+                break
+        raise IOError("SFL frame error (reply {})".format(reply))
+
+    def load(self, images, bios_timeout=30):
+        """Load images ({address: data}, boot address last) and jump to the boot address."""
+        mode = self.wait_bios(bios_timeout)
+        skipped = 0
+        if mode == "prompt":
+            for address, data in list(images.items()):
+                if self.bios_crc(address, len(data)) == zlib.crc32(data):
+                    print("0x{:08x}: {} bytes already in RAM, skipped".format(address, len(data)))
+                    skipped += len(data)
+                    images[address] = None
+            self.port.write(b"serialboot\n")
+            self.read_until(sfl_magic_req)
+        self.port.write(sfl_magic_ack)
+
+        sent = 0
+        start = time.time()
+        for address, data in images.items():
+            if data is None:
+                continue
+            print("0x{:08x}: sending {} bytes".format(address, len(data)))
+            chunk_length = sfl_payload_length - 4
+            for offset in range(0, len(data), chunk_length):
+                self.send_frame(sfl_cmd_load,
+                    (address + offset).to_bytes(4, "big") + data[offset:offset+chunk_length])
+            sent += len(data)
+        duration = time.time() - start
+        self.send_frame(sfl_cmd_jump, list(images.keys())[-1].to_bytes(4, "big"))
+        print("Sent {} bytes in {:.1f}s ({:.1f} KB/s effective), skipped {} bytes".format(
+            sent, duration, sent/max(duration, 1e-3)/1e3, skipped))
+
+def load_images(images_json, compress=False):
+    with open(images_json) as f:
+        images_addresses = json.load(f)
+    images = {}
+    rootfs_address = rootfs_size = None
+    dtb_address = None
+    for filename, address in images_addresses.items():
+        address = int(address, 0)
+        if compress and filename.endswith(".cpio"):
+            filename = compress_rootfs(filename)
+            rootfs_address = address
+        if filename.endswith(".dtb"):
+            dtb_address = address
+        with open(filename, "rb") as f:
+            images[address] = f.read()
+        if address == rootfs_address:
+            rootfs_size = len(images[address])
+    if rootfs_size is not None and dtb_address is not None:
+        images[dtb_address] = patch_initrd_end(images[dtb_address], rootfs_address + rootfs_size)
+    return images
+
+def main():
+    parser = argparse.ArgumentParser(description="Linux on LiteX-VexRiscv serial images loader")
+    parser.add_argument("port", help="serial port")
+    parser.add_argument("--images", default="images.json", help="images JSON file (filename: RAM address)")
+    parser.add_argument("--speed", type=float, default=1e6, help="serial baudrate (must match --uart-baudrate of the SoC)")
+    parser.add_argument("--compress", action="store_true", help="send gzip-compressed rootfs")
+    parser.add_argument("--timeout", type=float, default=30, help="BIOS prompt timeout (s)")
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.compress)
+    sb = SerialBoot(args.port, int(args.speed))
+    try:
+        sb.load(images, bios_timeout=args.timeout)
+    except (IOError, TimeoutError) as e:
+        print(e)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
+import os
+import gzip
+import json
+import time
+import shutil
+import subprocess
+import struct
+import hashlib
 import argparse
 
 from migen import *
+from migen.fhdl.specials import Special, SPECIAL_INPUT
+from migen.fhdl.verilog import _printexpr as verilog_printexpr
 from migen.genlib.io import CRG
 from migen.genlib.misc import timeline
 
@@ -19,7 +29,10 @@ from litex.soc.cores import uart
 
 from liteeth.common import convert_ip
 from liteeth.phy.model import LiteEthPHYModel
-from liteeth.core.mac import LiteEthMAC
+
+import json2dts
+import soc_linux
+from soc_linux import MTime, liteeth_mac
 
 
 class SimPins(Pins):
@@ -65,11 +78,199 @@ class Platform(SimPlatform):
         pass
 
 
+class MemoryDump(Special):
+    """Dumps a memory to a $readmemh file (loadable as the memory init file) when trigger is asserted."""
+    def __init__(self, memory, trigger, filename):
+        Special.__init__(self)
+        self.memory   = memory
+        self.trigger  = wrap(trigger)
+        self.clk      = ClockSignal()
+        self.filename = filename
+
+    def iter_expressions(self):
+        for attr in ["trigger", "clk"]:
+            yield self, attr, SPECIAL_INPUT
+
+    @staticmethod
+    def emit_verilog(dump, ns, add_data_file):
+        r  = "always @(posedge " + verilog_printexpr(ns, dump.clk)[0] + ") begin\n"
+        r += "\tif (" + verilog_printexpr(ns, dump.trigger)[0] + ")\n"
+        r += "\t\t$writememh(\"" + dump.filename + "\", " + ns.get_name(dump.memory) + ");\n"
+        r += "end\n\n"
+        return r
+
+
+class CyclesDump(Special):
+    """Writes the cycles count to a file every 2**log2_period cycles and when trigger is asserted."""
+    def __init__(self, cycles, trigger, filename, log2_period=20):
+        Special.__init__(self)
+        self.cycles      = wrap(cycles)
+        self.trigger     = wrap(trigger)
+        self.clk         = ClockSignal()
+        self.filename    = filename
+        self.log2_period = log2_period
+
+    def iter_expressions(self):
+        for attr in ["cycles", "trigger", "clk"]:
+            yield self, attr, SPECIAL_INPUT
+
+    @staticmethod
+    def emit_verilog(dump, ns, add_data_file):
+        cycles = verilog_printexpr(ns, dump.cycles)[0]
+        r  = "integer cycles_dump_file;\n"
+        r += "always @(posedge " + verilog_printexpr(ns, dump.clk)[0] + ") begin\n"
+        r += "\tif ((" + cycles + "[" + str(dump.log2_period - 1) + ":0] == 0) | "
+        r += verilog_printexpr(ns, dump.trigger)[0] + ") begin\n"
+        r += "\t\tcycles_dump_file = $fopen(\"" + dump.filename + "\", \"w\");\n"
+        r += "\t\t$fwrite(cycles_dump_file, \"%0d\\n\", " + cycles + ");\n"
+        r += "\t\t$fclose(cycles_dump_file);\n"
+        r += "\tend\n"
+        r += "end\n\n"
+        return r
+
+
+class TraceWriter(Special):
+    """Writes "<cycle> <data>" trace lines to a file: data when write is asserted and, on dump, the valid
+    entries (valid, data, cycle) of the ring buffer memory, oldest (at ring_ptr) first."""
+    def __init__(self, cycles, data, write, flush, filename, ring=None, ring_ptr=None, dump=None):
+        Special.__init__(self)
+        self.cycles   = wrap(cycles)
+        self.data     = wrap(data)
+        self.write    = wrap(write)
+        self.flush    = wrap(flush)
+        self.clk      = ClockSignal()
+        self.filename = filename
+        self.ring     = ring
+        if ring is not None:
+            self.ring_ptr = wrap(ring_ptr)
+            self.dump     = wrap(dump)
+
+    def iter_expressions(self):
+        attrs = ["cycles", "data", "write", "flush", "clk"]
+        if self.ring is not None:
+            attrs += ["ring_ptr", "dump"]
+        for attr in attrs:
+            yield self, attr, SPECIAL_INPUT
+
+    @staticmethod
+    def emit_verilog(writer, ns, add_data_file):
+        pe = lambda e: verilog_printexpr(ns, e)[0]
+        r  = "integer trace_file;\n"
+        r += "initial trace_file = $fopen(\"" + writer.filename + "\", \"w\");\n"
+        if writer.ring is not None:
+            ring  = ns.get_name(writer.ring)
+            depth = writer.ring.depth
+            dw    = len(writer.data)
+            r += "integer trace_ring_i;\n"
+            r += "reg [" + str(writer.ring.width - 1) + ":0] trace_ring_entry;\n"
+        r += "always @(posedge " + pe(writer.clk) + ") begin\n"
+        if writer.ring is not None:
+            r += "\tif (" + pe(writer.dump) + ") begin\n"
+            r += "\t\tfor (trace_ring_i = 0; trace_ring_i < " + str(depth) + "; trace_ring_i = trace_ring_i + 1) begin\n"
+            r += "\t\t\ttrace_ring_entry = " + ring + "[(" + pe(writer.ring_ptr) + " + trace_ring_i) % " + str(depth) + "];\n"
+            r += "\t\t\tif (trace_ring_entry[" + str(dw + 64) + "])\n"
+            r += "\t\t\t\t$fwrite(trace_file, \"%0d %h\\n\", trace_ring_entry[63:0], trace_ring_entry[" + str(dw + 63) + ":64]);\n"
+            r += "\t\tend\n"
+            r += "\tend\n"
+        r += "\tif (" + pe(writer.write) + ")\n"
+        r += "\t\t$fwrite(trace_file, \"%0d %h\\n\", " + pe(writer.cycles) + ", " + pe(writer.data) + ");\n"
+        r += "\tif (" + pe(writer.flush) + ")\n"
+        r += "\t\t$fflush(trace_file);\n"
+        r += "end\n\n"
+        return r
+
+
+class TraceRecorder(Module):
+    """Records the probes ([(name, signal)]) value changes from a trigger to a trace file, converted to
+    VCD/FST after the run (see write_trace).
+
+    Recording lasts length cycles (until stop if 0). With depth (power of 2), the probes are also kept in
+    a ring buffer of the last depth cycles, dumped on trigger: the trace then starts before the trigger.
+    """
+    def __init__(self, probes, trigger, stop, depth=0, length=0, filename="sim.trace"):
+        self.probes = probes
+        data = Cat(*[signal for _, signal in probes])
+
+        # # #
+
+        cycles    = Signal(64)
+        armed     = Signal(reset=1)
+        active    = Signal()
+        start     = Signal()
+        remaining = Signal(64)
+        last      = Signal(len(data))
+        write     = Signal()
+        flush     = Signal()
+        self.sync += cycles.eq(cycles + 1)
+        self.comb += start.eq(armed & trigger)
+        done = stop
+        if length:
+            done = stop | (remaining == 0)
+        self.sync += [
+            last.eq(data),
+            If(start,
+                armed.eq(0),
+                active.eq(1),
+                remaining.eq(max(length - 1, 0))
+            ).Elif(active,
+                remaining.eq(remaining - 1),
+                If(done,
+                    active.eq(0)
+                )
+            )
+        ]
+        self.comb += [
+            write.eq(start | (active & (data != last))),
+            flush.eq((active & ((cycles[:16] == 0) | done)) | start)
+        ]
+
+        if depth:
+            ring     = Memory(1 + len(data) + 64, depth)
+            ring_ptr = Signal(max=depth)
+            port     = ring.get_port(write_capable=True)
+            self.specials += ring, port
+            self.comb += [
+                port.adr.eq(ring_ptr),
+                port.dat_w.eq(Cat(cycles, data, 1)),
+                port.we.eq(armed & ~trigger)
+            ]
+            self.sync += If(armed & ~trigger, ring_ptr.eq(ring_ptr + 1))
+            self.specials += TraceWriter(cycles, data, write, flush, filename, ring, ring_ptr, start)
+        else:
+            self.specials += TraceWriter(cycles, data, write, flush, filename)
+
+
 class Supervisor(Module, AutoCSR):
     def __init__(self):
         self._finish  = CSR()  # controlled from CPU
+        self._snapshot = CSR() # controlled from CPU (machine mode emulator, see sim_snapshot_save)
+        self._trace    = CSR() # controlled from CPU (write 1/0 to start/stop tracing, see sim_trace)
         self.finish = Signal() # controlled from logic
-        self.sync += If(self._finish.re | self.finish, Finish())
+        finish = Signal()
+        self.comb += finish.eq(self._finish.re | self.finish)
+        self.sync += If(finish, Finish())
+
+        # simulated cycles, for the simulation speed report (see sim_speed_report)
+        self.cycles = cycles = Signal(64)
+        self.sync += cycles.eq(cycles + 1)
+        self.specials += CyclesDump(cycles, finish, "sim.cycles")
+
+    def add_trace(self, probes, trigger=None, depth=0, length=0):
+        """Record the probes from the trigger (default: trace CSR write of 1) to a trace file."""
+        start = Signal()
+        stop  = Signal()
+        self.comb += [
+            start.eq(self._trace.re & self._trace.r[0]),
+            stop.eq(self._trace.re & ~self._trace.r[0])
+        ]
+        if trigger is not None:
+            start = trigger
+        self.submodules.trace = TraceRecorder(probes, start, stop, depth, length)
+
+    def add_snapshot(self, memories):
+        """Dump the memories to <name>.snapshot files on a snapshot request of the CPU."""
+        for memory in memories:
+            self.specials += MemoryDump(memory, self._snapshot.re, memory.name_override + ".snapshot")
 
 
 class SoCLinux(SoCCore):
@@ -77,6 +278,7 @@ class SoCLinux(SoCCore):
         "ctrl":       0,
         "uart":       2,
         "timer0":     3,
+        "supervisor": 31, # fixed address for sim_trace (rootfs overlay)
     })
     SoCCore.interrupt_map.update({
         "uart":       0,
@@ -88,10 +290,12 @@ class SoCLinux(SoCCore):
         "emulator_ram": 0x20000000,
         "ethmac":       0xb0000000,
         "main_ram":     0xc0000000,
+        "mtime":        0xe0000000,
         "csr":          0xf0000000,
     }
 
-    def __init__(self, init_memories=False, with_ethernet=False):
+    def __init__(self, with_ethernet=False, with_mtime=False,
+        ethmac_rx_slots=2, ethmac_tx_slots=2, ethmac_slot_size=0x800, ethmac_dma=False, csr_data_width=8):
         platform = Platform()
         sys_clk_freq = int(1e6)
         SoCCore.__init__(self, platform, clk_freq=sys_clk_freq,
@@ -99,11 +303,9 @@ class SoCLinux(SoCCore):
             with_uart=False,
             integrated_rom_size=0x8000,
             integrated_main_ram_size=0x02000000, # 32MB
-            integrated_main_ram_init=get_mem_data({
-                "buildroot/Image":         "0x00000000",
-                "buildroot/rootfs.cpio":   "0x00800000",
-                "buildroot/rv32.dtb":      "0x01000000"
-                }, "little") if init_memories else [])
+            integrated_main_ram_init=[0],
+            csr_data_width=csr_data_width)
+        self.config["CSR_DATA_WIDTH"] = csr_data_width # for json2dts/emulator
         self.add_constant("SIM", None)
 
         # supervisor
@@ -114,11 +316,16 @@ class SoCLinux(SoCCore):
         self.submodules.crg = CRG(platform.request("sys_clk"))
 
         # machine mode emulator ram
-        emulator_rom = get_mem_data("emulator/emulator.bin", "little") if init_memories else []
-        self.submodules.emulator_ram = wishbone.SRAM(0x4000, init=emulator_rom)
+        self.submodules.emulator_ram = wishbone.SRAM(0x4000, init=[0])
         self.register_mem("emulator_ram", self.mem_map["emulator_ram"], self.emulator_ram.bus, 0x4000)
         self.add_constant("ROM_BOOT_ADDRESS",self.mem_map["emulator_ram"])
 
+        # memories, initialized at simulation startup from their init files (see write_memories)
+        self.rom.mem.name_override          = "rom"
+        self.main_ram.mem.name_override     = "main_ram"
+        self.emulator_ram.mem.name_override = "emulator_ram"
+        self.supervisor.add_snapshot([self.main_ram.mem, self.emulator_ram.mem])
+
         # serial
         self.submodules.uart_phy = uart.RS232PHYModel(platform.request("serial"))
         self.submodules.uart = uart.UART(self.uart_phy)
@@ -131,39 +338,236 @@ class SoCLinux(SoCCore):
             self.submodules.ethphy = LiteEthPHYModel(self.platform.request("eth", 0))
             self.add_csr("ethphy")
             # eth mac
-            ethmac = LiteEthMAC(phy=self.ethphy, dw=32,
-                interface="wishbone", endianness=self.cpu.endianness)
+            ethmac = liteeth_mac(ethmac_rx_slots, ethmac_tx_slots, ethmac_slot_size, ethmac_dma)(
+                phy=self.ethphy, dw=32, interface="wishbone", endianness=self.cpu.endianness)
             self.submodules.ethmac = ethmac
             self.add_wb_slave(mem_decoder(self.mem_map["ethmac"]), self.ethmac.bus)
-            self.add_memory_region("ethmac", self.mem_map["ethmac"], 0x2000, type="io")
+            if ethmac_dma:
+                self.add_wb_master(self.ethmac.dma_bus)
+                self.add_memory_region("ethmac", self.mem_map["ethmac"], 0x8, type="io")
+            else:
+                self.add_memory_region("ethmac", self.mem_map["ethmac"],
+                    (ethmac_rx_slots + ethmac_tx_slots)*ethmac_slot_size, type="io")
             self.add_csr("ethmac")
             self.add_interrupt("ethmac")
 
-    def generate_dts(self, board_name):
+        # mtime
+        if with_mtime:
+            self.submodules.mtime = MTime()
+            self.add_wb_slave(mem_decoder(self.mem_map["mtime"]), self.mtime.bus)
+            self.add_memory_region("mtime", self.mem_map["mtime"], 0x8, type="io")
+
+    def trace_probes(self, groups):
+        """Probes ([(name, signal)]) of the trace signal groups."""
+        available = {
+            "ibus":      [("ibus_" + n, getattr(self.cpu.ibus, n)) for n in ["adr", "dat_r", "cyc", "stb", "ack"]],
+            "dbus":      [("dbus_" + n, getattr(self.cpu.dbus, n)) for n in ["adr", "dat_w", "dat_r", "sel", "we", "cyc", "stb", "ack"]],
+            "interrupt": [("interrupt", self.cpu.interrupt)],
+            "uart_tx":   [("uart_tx_" + n, getattr(self.uart_phy.sink, n)) for n in ["valid", "ready", "data"]],
+            "uart_rx":   [("uart_rx_" + n, getattr(self.uart_phy.source, n)) for n in ["valid", "ready", "data"]],
+        }
+        if hasattr(self, "ethphy"):
+            available["eth_tx"] = [("eth_tx_" + n, getattr(self.ethphy.sink, n)) for n in ["valid", "ready", "data", "last"]]
+            available["eth_rx"] = [("eth_rx_" + n, getattr(self.ethphy.source, n)) for n in ["valid", "ready", "data", "last"]]
+        probes = []
+        for group in groups:
+            if group not in available:
+                raise ValueError("Unknown trace signals {} (available: {})".format(group, ", ".join(available.keys())))
+            probes += available[group]
+        return probes
+
+    def trace_trigger(self, trigger):
+        """Trace trigger: supervisor (trace CSR), pc:<address> (instruction fetch on the bus, i.e. on an
+        instruction cache miss), write:<address> (CPU bus write, ex: to a CSR) or cycle:<n>."""
+        if trigger == "supervisor":
+            return None
+        kind, _, value = trigger.partition(":")
+        value = int(value, 0)
+        ibus, dbus = self.cpu.ibus, self.cpu.dbus
+        if kind == "pc":
+            return ibus.cyc & ibus.stb & (ibus.adr == (value >> 2))
+        if kind == "write":
+            return dbus.cyc & dbus.stb & dbus.we & (dbus.adr == (value >> 2))
+        if kind == "cycle":
+            return self.supervisor.cycles == value
+        raise ValueError("Unknown trace trigger {}".format(trigger))
+
+    def add_trace(self, groups, trigger="supervisor", depth=0, length=0):
+        self.supervisor.add_trace(self.trace_probes(groups), self.trace_trigger(trigger), depth, length)
+
+    def write_memories(self, build_dir, restore=False, rootfs="buildroot/rootfs.cpio"):
+        """Write the memories init files, loaded by the simulation at startup.
+
+        With restore, main_ram and emulator_ram are loaded from the snapshot files of a previous run:
+        the BIOS boots the emulator, which resumes Linux from the snapshot state.
+        """
+        gateware_dir = os.path.join(build_dir, "gateware")
+        write_mem_init(os.path.join(gateware_dir, "rom.init"), {
+            os.path.join(build_dir, "software", "bios", "bios.bin"): 0x00000000})
+        if restore:
+            for name in ["main_ram", "emulator_ram"]:
+                shutil.copyfile(os.path.join(gateware_dir, "snapshot", name + ".snapshot"),
+                    os.path.join(gateware_dir, name + ".init"))
+            return
+        write_mem_init(os.path.join(gateware_dir, "main_ram.init"), {
+            "buildroot/Image":                   0x00000000,
+            rootfs:                              0x00800000,
+            os.path.join(build_dir, "rv32.dtb"): 0x01000000})
+        write_mem_init(os.path.join(gateware_dir, "emulator_ram.init"), {
+            os.path.join(build_dir, "emulator.bin"): 0x00000000})
+
+    def gateware_hash(self, build_dir, options):
+        """Hash of the simulation gateware inputs: CSR map, CPU sources, SoC sources and options."""
+        h = hashlib.sha256()
+        h.update(json.dumps(options, sort_keys=True).encode())
+        filenames = [os.path.join(build_dir, "csr.json"), __file__, soc_linux.__file__]
+        filenames += sorted(source[0] for source in self.platform.sources)
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    def generate_dts(self, board_name, initrd_size=None):
         json = os.path.join("build", board_name, "csr.json")
         dts = os.path.join("build", board_name, "{}.dts".format(board_name))
-        os.system("./json2dts.py {} > {}".format(json, dts))
+        json2dts.write_dts(json, dts, initrd_size=initrd_size)
 
     def compile_dts(self, board_name):
         dts = os.path.join("build", board_name, "{}.dts".format(board_name))
-        dtb = os.path.join("buildroot", "rv32.dtb")
-        os.system("dtc -O dtb -o {} {}".format(dtb, dts))
+        dtb = os.path.join("build", board_name, "rv32.dtb")
+        json2dts.compile_dts(dts, dtb)
 
-    def compile_emulator(self, board_name):
+    def compile_emulator(self, board_name, trap_stats=False, unaligned_bench=False, atomic_bench=False,
+        csr_bench=False):
         os.environ["BOARD"] = board_name
+        os.environ["TRAP_STATS"] = "1" if trap_stats else "0"
+        os.environ["UNALIGNED_BENCH"] = "1" if unaligned_bench else "0"
+        os.environ["ATOMIC_BENCH"] = "1" if atomic_bench else "0"
+        os.environ["CSR_BENCH"] = "1" if csr_bench else "0"
         os.system("cd emulator && make")
+        # emulator/ is shared with the other builds: keep this build's emulator
+        shutil.copyfile(os.path.join("emulator", "emulator.bin"), os.path.join("build", board_name, "emulator.bin"))
+
+# Memories init files -----------------------------------------------------------------------------
+
+def write_mem_init(filename, images):
+    """Write a $readmemh init file of the images ({filename: offset}) as little endian 32-bit words."""
+    lines = []
+    for image, offset in images.items():
+        with open(image, "rb") as f:
+            data = f.read()
+        data += bytes(-len(data) % 4)
+        lines.append("@{:x}".format(offset//4))
+        lines += ["{:08x}".format(word) for word, in struct.iter_unpack("<I", data)]
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+# Trace --------------------------------------------------------------------------------------------
+
+def write_trace(trace, probes, filename, period_ns):
+    """Convert a trace file of TraceRecorder ("<cycle> <data>" lines, the probes ([(name, signal)]) values
+    concatenated LSB first) to VCD, gzipped VCD (.vcd.gz) or FST (.fst, with vcd2fst of GTKWave)."""
+    ids = ["".join(chr(33 + (i//94**k) % 94) for k in range(1 + (i >= 94))) for i in range(len(probes))]
+    widths = [len(signal) for _, signal in probes]
+    vcd = filename[:-len(".fst")] + ".vcd" if filename.endswith(".fst") else filename
+    with (gzip.open(vcd, "wt") if vcd.endswith(".gz") else open(vcd, "w")) as f:
+        f.write("$timescale 1ns $end\n")
+        f.write("$scope module sim $end\n")
+        for (name, _), width, id in zip(probes, widths, ids):
+            f.write("$var wire {} {} {} $end\n".format(width, id, name))
+        f.write("$upscope $end\n$enddefinitions $end\n")
+        values = [None]*len(probes)
+        with open(trace) as t:
+            for line in t:
+                cycle, data = line.split()
+                data = int(data, 16)
+                changes = []
+                for i, width in enumerate(widths):
+                    value = data & (2**width - 1)
+                    data >>= width
+                    if value != values[i]:
+                        values[i] = value
+                        if width == 1:
+                            changes.append("{}{}".format(value, ids[i]))
+                        else:
+                            changes.append("b{:b} {}".format(value, ids[i]))
+                if changes:
+                    f.write("#{}\n".format(int(int(cycle)*period_ns)))
+                    f.write("\n".join(changes) + "\n")
+    if filename.endswith(".fst"):
+        subprocess.check_call(["vcd2fst", vcd, filename])
+        os.remove(vcd)
+
+# Simulation speed --------------------------------------------------------------------------------
+
+def sim_speed_report(gateware_dir, duration, sys_clk_freq):
+    """Print the simulated cycles per second of a run (cycles dumped by the simulation, see CyclesDump)."""
+    filename = os.path.join(gateware_dir, "sim.cycles")
+    if not os.path.exists(filename):
+        return
+    with open(filename) as f:
+        cycles = int(f.read())
+    speed = cycles/max(duration, 1e-3)
+    print("Simulated {} cycles in {:.1f}s: {:.0f} cycles/s ({:.2f}x real time at {:.0f}MHz)".format(
+        cycles, duration, speed, speed/sys_clk_freq, sys_clk_freq/1e6))
+
+# Main ---------------------------------------------------------------------------------------------
 
 def main():
     parser = argparse.ArgumentParser(description="Linux on LiteX-VexRiscv Simulation")
     parser.add_argument("--with-ethernet", action="store_true",
                         help="enable Ethernet support")
+    parser.add_argument("--ethmac-rx-slots", type=int, default=2, help="Ethernet MAC Rx slots")
+    parser.add_argument("--ethmac-tx-slots", type=int, default=2, help="Ethernet MAC Tx slots")
+    parser.add_argument("--ethmac-slot-size", type=lambda x: int(x, 0), default=0x800,
+                        help="Ethernet MAC slot size (DMA only)")
+    parser.add_argument("--ethmac-dma", action="store_true",
+                        help="Ethernet MAC with Rx/Tx slots in main_ram (DMA)")
+    parser.add_argument("--with-mtime", action="store_true",
+                        help="enable memory-mapped time counter (trap-less Linux clocksource)")
+    parser.add_argument("--csr-data-width", type=int, default=8, choices=[8, 32],
+                        help="CSR data width (32: one bus access per CSR up to 32-bit)")
     parser.add_argument("--trace", action="store_true", help="enable VCD tracing")
     parser.add_argument("--trace-start", default=0,
                         help="cycle to start VCD tracing")
     parser.add_argument("--trace-end", default=-1,
                         help="cycle to end VCD tracing")
+    parser.add_argument("--trace-signals", default="",
+                        help="record signal groups from a trigger (ex: ibus,dbus,interrupt,uart_tx,uart_rx,eth_tx,eth_rx)")
+    parser.add_argument("--trace-trigger", default="supervisor",
+                        help="recording trigger: supervisor (sim_trace), pc:<address>, write:<address> or cycle:<n>")
+    parser.add_argument("--trace-depth", type=int, default=0,
+                        help="cycles recorded before the trigger (ring buffer, power of 2)")
+    parser.add_argument("--trace-length", type=int, default=0,
+                        help="cycles recorded from the trigger (0: until stopped by sim_trace)")
+    parser.add_argument("--trace-format", default="vcd", choices=["vcd", "vcd.gz", "fst"],
+                        help="recording output format")
     parser.add_argument("--opt-level", default="O3",
                         help="compilation optimization level")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Verilator model threads")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="parallel make jobs for the simulator build")
+    parser.add_argument("--ccache", action="store_true",
+                        help="use ccache for the simulator build (objects reused across rebuilds)")
+    parser.add_argument("--build-name", default="sim",
+                        help="build directory name (build/<name>), to keep several simulator variants")
+    parser.add_argument("--rootfs", default="buildroot/rootfs.cpio",
+                        help="Linux rootfs (initramfs) image")
+    parser.add_argument("--no-run", action="store_true",
+                        help="build the simulator and its memories init files without running it")
+    parser.add_argument("--restore", action="store_true",
+                        help="restore the snapshot of a previous run (sim_snapshot) instead of booting Linux")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="force simulator rebuild (rebuilt only when the gateware changed otherwise)")
+    parser.add_argument("--emulator-trap-stats", action="store_true",
+                        help="enable machine mode emulator trap statistics")
+    parser.add_argument("--emulator-unaligned-bench", action="store_true",
+                        help="run unaligned access emulation benchmark before booting Linux")
+    parser.add_argument("--emulator-atomic-bench", action="store_true",
+                        help="run atomics emulation benchmark before booting Linux")
+    parser.add_argument("--emulator-csr-bench", action="store_true",
+                        help="run CSR accesses (UART, timer) benchmark before booting Linux")
     args = parser.parse_args()
 
     sim_config = SimConfig(default_clk="sys_clk")
@@ -171,24 +575,102 @@ def main():
     if args.with_ethernet:
         sim_config.add_module("ethernet", "eth", args={"interface": "tap0", "ip": "192.168.1.100"})
 
-    for i in range(2):
-        soc = SoCLinux(i!=0, args.with_ethernet)
-        board_name = "sim"
-        build_dir = os.path.join("build", board_name)
-        builder = Builder(soc, output_dir=build_dir,
-            compile_gateware=i!=0,
-            csr_json=os.path.join(build_dir, "csr.json"))
-        builder.build(sim_config=sim_config,
-            run=i!=0,
-            opt_level=args.opt_level,
-            trace=args.trace,
-            trace_start=int(args.trace_start),
-            trace_end=int(args.trace_end))
-        if i == 0:
-            os.chdir("..")
-            soc.generate_dts(board_name)
-            soc.compile_dts(board_name)
-            soc.compile_emulator(board_name)
+    soc = SoCLinux(args.with_ethernet, args.with_mtime,
+        args.ethmac_rx_slots, args.ethmac_tx_slots, args.ethmac_slot_size, args.ethmac_dma,
+        args.csr_data_width)
+    trace_signals = [group for group in args.trace_signals.split(",") if group]
+    if trace_signals:
+        if args.trace_depth & (args.trace_depth - 1):
+            raise SystemExit("--trace-depth must be a power of 2")
+        soc.add_trace(trace_signals, args.trace_trigger, args.trace_depth, args.trace_length)
+    board_name   = args.build_name
+    build_dir    = os.path.join("build", board_name)
+    gateware_dir = os.path.join(build_dir, "gateware")
+    cwd          = os.getcwd()
+
+    # CSR map and software (BIOS)
+    builder = Builder(soc, output_dir=build_dir,
+        compile_gateware=False,
+        csr_json=os.path.join(build_dir, "csr.json"))
+    builder.build(build=False, run=False)
+    os.chdir(cwd)
+
+    # DTB (initrd bounds from the actual rootfs size) and emulator
+    soc.generate_dts(board_name, os.path.getsize(args.rootfs) if os.path.exists(args.rootfs) else None)
+    soc.compile_dts(board_name)
+    soc.compile_emulator(board_name, args.emulator_trap_stats,
+        args.emulator_unaligned_bench, args.emulator_atomic_bench, args.emulator_csr_bench)
+
+    # Simulator, only rebuilt when the gateware changed: the memories contents (BIOS, Linux images, emulator)
+    # are loaded at startup.
+    build_kwargs = dict(
+        threads     = args.threads,
+        opt_level   = args.opt_level,
+        trace       = args.trace,
+        trace_start = int(args.trace_start),
+        trace_end   = int(args.trace_end))
+    stamp_filename = os.path.join(gateware_dir, "sim.stamp")
+    gateware_hash  = soc.gateware_hash(build_dir, dict(build_kwargs,
+        trace_signals=trace_signals, trace_trigger=args.trace_trigger,
+        trace_depth=args.trace_depth, trace_length=args.trace_length))
+    stamp = None
+    if os.path.exists(stamp_filename):
+        with open(stamp_filename) as f:
+            stamp = f.read()
+    if args.rebuild or stamp != gateware_hash or not os.path.exists(os.path.join(gateware_dir, "obj_dir", "Vdut")):
+        if stamp is not None:
+            os.remove(stamp_filename)
+        os.environ["MAKEFLAGS"] = "-j{}".format(args.jobs)
+        if args.ccache:
+            if shutil.which("ccache") is None:
+                raise SystemExit("ccache not found")
+            os.environ["OBJCACHE"] = "ccache" # Verilator makefiles compiler launcher
+        soc.build(build_dir=gateware_dir, sim_config=sim_config, build=True, run=False, **build_kwargs)
+        os.chdir(cwd)
+        with open(stamp_filename, "w") as f:
+            f.write(gateware_hash)
+    else:
+        print("Simulator up to date, skipping build (--rebuild to force it)")
+
+    # Snapshot, only valid for the simulator it was taken with
+    snapshot_dir   = os.path.join(gateware_dir, "snapshot")
+    snapshot_stamp = os.path.join(snapshot_dir, "snapshot.stamp")
+    if args.restore:
+        if args.with_ethernet:
+            raise SystemExit("--restore is not supported with Ethernet (MAC state is not saved)")
+        stamp = None
+        if os.path.exists(snapshot_stamp):
+            with open(snapshot_stamp) as f:
+                stamp = f.read()
+        if stamp != gateware_hash:
+            raise SystemExit("No snapshot for this simulator, run sim_snapshot in a simulation without --restore first")
+
+    soc.write_memories(build_dir, restore=args.restore, rootfs=args.rootfs)
+    if args.no_run:
+        return
+    if os.path.exists(os.path.join(gateware_dir, "sim.cycles")):
+        os.remove(os.path.join(gateware_dir, "sim.cycles"))
+    start = time.time()
+    try:
+        soc.build(build_dir=gateware_dir, sim_config=sim_config, build=False, run=True, **build_kwargs)
+    finally:
+        os.chdir(cwd)
+        sim_speed_report(gateware_dir, time.time() - start, soc.clk_freq)
+        # Recording of --trace-signals
+        trace = os.path.join(gateware_dir, "sim.trace")
+        if trace_signals and os.path.exists(trace) and os.path.getsize(trace):
+            filename = os.path.join(gateware_dir, "sim." + args.trace_format)
+            write_trace(trace, soc.supervisor.trace.probes, filename, 1e9/soc.clk_freq)
+            print("Trace written to {}".format(filename))
+        # Keep the memories dumped by the simulation (sim_snapshot), with the simulator hash.
+        dumps = [os.path.join(gateware_dir, name + ".snapshot") for name in ["main_ram", "emulator_ram"]]
+        if all(os.path.exists(dump) and os.path.getmtime(dump) >= start for dump in dumps):
+            os.makedirs(snapshot_dir, exist_ok=True)
+            for dump in dumps:
+                shutil.move(dump, os.path.join(snapshot_dir, os.path.basename(dump)))
+            with open(snapshot_stamp, "w") as f:
+                f.write(gateware_hash)
+            print("Snapshot saved to {} (./sim.py --restore to resume from it)".format(snapshot_dir))
 
 
 if __name__ == "__main__":
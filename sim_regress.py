@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+# Simulation supervisor finish CSR (CSR bank 31, see sim.py): ends the simulation.
+finish_command = "devmem 0xf000f800 32 1"
+
+# Console ------------------------------------------------------------------------------------------
+
+class Console:
+    """Serial console of a simulation (serial2console on the simulator stdin/stdout)."""
+    def __init__(self, process):
+        self.process   = process
+        self.closed    = False
+        self.data      = ""
+        self.position  = 0
+        self.condition = threading.Condition()
+        self.thread    = threading.Thread(target=self.reader, daemon=True)
+        self.thread.start()
+
+    def reader(self):
+        while True:
+            data = os.read(self.process.stdout.fileno(), 4096)
+            with self.condition:
+                if not data:
+                    self.closed = True
+                    self.condition.notify_all()
+                    return
+                self.data += data.decode(errors="replace")
+                self.condition.notify_all()
+
+    def expect(self, pattern, timeout):
+        """Wait for pattern in the console output following the previous match."""
+        pattern  = re.compile(pattern)
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                m = pattern.search(self.data, self.position)
+                if m is not None:
+                    self.position = m.end()
+                    return m
+                if self.closed:
+                    raise EOFError("Simulation ended waiting for {!r}".format(pattern.pattern))
+                if time.time() > deadline:
+                    raise TimeoutError("Timeout ({}s) waiting for {!r}".format(timeout, pattern.pattern))
+                self.condition.wait(min(1, deadline - time.time()))
+
+    def send(self, line):
+        self.process.stdin.write((line + "\n").encode())
+        self.process.stdin.flush()
+
+# Scenario -----------------------------------------------------------------------------------------
+
+class Scenario:
+    """Simulated Linux boot with sim.py options, checked by a list of steps ({"send": command} and/or
+    {"expect": regexp, "timeout": s}) played on the serial console."""
+    def __init__(self, name, args=[], steps=[], timeout=3600, step_timeout=600):
+        self.name         = name
+        self.args         = args
+        self.steps        = steps
+        self.timeout      = timeout
+        self.step_timeout = step_timeout
+        self.build_name   = "regress_" + re.sub(r"[^\w.-]", "_", name)
+        self.gateware_dir = os.path.join("build", self.build_name, "gateware")
+        self.log_filename = os.path.join("build", self.build_name, "regress.log")
+        self.result       = "skipped"
+        self.message      = ""
+        self.console      = ""
+        self.duration     = 0
+
+    def prepare(self):
+        """Build the simulator and its memories init files (sim.py --no-run)."""
+        os.makedirs(os.path.dirname(self.log_filename), exist_ok=True)
+        with open(self.log_filename, "w") as log:
+            r = subprocess.call(["./sim.py", "--build-name", self.build_name, "--no-run"] + self.args,
+                stdout=log, stderr=subprocess.STDOUT)
+        if r != 0:
+            self.result  = "error"
+            self.message = "Simulator build failed, see {}".format(self.log_filename)
+        return r == 0
+
+    def run(self):
+        start   = time.time()
+        process = subprocess.Popen([os.path.join("obj_dir", "Vdut")], cwd=self.gateware_dir,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        console = Console(process)
+        try:
+            for step in self.steps:
+                if "send" in step:
+                    console.send(step["send"])
+                if "expect" in step:
+                    timeout = min(step.get("timeout", self.step_timeout), start + self.timeout - time.time())
+                    console.expect(step["expect"], max(timeout, 0))
+            console.send(finish_command)
+            process.wait(timeout=max(start + self.timeout - time.time(), 10))
+            self.result = "passed"
+        except (TimeoutError, EOFError, subprocess.TimeoutExpired) as e:
+            self.result  = "failed"
+            self.message = str(e)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            self.duration = time.time() - start
+            console.thread.join(timeout=1)
+            self.console = console.data
+        with open(self.log_filename, "a") as log:
+            log.write(self.console)
+        return self
+
+# Report -------------------------------------------------------------------------------------------
+
+def write_junit(scenarios, filename):
+    testsuite = ET.Element("testsuite", name="sim_regress",
+        tests    = str(len(scenarios)),
+        failures = str(sum(s.result == "failed" for s in scenarios)),
+        errors   = str(sum(s.result == "error" for s in scenarios)),
+        skipped  = str(sum(s.result == "skipped" for s in scenarios)),
+        time     = "{:.3f}".format(sum(s.duration for s in scenarios)))
+    for s in scenarios:
+        testcase = ET.SubElement(testsuite, "testcase", classname="sim", name=s.name,
+            time="{:.3f}".format(s.duration))
+        if s.result in ["failed", "error", "skipped"]:
+            ET.SubElement(testcase, {"failed": "failure"}.get(s.result, s.result), message=s.message)
+        ET.SubElement(testcase, "system-out").text = s.console
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    ET.ElementTree(testsuite).write(filename, encoding="utf-8", xml_declaration=True)
+
+def report(scenarios):
+    print("")
+    print("{:<24} {:>8} {:>10}  {}".format("Scenario", "Result", "Time (s)", "Message"))
+    print("-"*60)
+    for s in scenarios:
+        print("{:<24} {:>8} {:>10.1f}  {}".format(s.name, s.result, s.duration, s.message))
+
+def load_scenarios(filename):
+    with open(filename) as f:
+        config = json.load(f)
+    defaults = config.get("defaults", {})
+    return [Scenario(**dict(defaults, **scenario)) for scenario in config["scenarios"]]
+
+def main():
+    parser = argparse.ArgumentParser(description="Linux on LiteX-VexRiscv simulation regression runner")
+    parser.add_argument("scenarios", nargs="?", default="sim_regress.json", help="scenarios JSON file")
+    parser.add_argument("--only", default="", help="comma-separated scenarios to run (default: all)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of simulations run in parallel")
+    parser.add_argument("--junit", default="build/sim_regress.xml", help="JUnit XML report file")
+    parser.add_argument("--no-prepare", action="store_true", help="run already built simulators")
+    args = parser.parse_args()
+
+    scenarios = load_scenarios(args.scenarios)
+    if args.only:
+        scenarios = [s for s in scenarios if s.name in args.only.split(",")]
+
+    # Simulators built one at a time (sim.py shares emulator/), run in parallel.
+    runnable = []
+    for s in scenarios:
+        print("Preparing {}...".format(s.name))
+        if args.no_prepare or s.prepare():
+            runnable.append(s)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        for s in executor.map(Scenario.run, runnable):
+            print("{}: {} ({:.1f}s)".format(s.name, s.result, s.duration))
+
+    report(scenarios)
+    write_junit(scenarios, args.junit)
+    sys.exit(0 if all(s.result == "passed" for s in scenarios) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 
 from migen import *
 
+from litex.soc.interconnect import stream
 from litex.soc.interconnect import wishbone
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect.csr_eventmanager import *
 from litex.soc.integration.soc_core import mem_decoder
 
 from litex.soc.cores.spi_flash import SpiFlash
@@ -15,8 +19,14 @@ from litex.soc.cores.xadc import XADC
 from litex.soc.cores.pwm import PWM
 from litex.soc.cores.icap import ICAPBitstream
 
+from liteeth.common import eth_phy_description
+from liteeth.core.mac import LiteEthMAC
+from liteeth.core.mac.core import LiteEthMACCore
+
 from litevideo.output import VideoOut
 
+import json2dts
+
 # Helpers ------------------------------------------------------------------------------------------
 
 def platform_request_all(platform, name):
@@ -31,6 +41,335 @@ def platform_request_all(platform, name):
         raise ValueError
     return r
 
+# MTime --------------------------------------------------------------------------------------------
+
+class MTime(Module):
+    """Free-running 64-bit time counter (sys_clk cycles) memory-mapped on Wishbone.
+
+    Allows reading the time base without trapping to the machine mode emulator. Reading the low word
+    (offset 0x0) latches the high word (offset 0x4) for coherent 64-bit reads. The time can be reloaded
+    (simulation snapshot restore) by writing the high word then the low word.
+    """
+    def __init__(self):
+        self.bus = bus = wishbone.Interface()
+
+        # # #
+
+        time    = Signal(64)
+        time_hi = Signal(32)
+        self.sync += time.eq(time + 1)
+        self.sync += [
+            bus.ack.eq(0),
+            If(bus.cyc & bus.stb & ~bus.ack,
+                bus.ack.eq(1),
+                If(bus.adr[0],
+                    bus.dat_r.eq(time_hi),
+                    If(bus.we, time_hi.eq(bus.dat_w))
+                ).Else(
+                    bus.dat_r.eq(time[:32]),
+                    If(bus.we,
+                        time.eq(Cat(bus.dat_w, time_hi))
+                    ).Else(
+                        time_hi.eq(time[32:])
+                    )
+                )
+            )
+        ]
+
+# LiteEthMACDMA ------------------------------------------------------------------------------------
+
+class LiteEthMACDMAWriter(Module, AutoCSR):
+    """Writes the received frames to Rx slots of main_ram (Wishbone DMA), same CSRs as the SRAM writer."""
+    def __init__(self, dw, nslots, slot_size, endianness):
+        self.sink = sink = stream.Endpoint(eth_phy_description(dw))
+        self.bus  = bus  = wishbone.Interface()
+        self.base = Signal(32)
+
+        slotbits   = max(log2_int(nslots, need_pow2=False), 1)
+        lengthbits = 32
+
+        self._slot   = CSRStatus(slotbits)
+        self._length = CSRStatus(lengthbits)
+        self.errors  = CSRStatus(32)
+
+        self.submodules.ev = EventManager()
+        self.ev.available = EventSourceLevel()
+        self.ev.finalize()
+
+        # # #
+
+        # The PHY can't be back-pressured: buffer a frame while waiting for the bus.
+        fifo = stream.SyncFIFO(eth_phy_description(dw), slot_size//(dw//8), buffered=True)
+        self.submodules += fifo
+        self.comb += sink.connect(fifo.sink)
+        source = fifo.source
+
+        # Length computation
+        inc = Signal(3)
+        if endianness == "big":
+            self.comb += Case(source.last_be, {
+                0b1000:    inc.eq(1),
+                0b0100:    inc.eq(2),
+                0b0010:    inc.eq(3),
+                "default": inc.eq(4)
+            })
+        else:
+            self.comb += Case(source.last_be, {
+                0b0001:    inc.eq(1),
+                0b0010:    inc.eq(2),
+                0b0100:    inc.eq(3),
+                "default": inc.eq(4)
+            })
+
+        slot   = Signal(slotbits)
+        length = Signal(lengthbits)
+        offset = Signal(max=slot_size//(dw//8))
+
+        # Status FIFO (received slots not yet released by the CPU)
+        stat_fifo = stream.SyncFIFO([("slot", slotbits), ("length", lengthbits)], nslots)
+        self.submodules += stat_fifo
+
+        # FSM
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            NextValue(length, 0),
+            NextValue(offset, 0),
+            If(source.valid,
+                If(stat_fifo.sink.ready,
+                    NextState("WRITE")
+                ).Else(
+                    # No slot available: frame dropped.
+                    NextValue(self.errors.status, self.errors.status + 1),
+                    NextState("DISCARD")
+                )
+            )
+        )
+        fsm.act("WRITE",
+            bus.stb.eq(source.valid),
+            bus.cyc.eq(source.valid),
+            bus.we.eq(1),
+            bus.sel.eq(2**(dw//8) - 1),
+            bus.adr.eq(self.base[2:] + (slot << log2_int(slot_size//(dw//8))) + offset),
+            bus.dat_w.eq(source.data),
+            If(bus.ack,
+                source.ready.eq(1),
+                NextValue(length, length + inc),
+                NextValue(offset, offset + 1),
+                If(source.last,
+                    If((source.error & source.last_be) != 0,
+                        NextState("IDLE")
+                    ).Else(
+                        NextState("TERMINATE")
+                    )
+                ).Elif(offset == (slot_size//(dw//8) - 1),
+                    # Frame larger than the slot: dropped.
+                    NextValue(self.errors.status, self.errors.status + 1),
+                    NextState("DISCARD")
+                )
+            )
+        )
+        fsm.act("DISCARD",
+            source.ready.eq(1),
+            If(source.valid & source.last,
+                NextState("IDLE")
+            )
+        )
+        fsm.act("TERMINATE",
+            stat_fifo.sink.valid.eq(1),
+            stat_fifo.sink.slot.eq(slot),
+            stat_fifo.sink.length.eq(length),
+            NextValue(slot, Mux(slot == (nslots - 1), 0, slot + 1)),
+            NextState("IDLE")
+        )
+
+        self.comb += [
+            stat_fifo.source.ready.eq(self.ev.available.clear),
+            self.ev.available.trigger.eq(stat_fifo.source.valid),
+            self._slot.status.eq(stat_fifo.source.slot),
+            self._length.status.eq(stat_fifo.source.length),
+        ]
+
+
+class LiteEthMACDMAReader(Module, AutoCSR):
+    """Reads the frames to transmit from Tx slots of main_ram (Wishbone DMA), same CSRs as the SRAM reader."""
+    def __init__(self, dw, nslots, slot_size, endianness):
+        self.source = source = stream.Endpoint(eth_phy_description(dw))
+        self.bus    = bus    = wishbone.Interface()
+        self.base   = Signal(32)
+
+        slotbits   = max(log2_int(nslots, need_pow2=False), 1)
+        lengthbits = bits_for(slot_size)
+
+        self._start  = CSR()
+        self._ready  = CSRStatus()
+        self._level  = CSRStatus(bits_for(nslots))
+        self._slot   = CSRStorage(slotbits)
+        self._length = CSRStorage(lengthbits)
+
+        self.submodules.ev = EventManager()
+        self.ev.done = EventSourcePulse()
+        self.ev.finalize()
+
+        # # #
+
+        # Command FIFO
+        cmd_fifo = stream.SyncFIFO([("slot", slotbits), ("length", lengthbits)], nslots)
+        self.submodules += cmd_fifo
+        self.comb += [
+            cmd_fifo.sink.valid.eq(self._start.re),
+            cmd_fifo.sink.slot.eq(self._slot.storage),
+            cmd_fifo.sink.length.eq(self._length.storage),
+            self._ready.status.eq(cmd_fifo.sink.ready),
+            self._level.status.eq(cmd_fifo.level)
+        ]
+        cmd = cmd_fifo.source
+
+        # Last word byte enable
+        last_be = Signal(dw//8)
+        if endianness == "big":
+            self.comb += Case(cmd.length[:2], {
+                0: last_be.eq(0b0001),
+                1: last_be.eq(0b1000),
+                2: last_be.eq(0b0100),
+                3: last_be.eq(0b0010)
+            })
+        else:
+            self.comb += Case(cmd.length[:2], {
+                0: last_be.eq(0b1000),
+                1: last_be.eq(0b0001),
+                2: last_be.eq(0b0010),
+                3: last_be.eq(0b0100)
+            })
+
+        # Frames are sent once entirely read (store and forward): the PHY can't wait for the bus.
+        fifo = stream.SyncFIFO(eth_phy_description(dw), slot_size//(dw//8), buffered=True)
+        self.submodules += fifo
+        frames = Signal(max=slot_size//(dw//8) + 1)
+        push   = fifo.sink.valid & fifo.sink.ready & fifo.sink.last
+        pop    = fifo.source.valid & fifo.source.ready & fifo.source.last
+        self.sync += [
+            If(push & ~pop,
+                frames.eq(frames + 1)
+            ).Elif(pop & ~push,
+                frames.eq(frames - 1)
+            )
+        ]
+        self.comb += [
+            fifo.source.connect(source, omit={"valid", "ready"}),
+            source.valid.eq(fifo.source.valid & (frames != 0)),
+            fifo.source.ready.eq(source.ready & (frames != 0)),
+        ]
+
+        offset = Signal(max=slot_size//(dw//8))
+        last   = Signal()
+        self.comb += last.eq((offset + 1) >= ((cmd.length + (dw//8 - 1)) >> log2_int(dw//8)))
+
+        # FSM
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            NextValue(offset, 0),
+            If(cmd.valid,
+                NextState("READ")
+            )
+        )
+        fsm.act("READ",
+            bus.stb.eq(fifo.sink.ready),
+            bus.cyc.eq(fifo.sink.ready),
+            bus.we.eq(0),
+            bus.sel.eq(2**(dw//8) - 1),
+            bus.adr.eq(self.base[2:] + (cmd.slot << log2_int(slot_size//(dw//8))) + offset),
+            fifo.sink.data.eq(bus.dat_r),
+            fifo.sink.last.eq(last),
+            If(last,
+                fifo.sink.last_be.eq(last_be)
+            ),
+            If(bus.ack,
+                fifo.sink.valid.eq(1),
+                NextValue(offset, offset + 1),
+                If(last,
+                    NextState("TERMINATE")
+                )
+            )
+        )
+        fsm.act("TERMINATE",
+            # Slot released once read, before the frame is sent.
+            cmd.ready.eq(1),
+            self.ev.done.trigger.eq(1),
+            NextState("IDLE")
+        )
+
+
+class LiteEthMACDMA(Module, AutoCSR):
+    """LiteEthMAC with the Rx/Tx slots in main_ram, written/read by DMA.
+
+    The CPU reads the received frames from cached memory instead of doing uncached accesses to the
+    SRAM slots of LiteEthMAC. CSRs are the same as the SRAM interface of LiteEthMAC, bus is a small
+    registers window with the base addresses of the Rx (offset 0x0) and Tx (offset 0x4) slots, set by
+    the CPU, dma_bus the Wishbone master to add to the SoC.
+    """
+    def __init__(self, phy, dw, endianness="big", nrxslots=2, ntxslots=2, slot_size=0x800,
+        with_preamble_crc=True):
+        assert dw == 32
+        assert slot_size >= 0x600 and slot_size <= 0x8000 and (slot_size & (slot_size - 1)) == 0
+        assert nrxslots <= 128 and ntxslots <= 128
+        self.submodules.core   = LiteEthMACCore(phy, dw, endianness, with_preamble_crc)
+        self.submodules.writer = LiteEthMACDMAWriter(dw, nrxslots, slot_size, endianness)
+        self.submodules.reader = LiteEthMACDMAReader(dw, ntxslots, slot_size, endianness)
+        self.submodules.ev     = SharedIRQ(self.writer.ev, self.reader.ev)
+        self.comb += [
+            self.core.source.connect(self.writer.sink),
+            self.reader.source.connect(self.core.sink),
+        ]
+
+        self.rx_slots  = CSRConstant(nrxslots)
+        self.tx_slots  = CSRConstant(ntxslots)
+        self.slot_size = CSRConstant(slot_size)
+        self.dma       = CSRConstant(1)
+
+        # SRAM interface CSRs names (used by the BIOS), then MAC core CSRs.
+        self.csrs = []
+        for prefix, m in [("sram_writer_", self.writer), ("sram_reader_", self.reader)]:
+            for csr in m.get_csrs():
+                csr.name = prefix + csr.name
+                self.csrs.append(csr)
+        self.csrs += self.core.get_csrs()
+
+        # # #
+
+        # DMA
+        self.dma_bus = wishbone.Interface()
+        self.submodules.arbiter = wishbone.Arbiter([self.writer.bus, self.reader.bus], self.dma_bus)
+
+        # Slots base addresses registers
+        self.bus = bus = wishbone.Interface()
+        self.sync += [
+            bus.ack.eq(0),
+            If(bus.cyc & bus.stb & ~bus.ack,
+                bus.ack.eq(1),
+                If(bus.adr[0],
+                    bus.dat_r.eq(self.reader.base),
+                    If(bus.we, self.reader.base.eq(bus.dat_w))
+                ).Else(
+                    bus.dat_r.eq(self.writer.base),
+                    If(bus.we, self.writer.base.eq(bus.dat_w))
+                )
+            )
+        ]
+
+    def get_csrs(self):
+        return self.csrs
+
+
+def liteeth_mac(rx_slots=2, tx_slots=2, slot_size=0x800, dma=False):
+    """Returns a LiteEthMAC constructor with the given Rx/Tx slots (SRAM or DMA in main_ram)."""
+    def ethmac(phy, dw, interface="wishbone", endianness="big", **kwargs):
+        if dma:
+            return LiteEthMACDMA(phy, dw, endianness, rx_slots, tx_slots, slot_size, **kwargs)
+        # SRAM slots size is fixed by the MTU.
+        assert slot_size == 0x800
+        return LiteEthMAC(phy, dw, interface, endianness, nrxslots=rx_slots, ntxslots=tx_slots, **kwargs)
+    return ethmac
+
 # SoCLinux -----------------------------------------------------------------------------------------
 
 def SoCLinux(soc_cls, **kwargs):
@@ -50,24 +389,44 @@ def SoCLinux(soc_cls, **kwargs):
             "emulator_ram": 0x20000000,
             "ethmac":       0xb0000000,
             "spiflash":     0xd0000000,
+            "mtime":        0xe0000000,
             "main_ram":     0xc0000000,
             "csr":          0xf0000000,
         }
 
-        def __init__(self, cpu_variant="linux", **kwargs):
-            soc_cls.__init__(self, cpu_type="vexriscv", cpu_variant=cpu_variant, uart_baudrate=1e6, **kwargs)
+        def __init__(self, cpu_variant="linux", uart_baudrate=1e6,
+            ethmac_rx_slots=2, ethmac_tx_slots=2, ethmac_slot_size=0x800, ethmac_dma=False,
+            csr_data_width=8, **kwargs):
+            # The Ethernet MAC of the targets is created by their __init__ (with the default slots): have it
+            # created with the configured slots.
+            target     = sys.modules[soc_cls.__module__]
+            target_mac = getattr(target, "LiteEthMAC", None)
+            if target_mac is not None:
+                target.LiteEthMAC = liteeth_mac(ethmac_rx_slots, ethmac_tx_slots, ethmac_slot_size, ethmac_dma)
+            try:
+                soc_cls.__init__(self, cpu_type="vexriscv", cpu_variant=cpu_variant, uart_baudrate=uart_baudrate,
+                    csr_data_width=csr_data_width, **kwargs)
+            finally:
+                if target_mac is not None:
+                    target.LiteEthMAC = target_mac
+            # CSR data width (8: LiteX default, 32: one bus access per CSR up to 32-bit), exported for
+            # json2dts (litex,csr-data-width of the Linux drivers).
+            self.config["CSR_DATA_WIDTH"] = csr_data_width
+            if hasattr(self, "ethmac") and ethmac_dma:
+                self.add_wb_master(self.ethmac.dma_bus)
 
             # machine mode emulator ram
             self.submodules.emulator_ram = wishbone.SRAM(0x4000)
             self.register_mem("emulator_ram", self.mem_map["emulator_ram"], self.emulator_ram.bus, 0x4000)
 
-        def add_spi_flash(self):
+        def add_spi_flash(self, dummy=11, div=2):
             # TODO: add spiflash1x support
+            # dummy: read dummy cycles (flash/read command dependent), div: SPI clock divider of reads.
             spiflash_pads = self.platform.request("spiflash4x")
             self.submodules.spiflash = SpiFlash(
                 spiflash_pads,
-                dummy=11,
-                div=2,
+                dummy=dummy,
+                div=div,
                 with_bitbang=True,
                 endianness=self.cpu.endianness)
             self.spiflash.add_clk_primitive(self.platform.device)
@@ -75,6 +434,11 @@ def SoCLinux(soc_cls, **kwargs):
             self.add_memory_region("spiflash", self.mem_map["spiflash"], 0x1000000, type="io")
             self.add_csr("spiflash")
 
+        def add_mtime(self):
+            self.submodules.mtime = MTime()
+            self.add_wb_slave(mem_decoder(self.mem_map["mtime"]), self.mtime.bus)
+            self.add_memory_region("mtime", self.mem_map["mtime"], 0x8, type="io")
+
         def add_leds(self):
             self.submodules.leds = GPIOOut(Cat(platform_request_all(self.platform, "user_led")))
             self.add_csr("leds")
@@ -144,22 +508,28 @@ def SoCLinux(soc_cls, **kwargs):
             self.add_constant("REMOTEIP3", int(remote_ip[2]))
             self.add_constant("REMOTEIP4", int(remote_ip[3]))
 
-        def configure_boot(self):
+        def configure_boot(self, flash_layout=None):
             if hasattr(self, "spiflash"):
-                self.add_constant("FLASH_BOOT_ADDRESS", 0x00400000)
+                if flash_layout is None:
+                    self.add_constant("FLASH_BOOT_ADDRESS", 0x00400000)
+                else:
+                    for name, value in flash_layout.get_constants().items():
+                        self.add_constant(name, value)
 
-        def generate_dts(self, board_name):
+        def generate_dts(self, board_name, initrd_size=None, flash_rootfs=None):
             json = os.path.join("build", board_name, "csr.json")
             dts = os.path.join("build", board_name, "{}.dts".format(board_name))
-            os.system("./json2dts.py {} > {}".format(json, dts))
+            json2dts.write_dts(json, dts, initrd_size=initrd_size, flash_rootfs=flash_rootfs)
 
         def compile_dts(self, board_name):
             dts = os.path.join("build", board_name, "{}.dts".format(board_name))
             dtb = os.path.join("buildroot", "rv32.dtb")
-            os.system("dtc -O dtb -o {} {}".format(dtb, dts))
+            json2dts.compile_dts(dts, dtb)
 
-        def compile_emulator(self, board_name):
+        def compile_emulator(self, board_name, trap_stats=False, csr_bench=False):
             os.environ["BOARD"] = board_name
+            os.environ["TRAP_STATS"] = "1" if trap_stats else "0"
+            os.environ["CSR_BENCH"] = "1" if csr_bench else "0"
             os.system("cd emulator && make")
 
     return _SoCLinux(**kwargs)